@@ -1,63 +1,541 @@
 import os
-from flask import Flask, request, jsonify, render_template
+import json
+import hashlib
+import tarfile
+import zipfile
+from collections import deque
+from concurrent.futures import Future
+import tempfile
+import time
+from contextlib import contextmanager
+from functools import partial
+from flask import Flask, Request, Response, g, request, jsonify, render_template, stream_with_context
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
 from werkzeug.utils import secure_filename
-import torch
-from torch.serialization import add_safe_globals
-from ultralytics.nn.tasks import DetectionModel
-from torch.nn.modules.container import Sequential, ModuleList
-from ultralytics.nn.modules.conv import Conv
-from ultralytics.nn.modules.block import C2f, SPPF, Bottleneck, DFL
-from ultralytics.nn.modules.head import Detect
-from torch.nn.modules.conv import Conv2d
-from torch.nn.modules.batchnorm import BatchNorm2d
-from torch.nn.modules.activation import SiLU
-from torch.nn.modules.pooling import MaxPool2d
-from torch.nn.modules.upsampling import Upsample
-from ultralytics.nn.modules.conv import Concat
+from ml_model import metrics
 from ml_model.detect import StarWarsDetector
+from ml_model.batching import PRIORITIES, BatchingScheduler, DeadlineExceededError, QueueFullError
+from ml_model.cache import DetectionCache, content_digest, make_key
+from ml_model.results import Detections, render_detections
+from ml_model.rendering import RenderStore, encode_jpeg
+from ml_model.resolution import ResolutionPolicy
+from ml_model.runtime_config import load_runtime_config
+from ml_model.video import VIDEO_EXTENSIONS
 import base64
-from io import BytesIO
-from PIL import Image
-
-# Add safe globals for model loading
-add_safe_globals([
-    Upsample,
-    MaxPool2d,
-    Bottleneck,
-    ModuleList,
-    DetectionModel,
-    Sequential,
-    Conv,
-    C2f,
-    SPPF,
-    Detect,
-    Conv2d,
-    BatchNorm2d,
-    SiLU,
-    Concat,
-    DFL
-])
+import uuid
+from io import BytesIO, UnsupportedOperation
+
+class DetectorRequest(Request):
+    @property
+    def max_content_length(self):
+        # Los endpoints masivo y de vídeo tienen su propio límite de tamaño
+        if self.path in ('/detect/batch', '/detect/video'):
+            return app.config['BULK_MAX_CONTENT_LENGTH']
+        return super().max_content_length
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
+app.request_class = DetectorRequest
 
 # Configuración de la aplicación
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max-limit
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg'}
+app.config['DEFAULT_CONF_THRESHOLD'] = 0.25
+# /detect/batch admite subidas mayores; werkzeug las vuelca a ficheros temporales
+app.config['BULK_MAX_CONTENT_LENGTH'] = int(os.environ.get('BULK_MAX_CONTENT_LENGTH', 1024 * 1024 * 1024))
+app.config['BULK_ARCHIVE_EXTENSIONS'] = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+# Ajustes medidos en esta máquina por benchmarks/autotune.py (RUNTIME_CONFIG, por defecto
+# runtime_config.json); las variables de entorno tienen prioridad
+runtime_config = load_runtime_config()
+# Micro-batching: las peticiones que llegan dentro de la ventana comparten una pasada del modelo
+app.config['BATCH_MAX_SIZE'] = int(os.environ.get('BATCH_MAX_SIZE', runtime_config.get('batch_max_size', 8)))
+app.config['BATCH_WINDOW_MS'] = float(os.environ.get('BATCH_WINDOW_MS', runtime_config.get('batch_window_ms', 5)))
+# Control de admisión: con la cola llena se responde 503 con Retry-After en vez de
+# acumular trabajo que caducará. Las peticiones 'bulk' solo entran hasta QUEUE_BULK_SIZE,
+# dejando el resto de la cola a las 'interactive' (la interfaz web)
+app.config['QUEUE_MAX_SIZE'] = int(os.environ.get('QUEUE_MAX_SIZE', 64))
+app.config['QUEUE_BULK_SIZE'] = int(os.environ.get('QUEUE_BULK_SIZE', app.config['QUEUE_MAX_SIZE'] // 2))
+# Prioridad de las peticiones sin cabecera X-Priority
+app.config['DEFAULT_PRIORITY'] = os.environ.get('DEFAULT_PRIORITY', 'bulk')
+# Vídeo: procesar uno de cada VIDEO_STRIDE fotogramas y reutilizar las detecciones
+# de los fotogramas casi idénticos al último inferido (0 = inferir todos)
+app.config['VIDEO_EXTENSIONS'] = VIDEO_EXTENSIONS
+app.config['VIDEO_STRIDE'] = int(os.environ.get('VIDEO_STRIDE', 1))
+app.config['VIDEO_SCENE_THRESHOLD'] = float(os.environ.get('VIDEO_SCENE_THRESHOLD', 0.02))
+# Inferencia por teselas (campo tiled=1 en /detect y /predict): para imágenes grandes
+# con personajes pequeños; TILE_MAX_TILES acota el coste de cada petición
+app.config['TILE_SIZE'] = int(os.environ.get('TILE_SIZE', 640))
+app.config['TILE_OVERLAP'] = float(os.environ.get('TILE_OVERLAP', 0.2))
+app.config['TILE_MAX_TILES'] = int(os.environ.get('TILE_MAX_TILES', 16))
+app.config['TILE_MERGE'] = os.environ.get('TILE_MERGE', 'wbf')
+# Tamaño de entrada del modelo según la imagen: INPUT_SIZES lista los tamaños permitidos
+# (vacío = siempre el del entrenamiento) y RESOLUTION_PROFILE las latencias medidas con
+# python -m ml_model.resolution, para respetar el campo latency_budget_ms de cada petición
+app.config['INPUT_SIZES'] = os.environ.get('INPUT_SIZES', '')
+app.config['RESOLUTION_PROFILE'] = os.environ.get('RESOLUTION_PROFILE') or None
+# Métricas Prometheus en /metrics (gunicorn.conf.py agrega las de todos los workers)
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1') == '1'
+
+# Las imágenes se decodifican en memoria; solo las subidas mayores a este tamaño
+# se escriben a disco (0 = nunca)
+app.config['SPOOL_THRESHOLD_BYTES'] = int(os.environ.get('SPOOL_THRESHOLD_BYTES', 0))
+
+# Caché de resultados por contenido: LRU en proceso (CACHE_MAX_ENTRIES=0 lo desactiva)
+# y, opcionalmente, un fichero sqlite compartido por todos los workers
+app.config['CACHE_MAX_ENTRIES'] = int(os.environ.get('CACHE_MAX_ENTRIES', 1024))
+app.config['CACHE_MAX_BYTES'] = int(os.environ.get('CACHE_MAX_BYTES', 64 * 1024 * 1024))
+app.config['CACHE_TTL_SECONDS'] = float(os.environ.get('CACHE_TTL_SECONDS', 0)) or None
+app.config['CACHE_SHARED_PATH'] = os.environ.get('CACHE_SHARED_PATH') or None
+app.config['CACHE_ANNOTATED_IMAGES'] = os.environ.get('CACHE_ANNOTATED_IMAGES', '1') == '1'
+# Imagen anotada de /predict: calidad JPEG, lado máximo (0 = tamaño original) y
+# vida de las URLs de render diferido
+app.config['JPEG_QUALITY'] = int(os.environ.get('JPEG_QUALITY', 75))
+app.config['RENDER_MAX_SIZE'] = int(os.environ.get('RENDER_MAX_SIZE', 0))
+app.config['RENDER_URL_TTL_SECONDS'] = float(os.environ.get('RENDER_URL_TTL_SECONDS', 300))
 
 # Asegurarse de que el directorio de uploads existe
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
 # Ruta al modelo
-MODEL_PATH = os.path.join('ml_model', 'best.pt')
+MODEL_PATH = os.environ.get('MODEL_PATH', os.path.join('ml_model', 'best.pt'))
+# Backend de inferencia: 'pytorch' o 'onnx' (usa ml_model/best.onnx, sin importar torch)
+app.config['DETECTOR_BACKEND'] = os.environ.get('DETECTOR_BACKEND', 'pytorch')
+# Variante optimizada publicada por python -m ml_model.optimize (p. ej. 'int8-static');
+# si se indica, decide ella el backend
+app.config['MODEL_VARIANT'] = os.environ.get('MODEL_VARIANT') or None
+# Pasadas de calentamiento antes de aceptar tráfico
+app.config['WARMUP_RUNS'] = int(os.environ.get('WARMUP_RUNS', 1))
+# Guardar junto a los pesos una copia ya fusionada (Conv+BN) para arrancar más rápido
+app.config['CACHE_FUSED_MODEL'] = os.environ.get('CACHE_FUSED_MODEL', '1') == '1'
+
+# Cargar el modelo una sola vez en el master de gunicorn y compartirlo con los workers
+# (ver gunicorn.conf.py)
+app.config['PRELOAD_MODEL'] = os.environ.get('PRELOAD_MODEL', '1') == '1'
 
 # Inicializar el detector
-detector = StarWarsDetector(MODEL_PATH)
+backend_options = {}
+if app.config['MODEL_VARIANT'] is None and app.config['DETECTOR_BACKEND'] == 'pytorch':
+    backend_options['cache_fused'] = app.config['CACHE_FUSED_MODEL']
+resolution_policy = None
+if app.config['RESOLUTION_PROFILE']:
+    resolution_policy = ResolutionPolicy.from_profile(
+        app.config['RESOLUTION_PROFILE'], app.config['INPUT_SIZES'] or None
+    )
+elif app.config['INPUT_SIZES']:
+    resolution_policy = ResolutionPolicy(app.config['INPUT_SIZES'])
+detector = StarWarsDetector(
+    MODEL_PATH,
+    backend=None if app.config['MODEL_VARIANT'] else app.config['DETECTOR_BACKEND'],
+    variant=app.config['MODEL_VARIANT'],
+    warmup_runs=app.config['WARMUP_RUNS'],
+    resolution_policy=resolution_policy,
+    **backend_options
+)
+app.logger.info(
+    'Detector ready (%s): %s',
+    detector.model_version,
+    ', '.join(f'{phase} {seconds * 1000:.0f}ms' for phase, seconds in detector.startup_timings.items())
+)
+if app.config['PRELOAD_MODEL']:
+    detector.freeze()
+batcher = BatchingScheduler(
+    detector,
+    max_batch_size=app.config['BATCH_MAX_SIZE'],
+    batch_window_ms=app.config['BATCH_WINDOW_MS'],
+    max_queue_size=app.config['QUEUE_MAX_SIZE'],
+    bulk_queue_size=app.config['QUEUE_BULK_SIZE']
+)
+
+cache = None
+if app.config['CACHE_MAX_ENTRIES'] > 0:
+    cache = DetectionCache(
+        max_entries=app.config['CACHE_MAX_ENTRIES'],
+        max_bytes=app.config['CACHE_MAX_BYTES'],
+        ttl=app.config['CACHE_TTL_SECONDS'],
+        shared_path=app.config['CACHE_SHARED_PATH']
+    )
+
+RESPONSE_MODES = ('json', 'detections', 'jpeg', 'multipart', 'url')
+render_store = RenderStore(
+    os.path.join(app.config['UPLOAD_FOLDER'], 'renders'),
+    ttl=app.config['RENDER_URL_TTL_SECONDS']
+)
+
+def init_worker(num_threads, interop_threads=None, opencv_threads=None):
+    """Per-worker setup, called by gunicorn once a worker has loaded the app."""
+    detector.set_num_threads(num_threads, interop_threads, opencv_threads)
+    app.logger.info('Worker %d using %d inference threads', os.getpid(), num_threads)
+
+def get_conf_threshold(form=None):
+    """Read the optional per-request confidence threshold from the form (request.form by default)."""
+    form = request.form if form is None else form
+    value = form.get('conf', app.config['DEFAULT_CONF_THRESHOLD'])
+    try:
+        conf = float(value)
+    except (TypeError, ValueError):
+        raise ValueError('conf must be a number')
+    if not 0.0 <= conf <= 1.0:
+        raise ValueError('conf must be between 0 and 1')
+    return conf
+
+@contextmanager
+def open_upload(file):
+    """
+    Yield the encoded upload and its content hash.
+    
+    The upload is kept in memory, or spooled to a uniquely named temp file
+    (removed on exit) when it is larger than SPOOL_THRESHOLD_BYTES.
+    """
+    spool_threshold = app.config['SPOOL_THRESHOLD_BYTES']
+    if spool_threshold and (request.content_length or 0) > spool_threshold:
+        # Unique temp name so concurrent uploads with the same filename never collide
+        suffix = os.path.splitext(secure_filename(file.filename))[1]
+        fd, filepath = tempfile.mkstemp(suffix=suffix, dir=app.config['UPLOAD_FOLDER'])
+        digest = hashlib.blake2b(digest_size=16)
+        try:
+            with metrics.stage_timer('upload'), os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: file.stream.read(1024 * 1024), b''):
+                    digest.update(chunk)
+                    f.write(chunk)
+            yield filepath, digest.hexdigest()
+        finally:
+            os.remove(filepath)
+    else:
+        with metrics.stage_timer('upload'):
+            stream = file.stream
+            data = stream.getbuffer() if isinstance(stream, BytesIO) else stream.read()
+            digest = content_digest(data)
+        yield data, digest
+
+def get_tiling(form=None):
+    """Tiled-inference options if the request asks for them (form field 'tiled'), else None."""
+    form = request.form if form is None else form
+    if form.get('tiled', '0').lower() not in ('1', 'true', 'yes'):
+        return None
+    return {
+        'tile_size': app.config['TILE_SIZE'],
+        'overlap': app.config['TILE_OVERLAP'],
+        'max_tiles': app.config['TILE_MAX_TILES'],
+        'merge': app.config['TILE_MERGE'],
+    }
+
+def get_latency_budget(form=None, headers=None):
+    """Optional model latency budget in ms (form field or X-Latency-Budget-Ms header)."""
+    form = request.form if form is None else form
+    headers = request.headers if headers is None else headers
+    value = form.get('latency_budget_ms') or headers.get('X-Latency-Budget-Ms')
+    if value is None:
+        return None
+    try:
+        budget = float(value)
+    except (TypeError, ValueError):
+        raise ValueError('latency_budget_ms must be a number')
+    if budget <= 0:
+        raise ValueError('latency_budget_ms must be positive')
+    return budget
+
+def get_admission(form=None, headers=None, priority=None):
+    """
+    Admission options for the batcher: priority class and optional deadline.
+    
+    The priority comes from the X-Priority header or 'priority' form field
+    (DEFAULT_PRIORITY otherwise) unless the endpoint fixes it. The deadline is
+    an absolute Unix time in X-Request-Deadline or a timeout relative to now
+    in X-Request-Timeout-Ms.
+    """
+    form = request.form if form is None else form
+    headers = request.headers if headers is None else headers
+    if priority is None:
+        priority = headers.get('X-Priority') or form.get('priority') or app.config['DEFAULT_PRIORITY']
+    if priority not in PRIORITIES:
+        raise ValueError(f"priority must be one of: {', '.join(PRIORITIES)}")
+    deadline = None
+    try:
+        if headers.get('X-Request-Deadline'):
+            deadline = float(headers['X-Request-Deadline'])
+        elif headers.get('X-Request-Timeout-Ms'):
+            deadline = time.time() + float(headers['X-Request-Timeout-Ms']) / 1000.0
+    except ValueError:
+        raise ValueError('X-Request-Deadline and X-Request-Timeout-Ms must be numbers')
+    return {'priority': priority, 'deadline': deadline}
+
+def shed_response(error):
+    """503 with Retry-After for a full queue, 504 for a passed deadline."""
+    if isinstance(error, QueueFullError):
+        response = jsonify({'error': str(error)})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(error.retry_after)
+        return response
+    return jsonify({'error': str(error)}), 504
+
+def variant_tag(tiling=None, budget=None):
+    """Suffix for cache keys, so results of different detection settings never mix."""
+    parts = []
+    if detector.resolution_policy is not None:
+        parts.append(detector.resolution_policy.tag)
+        if budget is not None:
+            parts.append(f'b{budget:g}')
+    if tiling is not None:
+        parts.append('tiled-{tile_size}-{overlap}-{max_tiles}-{merge}'.format(**tiling))
+    return ''.join(f'-{part}' for part in parts)
+
+def result_key(digest, conf, kind='columns', tiling=None, budget=None):
+    """Cache key of a result of the current detector; every cached result goes through here."""
+    return make_key(digest, conf, detector.model_version, kind=kind + variant_tag(tiling, budget))
+
+def batched_detect(images, conf, admission=None):
+    """detect_batch replacement that sends every image through the shared batcher."""
+    futures = [batcher.submit(image, conf, return_image=False, **(admission or {})) for image in images]
+    return [future.result() for future in futures]
+
+def cached_detections(source, digest, conf, return_image=False, tiling=None, budget=None, admission=None):
+    """
+    Run detection through the result cache.
+    
+    With return_image, detections computed here keep the decoded upload as
+    their image, so rendering does not decode it again. Cache hits never
+    decode the upload, nor take a place in the batcher's queue.
+    """
+    key = result_key(digest, conf, tiling=tiling, budget=budget)
+    columns = cache.get(key) if cache else None
+    if cache:
+        metrics.CACHE_LOOKUPS.labels('miss' if columns is None else 'hit').inc()
+    if columns is None:
+        if tiling is None:
+            detections = batcher.detect(
+                source, conf, return_image=return_image, latency_budget_ms=budget, **(admission or {})
+            )
+        else:
+            detections = detector.detect_tiled(
+                source, conf, return_image=return_image,
+                detect_batch=partial(batched_detect, admission=admission), **tiling
+            )
+        if cache:
+            cache.set(key, detections.to_columns())
+    else:
+        detections = Detections.from_columns(columns, detector.class_names)
+    return detections
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
+
+def detections_json(detections, label_key, **fields):
+    """Serialize a response object whose 'detections' come straight from the arrays."""
+    with metrics.stage_timer('serialize'):
+        parts = ['{"detections":', detections.to_json(label_key)]
+        for key in sorted(fields):
+            parts.append(f',{json.dumps(key)}:{json.dumps(fields[key])}')
+        parts.append('}')
+        return ''.join(parts)
+
+def detections_response(detections, label_key, **fields):
+    return Response(detections_json(detections, label_key, **fields), mimetype='application/json')
+
+def detach_upload(file):
+    """
+    Return a stream for an upload that stays open after the request ends.
+    
+    Flask closes request.files when the view returns, before a streamed
+    response is consumed. Disk-backed uploads get a duplicated descriptor;
+    in-memory ones are small and simply copied.
+    """
+    stream = file.stream
+    stream.seek(0)
+    try:
+        fd = stream.fileno()
+    except (AttributeError, OSError, UnsupportedOperation):
+        return BytesIO(stream.read())
+    stream.flush()
+    detached = os.fdopen(os.dup(fd), 'rb')
+    detached.seek(0)
+    return detached
+
+def iter_archive(filename, stream):
+    """
+    Yield (filename, encoded bytes, error) for each image in a zip/tar upload.
+    
+    Members are read one at a time so memory stays bounded regardless of
+    the archive size.
+    """
+    max_size = app.config['MAX_CONTENT_LENGTH']
+    if filename.lower().endswith('.zip'):
+        with zipfile.ZipFile(stream) as zf:
+            for info in zf.infolist():
+                if info.is_dir() or not allowed_file(info.filename):
+                    continue
+                if info.file_size > max_size:
+                    yield info.filename, None, 'File too large'
+                    continue
+                yield info.filename, zf.read(info), None
+    else:
+        with tarfile.open(fileobj=stream, mode='r|*') as tf:
+            for member in tf:
+                if not member.isfile() or not allowed_file(member.name):
+                    continue
+                if member.size > max_size:
+                    yield member.name, None, 'File too large'
+                    continue
+                yield member.name, tf.extractfile(member).read(), None
+
+def iter_bulk_uploads(uploads):
+    """Yield (filename, encoded bytes, error) for every image of a bulk request."""
+    for filename, stream, is_archive in uploads:
+        with stream:
+            if is_archive:
+                try:
+                    yield from iter_archive(filename, stream)
+                except (zipfile.BadZipFile, tarfile.TarError) as e:
+                    yield filename, None, f'Invalid archive: {e}'
+            else:
+                yield filename, stream.read(), None
+
+def get_response_mode(args=None, form=None, accept=None):
+    """
+    Pick the /predict response mode.
+    
+    An explicit 'response' query/form field wins; otherwise the Accept header
+    can ask for image/jpeg or multipart/mixed. The default is JSON with the
+    annotated image embedded as a data URL. Query args, form and the raw
+    Accept header default to those of the current Flask request.
+    """
+    args = request.args if args is None else args
+    form = request.form if form is None else form
+    accept_mimetypes = request.accept_mimetypes if accept is None else parse_accept_header(accept, MIMEAccept)
+    mode = args.get('response') or form.get('response')
+    if mode is None:
+        best = accept_mimetypes.best_match(
+            ['application/json', 'image/jpeg', 'multipart/mixed'], default='application/json'
+        )
+        mode = {'image/jpeg': 'jpeg', 'multipart/mixed': 'multipart'}.get(best, 'json')
+    if mode not in RESPONSE_MODES:
+        raise ValueError(f"response must be one of: {', '.join(RESPONSE_MODES)}")
+    return mode
+
+def annotated_jpeg(detections, digest, conf, source=None, tiling=None, budget=None):
+    """
+    Rendered JPEG of the detections, served from the cache when possible.
+    
+    The source image is decoded only if detections does not already carry it.
+    """
+    quality, max_size = app.config['JPEG_QUALITY'], app.config['RENDER_MAX_SIZE']
+    key = result_key(digest, conf, f'jpeg-q{quality}-{max_size}', tiling, budget)
+    use_cache = cache and app.config['CACHE_ANNOTATED_IMAGES']
+    jpeg = cache.get(key) if use_cache else None
+    if jpeg is None:
+        image = detections.image
+        if image is None:
+            with metrics.stage_timer('decode'):
+                image = detector.load_image(source)
+        with metrics.stage_timer('render'):
+            rendered = render_detections(image, detections, max_size)
+        with metrics.stage_timer('jpeg_encode'):
+            jpeg = encode_jpeg(rendered, quality)
+        if use_cache:
+            cache.set(key, jpeg)
+    return jpeg
+
+def predict_output(source, digest, conf, mode, tiling=None, budget=None, admission=None):
+    """
+    Run /predict on an upload and build the response in the requested mode.
+    
+    Independent of the web framework, so the WSGI and ASGI apps share it.
+    
+    Returns:
+        Tuple of (body, mimetype, extra headers)
+    """
+    # Solo se decodifica la imagen para dibujar si el modo lo necesita
+    if mode in ('json', 'jpeg', 'multipart'):
+        results = cached_detections(
+            source, digest, conf, return_image=True, tiling=tiling, budget=budget, admission=admission
+        )
+        jpeg = annotated_jpeg(results, digest, conf, source=source, tiling=tiling, budget=budget)
+    else:
+        results = cached_detections(source, digest, conf, tiling=tiling, budget=budget, admission=admission)
+    
+    if mode == 'detections':
+        return detections_json(results, 'label', success=True), 'application/json', {}
+    if mode == 'url':
+        token = render_store.put(source, {
+            'digest': digest,
+            'conf': conf,
+            'tiling': tiling,
+            'budget': budget,
+            'columns': results.to_columns()
+        })
+        body = detections_json(
+            results, 'label', success=True,
+            image_url=f'/renders/{token}.jpg',
+            expires_in=app.config['RENDER_URL_TTL_SECONDS']
+        )
+        return body, 'application/json', {}
+    if mode == 'jpeg':
+        with metrics.stage_timer('serialize'):
+            headers = {'X-Detections': results.to_json('label')}
+        return jpeg, 'image/jpeg', headers
+    if mode == 'multipart':
+        boundary = uuid.uuid4().hex
+        body = b''.join([
+            f'--{boundary}\r\nContent-Type: application/json\r\n\r\n'.encode(),
+            detections_json(results, 'label', success=True).encode(),
+            f'\r\n--{boundary}\r\nContent-Type: image/jpeg\r\n\r\n'.encode(),
+            jpeg,
+            f'\r\n--{boundary}--\r\n'.encode()
+        ])
+        return body, f'multipart/mixed; boundary={boundary}', {}
+    # Generar imagen con las detecciones
+    with metrics.stage_timer('base64'):
+        img_data_url = f"data:image/jpeg;base64,{base64.b64encode(jpeg).decode()}"
+    return detections_json(results, 'label', success=True, image=img_data_url), 'application/json', {}
 
 @app.route('/')
 def home():
     return render_template('index.html')
 
+# Rutas que no cuentan como peticiones de detección
+UNINSTRUMENTED_ENDPOINTS = {None, 'static', 'metrics_endpoint'}
+
+@app.before_request
+def start_request_metrics():
+    if app.config['METRICS_ENABLED'] and request.endpoint not in UNINSTRUMENTED_ENDPOINTS:
+        g.metrics_started = time.perf_counter()
+        metrics.IN_FLIGHT.labels(request.endpoint).inc()
+
+@app.after_request
+def count_request(response):
+    if g.get('metrics_started') is not None:
+        metrics.REQUESTS.labels(request.endpoint, str(response.status_code)).inc()
+        if response.status_code >= 500:
+            metrics.ERRORS.labels('server').inc()
+        elif response.status_code >= 400:
+            metrics.ERRORS.labels('client').inc()
+    return response
+
+@app.teardown_request
+def finish_request_metrics(error):
+    # Con respuestas en streaming se ejecuta cuando termina el stream
+    started = g.get('metrics_started')
+    if started is not None:
+        metrics.IN_FLIGHT.labels(request.endpoint).dec()
+        metrics.REQUEST_SECONDS.labels(request.endpoint).observe(time.perf_counter() - started)
+        if error is not None:
+            metrics.ERRORS.labels('unhandled').inc()
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if not app.config['METRICS_ENABLED']:
+        return jsonify({'error': 'Metrics are disabled'}), 404
+    payload, content_type = metrics.render_latest()
+    return Response(payload, content_type=content_type)
+
+@app.route('/stats')
+def stats():
+    return jsonify({
+        'startup_seconds': detector.startup_timings,
+        'batching': batcher.stats(),
+        'cache': cache.stats() if cache else None
+    })
+
 @app.route('/detect', methods=['POST'])
 def detect():
     if 'file' not in request.files:
@@ -67,38 +545,158 @@ def detect():
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
     
+    try:
+        conf = get_conf_threshold()
+        tiling = get_tiling()
+        budget = get_latency_budget()
+        admission = get_admission()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     if file:
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        
         try:
-            results = detector.detect(filepath)
-            detections = []
-            
-            for box in results.boxes:
-                x1, y1, x2, y2 = box.xyxy[0].tolist()
-                confidence = float(box.conf[0])
-                class_id = int(box.cls[0])
-                class_name = results.names[class_id]
-                
-                detections.append({
-                    'class': class_name,
-                    'confidence': confidence,
-                    'bbox': [x1, y1, x2, y2]
-                })
-            
-            return jsonify({
-                'success': True,
-                'detections': detections
-            })
-            
+            with open_upload(file) as (source, digest):
+                results = cached_detections(source, digest, conf, tiling=tiling, budget=budget, admission=admission)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except (QueueFullError, DeadlineExceededError) as e:
+            return shed_response(e)
         except Exception as e:
             return jsonify({'error': str(e)}), 500
+        
+        return detections_response(results, 'class', success=True)
+
+@app.route('/detect/batch', methods=['POST'])
+def detect_batch():
+    archive = request.files.get('archive')
+    files = [file for file in request.files.getlist('files') if file.filename != '']
+    if archive and archive.filename:
+        if not archive.filename.lower().endswith(app.config['BULK_ARCHIVE_EXTENSIONS']):
+            return jsonify({'error': 'Archive must be a zip or tar file'}), 400
+    elif not files:
+        return jsonify({'error': 'No files or archive part'}), 400
+    
+    try:
+        conf = get_conf_threshold()
+        # Siempre 'bulk': espera a que haya sitio en la cola en vez de rechazar imágenes
+        admission = dict(get_admission(priority='bulk'), block=True)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    uploads = [(file.filename, detach_upload(file), False) for file in files]
+    if archive and archive.filename:
+        uploads.insert(0, (archive.filename, detach_upload(archive), True))
+    
+    def submit(filename, data):
+        """Queue one image; returns (cache key or None, future)."""
+        # Sin presupuesto ni teselas, pero la política de resolución sí elige el tamaño
+        key = result_key(content_digest(data), conf)
+        columns = cache.get(key) if cache else None
+        if cache:
+            metrics.CACHE_LOOKUPS.labels('miss' if columns is None else 'hit').inc()
+        if columns is not None:
+            future = Future()
+            future.set_result(Detections.from_columns(columns, detector.class_names))
+            return None, future
+        return key, batcher.submit(data, conf, return_image=False, **admission)
+    
+    def result_line(index, filename, key, future, error):
+        if error is None:
+            try:
+                results = future.result()
+                if cache and key is not None:
+                    cache.set(key, results.to_columns())
+            except Exception as e:
+                error = str(e)
+        if error is not None:
+            line = json.dumps({'index': index, 'filename': filename, 'success': False, 'error': error})
+        else:
+            line = detections_json(results, 'class', index=index, filename=filename, success=True)
+        return line + '\n', error is None
+    
+    def generate():
+        # Como mucho dos batches en vuelo: la memoria no depende del tamaño de la subida
+        max_pending = 2 * app.config['BATCH_MAX_SIZE']
+        pending = deque()
+        counts = {'images': 0, 'errors': 0}
+        
+        def flush(limit):
+            while pending and (len(pending) > limit or pending[0][4] is not None or pending[0][3].done()):
+                line, ok = result_line(*pending.popleft())
+                counts['images'] += 1
+                counts['errors'] += not ok
+                yield line
+        
+        for index, (filename, data, error) in enumerate(iter_bulk_uploads(uploads)):
+            key, future = None, None
+            if error is None:
+                try:
+                    key, future = submit(filename, data)
+                except Exception as e:
+                    error = str(e)
+            del data
+            pending.append((index, filename, key, future, error))
+            yield from flush(max_pending)
+        yield from flush(0)
+        yield json.dumps({'summary': counts}) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/detect/video', methods=['POST'])
+def detect_video():
+    file = request.files.get('video')
+    if file is None or file.filename == '':
+        return jsonify({'error': 'No video part'}), 400
+    suffix = os.path.splitext(secure_filename(file.filename))[1].lower()
+    if suffix not in app.config['VIDEO_EXTENSIONS']:
+        return jsonify({'error': 'Unsupported video format'}), 400
+    
+    try:
+        conf = get_conf_threshold()
+        stride = int(request.form.get('stride', app.config['VIDEO_STRIDE']))
+        scene_threshold = float(request.form.get('scene_threshold', app.config['VIDEO_SCENE_THRESHOLD']))
+        admission = dict(get_admission(priority='bulk'), block=True)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if stride < 1 or not 0.0 <= scene_threshold <= 1.0:
+        return jsonify({'error': 'stride must be >= 1 and scene_threshold between 0 and 1'}), 400
+    
+    # OpenCV solo lee vídeo desde un fichero: se vuelca a disco y se borra al terminar
+    fd, filepath = tempfile.mkstemp(suffix=suffix, dir=app.config['UPLOAD_FOLDER'])
+    
+    def remove_spool():
+        # Idempotente: la llaman el generador y el cierre de la respuesta
+        try:
+            os.remove(filepath)
+        except FileNotFoundError:
+            pass
+    
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in iter(lambda: file.stream.read(1024 * 1024), b''):
+                f.write(chunk)
+    except Exception:
+        remove_spool()
+        raise
+    
+    def generate():
+        try:
+            lines, pipeline = detector.detect_video(
+                filepath, conf, stride=stride, scene_threshold=scene_threshold,
+                batch_size=app.config['BATCH_MAX_SIZE'], detect_batch=partial(batched_detect, admission=admission)
+            )
+            for line in lines:
+                yield line + '\n'
+            yield json.dumps({'summary': pipeline.report}) + '\n'
+        except Exception as e:
+            yield json.dumps({'summary': None, 'error': str(e)}) + '\n'
         finally:
-            # Clean up the uploaded file
-            if os.path.exists(filepath):
-                os.remove(filepath)
+            remove_spool()
+    
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    # Un generador que nunca empieza (HEAD, cliente que se va antes) no llega a su finally
+    response.call_on_close(remove_spool)
+    return response
 
 @app.route('/predict', methods=['POST'])
 def predict():
@@ -107,41 +705,50 @@ def predict():
     file = request.files['image']
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
+    try:
+        conf = get_conf_threshold()
+        mode = get_response_mode()
+        tiling = get_tiling()
+        budget = get_latency_budget()
+        admission = get_admission()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     if file:
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
         try:
-            results = detector.detect(filepath)
-            detections = []
-            for box in results.boxes:
-                x1, y1, x2, y2 = box.xyxy[0].tolist()
-                confidence = float(box.conf[0])
-                class_id = int(box.cls[0])
-                class_name = results.names[class_id]
-                detections.append({
-                    'label': class_name,
-                    'confidence': confidence,
-                    'bbox': [x1, y1, x2, y2]
-                })
-            # Generar imagen con las detecciones
-            result_img = results.plot()
-            pil_img = Image.fromarray(result_img)
-            buffered = BytesIO()
-            pil_img.save(buffered, format="JPEG")
-            img_str = base64.b64encode(buffered.getvalue()).decode()
-            img_data_url = f"data:image/jpeg;base64,{img_str}"
-            return jsonify({
-                'success': True,
-                'image': img_data_url,
-                'detections': detections
-            })
+            with open_upload(file) as (source, digest):
+                body, mimetype, headers = predict_output(source, digest, conf, mode, tiling, budget, admission)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except (QueueFullError, DeadlineExceededError) as e:
+            return shed_response(e)
         except Exception as e:
             return jsonify({'error': str(e)}), 500
-        finally:
-            if os.path.exists(filepath):
-                os.remove(filepath)
+        return Response(body, mimetype=mimetype, headers=headers)
+
+@app.route('/renders/<token>.jpg')
+def render(token):
+    stored = render_store.get(token)
+    if stored is None:
+        return jsonify({'error': 'Render not found or expired'}), 404
+    source, metadata = stored
+    try:
+        results = Detections.from_columns(metadata['columns'], detector.class_names)
+        jpeg = annotated_jpeg(
+            results, metadata['digest'], metadata['conf'], source=source,
+            tiling=metadata.get('tiling'), budget=metadata.get('budget')
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 500
+    response = Response(jpeg, mimetype='image/jpeg')
+    response.headers['Cache-Control'] = 'private, max-age=60'
+    return response
 
 if __name__ == '__main__':
+    if runtime_config.get('torch_threads'):
+        init_worker(
+            runtime_config['torch_threads'],
+            runtime_config.get('interop_threads'),
+            runtime_config.get('opencv_threads')
+        )
     port = int(os.environ.get('PORT', 10000))
     app.run(host='0.0.0.0', port=port) 
\ No newline at end of file
@@ -0,0 +1,203 @@
+"""
+ASGI entry point: /detect and /predict served from an event loop.
+
+Uploads are received and responses sent by the event loop, so a slow client
+costs a coroutine instead of a whole worker thread. Decoding, inference and
+encoding are offloaded to a bounded thread pool, reusing the same detector,
+batcher, cache and response building as the Flask app (app/app.py), so both
+endpoints keep their contracts. Every other route is served by the Flask
+app itself, mounted as WSGI.
+
+Run with:
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker app.asgi:app
+"""
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+
+from ml_model import metrics
+from ml_model.batching import DeadlineExceededError, QueueFullError
+from ml_model.cache import content_digest
+
+from app.app import (
+    app as flask_app,
+    cached_detections,
+    detections_json,
+    get_admission,
+    get_conf_threshold,
+    get_latency_budget,
+    get_response_mode,
+    get_tiling,
+    predict_output
+)
+
+# Hilos para decodificar, inferir y codificar, y máximo de trabajos en vuelo
+# (los demás esperan en el event loop sin ocupar un hilo)
+flask_app.config['ASYNC_EXECUTOR_THREADS'] = int(os.environ.get('ASYNC_EXECUTOR_THREADS', 8))
+flask_app.config['ASYNC_MAX_PENDING'] = int(os.environ.get('ASYNC_MAX_PENDING', 64))
+
+executor = ThreadPoolExecutor(
+    max_workers=flask_app.config['ASYNC_EXECUTOR_THREADS'], thread_name_prefix='asgi-detector'
+)
+_pending = None
+
+
+def error_response(message, status, headers=None):
+    return Response(
+        json.dumps({'error': message}), status_code=status, headers=headers, media_type='application/json'
+    )
+
+
+def shed_response(error):
+    """Same as app.shed_response: 503 with Retry-After, or 504 for a passed deadline."""
+    if isinstance(error, QueueFullError):
+        return error_response(str(error), 503, {'Retry-After': str(error.retry_after)})
+    return error_response(str(error), 504)
+
+
+async def offload(function, *args):
+    """Run function in the bounded executor, waiting on the loop when it is saturated."""
+    global _pending
+    if _pending is None:
+        # Created lazily: it must belong to the worker's event loop
+        _pending = asyncio.Semaphore(flask_app.config['ASYNC_MAX_PENDING'])
+    async with _pending:
+        return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+
+async def read_upload(request, field):
+    """
+    Receive the multipart form on the event loop.
+
+    Returns:
+        Tuple of (form, upload or None, error response or None)
+    """
+    length = int(request.headers.get('content-length') or 0)
+    if length > flask_app.config['MAX_CONTENT_LENGTH']:
+        return None, None, error_response('Request entity too large', 413)
+    start = time.perf_counter()
+    form = await request.form()
+    metrics.observe_stage('upload', time.perf_counter() - start)
+    upload = form.get(field)
+    if upload is None or isinstance(upload, str):
+        await form.close()
+        return None, None, error_response(f'No {field} part', 400)
+    if not upload.filename:
+        await form.close()
+        return None, None, error_response('No selected file', 400)
+    return form, upload, None
+
+
+def read_source(upload):
+    """Encoded upload bytes and their content hash (runs in the executor)."""
+    upload.file.seek(0)
+    data = upload.file.read()
+    return data, content_digest(data)
+
+
+def detect_job(upload, conf, tiling, budget, admission):
+    source, digest = read_source(upload)
+    results = cached_detections(source, digest, conf, tiling=tiling, budget=budget, admission=admission)
+    return detections_json(results, 'class', success=True)
+
+
+def predict_job(upload, conf, mode, tiling, budget, admission):
+    source, digest = read_source(upload)
+    return predict_output(source, digest, conf, mode, tiling, budget, admission)
+
+
+async def instrumented(endpoint, handler, request):
+    """Same request metrics as the Flask hooks."""
+    if not flask_app.config['METRICS_ENABLED']:
+        return await handler(request)
+    started = time.perf_counter()
+    metrics.IN_FLIGHT.labels(endpoint).inc()
+    try:
+        response = await handler(request)
+    except Exception:
+        metrics.ERRORS.labels('unhandled').inc()
+        raise
+    finally:
+        metrics.IN_FLIGHT.labels(endpoint).dec()
+        metrics.REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - started)
+    metrics.REQUESTS.labels(endpoint, str(response.status_code)).inc()
+    if response.status_code >= 500:
+        metrics.ERRORS.labels('server').inc()
+    elif response.status_code >= 400:
+        metrics.ERRORS.labels('client').inc()
+    return response
+
+
+async def handle_detect(request):
+    form, upload, error = await read_upload(request, 'file')
+    if error is not None:
+        return error
+    try:
+        try:
+            conf = get_conf_threshold(form)
+            tiling = get_tiling(form)
+            budget = get_latency_budget(form, request.headers)
+            admission = get_admission(form, request.headers)
+        except ValueError as e:
+            return error_response(str(e), 400)
+        try:
+            body = await offload(detect_job, upload, conf, tiling, budget, admission)
+        except ValueError as e:
+            return error_response(str(e), 400)
+        except (QueueFullError, DeadlineExceededError) as e:
+            return shed_response(e)
+        except Exception as e:
+            return error_response(str(e), 500)
+        return Response(body, media_type='application/json')
+    finally:
+        await form.close()
+
+
+async def handle_predict(request):
+    form, upload, error = await read_upload(request, 'image')
+    if error is not None:
+        return error
+    try:
+        try:
+            conf = get_conf_threshold(form)
+            mode = get_response_mode(request.query_params, form, request.headers.get('accept', ''))
+            tiling = get_tiling(form)
+            budget = get_latency_budget(form, request.headers)
+            admission = get_admission(form, request.headers)
+        except ValueError as e:
+            return error_response(str(e), 400)
+        try:
+            body, mimetype, headers = await offload(predict_job, upload, conf, mode, tiling, budget, admission)
+        except ValueError as e:
+            return error_response(str(e), 400)
+        except (QueueFullError, DeadlineExceededError) as e:
+            return shed_response(e)
+        except Exception as e:
+            return error_response(str(e), 500)
+        # El mimetype ya incluye el boundary en el modo multipart
+        return Response(body, headers={**headers, 'Content-Type': mimetype})
+    finally:
+        await form.close()
+
+
+async def detect(request):
+    return await instrumented('detect', handle_detect, request)
+
+
+async def predict(request):
+    return await instrumented('predict', handle_predict, request)
+
+
+app = Starlette(routes=[
+    Route('/detect', detect, methods=['POST']),
+    Route('/predict', predict, methods=['POST']),
+    # /, /stats, /metrics, /detect/batch, /detect/video, /renders/... siguen en Flask
+    Mount('/', app=WSGIMiddleware(flask_app, workers=flask_app.config['ASYNC_EXECUTOR_THREADS'])),
+])
@@ -93,6 +93,8 @@ document.addEventListener('DOMContentLoaded', () => {
 
         fetch('/predict', {
             method: 'POST',
+            // The web UI goes ahead of bulk API clients in the detector queue
+            headers: { 'X-Priority': 'interactive' },
             body: formData
         })
         .then(response => response.json())
@@ -0,0 +1,219 @@
+"""
+Tune gunicorn workers, inference threads and batch size for this machine.
+
+Loads StarWarsDetector once (as gunicorn --preload does) and, for every
+combination of worker processes, inference threads per worker and maximum
+batch size, forks that many workers, each with its own BatchingScheduler and
+thread limits (torch intra-op and inter-op, OpenCV). A fixed number of
+concurrent clients, spread over the workers, sends encoded images for
+--duration seconds. The fastest combination whose p99 latency meets the
+target is written to runtime_config.json, which gunicorn.conf.py and
+app/app.py read at startup.
+
+Combinations with more inference threads than cores (workers x threads) are
+skipped: that oversubscription is what the tuning is meant to avoid.
+
+Usage:
+    python benchmarks/autotune.py --p99-ms 500 --output runtime_config.json
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from itertools import product
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.loadgen import load_images
+from benchmarks.standin import resolve_model
+from ml_model.runtime_config import DEFAULT_PATH
+
+
+def powers_of_two(limit):
+    """1, 2, 4, ... up to limit, plus limit itself."""
+    values = [2 ** i for i in range(int(math.log2(limit)) + 1)] if limit >= 1 else [1]
+    return sorted(set(values) | {limit})
+
+
+def parse_values(value, default):
+    return [int(part) for part in value.split(",") if part] if value else default
+
+
+def run_worker(detector, images, conf, torch_threads, interop_threads, batch_size, batch_window_ms,
+               clients, duration, warmup, ready, start, results):
+    """Body of one forked worker: a batcher fed by `clients` closed-loop client threads."""
+    from ml_model.batching import BatchingScheduler
+
+    detector.set_num_threads(torch_threads, interop_threads, torch_threads)
+    batcher = BatchingScheduler(detector, max_batch_size=batch_size, batch_window_ms=batch_window_ms)
+    for i in range(warmup):
+        batcher.detect(images[i % len(images)], conf, return_image=False)
+    ready.put(os.getpid())
+    start.wait()
+
+    latencies, lock = [], threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(offset):
+        local = []
+        i = offset
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            batcher.detect(images[i % len(images)], conf, return_image=False)
+            local.append(time.perf_counter() - started)
+            i += 1
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    batcher.close()
+    results.put(latencies)
+
+
+def measure(context, detector, images, args, workers, torch_threads, batch_size):
+    """Run one combination and return its throughput and latency percentiles."""
+    clients = math.ceil(args.concurrency / workers)
+    ready, results, start = context.Queue(), context.Queue(), context.Event()
+    processes = [
+        context.Process(target=run_worker, args=(
+            detector, images, args.conf, torch_threads, args.interop_threads, batch_size,
+            args.batch_window_ms, clients, args.duration, args.warmup, ready, start, results
+        ))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for _ in processes:
+            ready.get(timeout=args.startup_timeout)
+        start.set()
+        latencies = []
+        for _ in processes:
+            latencies.extend(results.get(timeout=args.duration + args.startup_timeout))
+    finally:
+        for process in processes:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.kill()
+    latencies = np.array(latencies) * 1000.0
+    p50, p99 = np.percentile(latencies, [50, 99])
+    return {
+        "workers": workers,
+        "torch_threads": torch_threads,
+        "batch_max_size": batch_size,
+        "clients_per_worker": clients,
+        "requests": int(latencies.size),
+        "throughput": latencies.size / args.duration,
+        "latency_ms": {"p50": float(p50), "p99": float(p99), "max": float(latencies.max())},
+    }
+
+
+def main():
+    cpu_count = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description="Find the fastest worker/thread/batch setup within a p99 target")
+    parser.add_argument("--model", default=str(ROOT / "ml_model" / "best.pt"),
+                        help="Trained model; a stand-in is used when it does not exist")
+    parser.add_argument("--no-standin", action="store_true", help="Fail instead of using the stand-in model")
+    parser.add_argument("--backend", choices=["pytorch", "onnx"], help="Inference backend")
+    parser.add_argument("--variant", help="Published model variant to tune (see ml_model/optimize.py)")
+    parser.add_argument("--workers", help="Comma-separated worker counts (default: powers of two up to the cores)")
+    parser.add_argument("--threads", help="Comma-separated inference threads per worker (default: same)")
+    parser.add_argument("--batch-sizes", default="1,4,8", help="Comma-separated maximum batch sizes")
+    parser.add_argument("--batch-window-ms", type=float, default=5.0, help="Batch window of every run")
+    parser.add_argument("--interop-threads", type=int, default=1, help="torch inter-op threads per worker")
+    parser.add_argument("--concurrency", type=int, default=max(4, 2 * cpu_count),
+                        help="Concurrent clients, spread over the workers")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds measured per combination")
+    parser.add_argument("--warmup", type=int, default=3, help="Untimed requests per worker")
+    parser.add_argument("--p99-ms", type=float, default=500.0, help="p99 latency target")
+    parser.add_argument("--images", help="Folder of images to send (default: synthetic 1280x720 scenes)")
+    parser.add_argument("--max-images", type=int, default=20, help="Images loaded from the folder")
+    parser.add_argument("--conf", type=float, default=0.25, help="Confidence threshold")
+    parser.add_argument("--allow-oversubscription", action="store_true",
+                        help="Also try combinations with more threads than cores")
+    parser.add_argument("--startup-timeout", type=float, default=120.0, help="Seconds to wait for a worker")
+    parser.add_argument("--output", default=str(ROOT / DEFAULT_PATH), help="Config file to write")
+    args = parser.parse_args()
+
+    workers_options = parse_values(args.workers, powers_of_two(cpu_count))
+    threads_options = parse_values(args.threads, powers_of_two(cpu_count))
+    batch_options = parse_values(args.batch_sizes, [1, 4, 8])
+    combinations = [
+        (workers, threads, batch)
+        for workers, threads, batch in product(workers_options, threads_options, batch_options)
+        if args.allow_oversubscription or workers * threads <= cpu_count
+    ]
+    if not combinations:
+        parser.error(f"no combination fits in {cpu_count} cores")
+
+    from ml_model.detect import StarWarsDetector
+
+    model_path, standin = resolve_model(args.model, allow_standin=not args.no_standin)
+    # Loaded once and shared by the forked workers, as with gunicorn --preload
+    detector = StarWarsDetector(model_path, backend=args.backend, variant=args.variant, warmup_runs=1)
+    detector.freeze()
+    images = load_images(args.images, args.max_images)
+    context = multiprocessing.get_context("fork")
+
+    print(f"{len(combinations)} combinations on {cpu_count} CPUs, {args.concurrency} clients, "
+          f"p99 target {args.p99_ms:g} ms")
+    print(f"{'workers':>7} {'threads':>7} {'batch':>5} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    results = []
+    for workers, threads, batch in combinations:
+        result = measure(context, detector, images, args, workers, threads, batch)
+        result["meets_target"] = result["latency_ms"]["p99"] <= args.p99_ms
+        results.append(result)
+        latency = result["latency_ms"]
+        print(f"{workers:>7} {threads:>7} {batch:>5} {result['throughput']:>8.1f} {latency['p50']:>8.1f} "
+              f"{latency['p99']:>8.1f} {'' if result['meets_target'] else 'over target'}")
+
+    passing = [result for result in results if result["meets_target"]]
+    if not passing:
+        print(f"\nNo combination met p99 <= {args.p99_ms:g} ms; {args.output} not written")
+        sys.exit(1)
+    best = max(passing, key=lambda result: result["throughput"])
+    settings = {
+        "workers": best["workers"],
+        # Enough request threads to keep every client of the load model served
+        "threads": max(best["clients_per_worker"], best["batch_max_size"]),
+        "torch_threads": best["torch_threads"],
+        "interop_threads": args.interop_threads,
+        "opencv_threads": best["torch_threads"],
+        "batch_max_size": best["batch_max_size"],
+        "batch_window_ms": args.batch_window_ms,
+    }
+    config = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "cpu_count": cpu_count,
+        "platform": platform.platform(),
+        "model_version": detector.model_version,
+        "standin_model": standin,
+        "concurrency": args.concurrency,
+        "p99_target_ms": args.p99_ms,
+        "settings": settings,
+        "measured": {"throughput": best["throughput"], "latency_ms": best["latency_ms"]},
+        "results": results,
+    }
+    Path(args.output).write_text(json.dumps(config, indent=2))
+    print(f"\nBest within target: {best['workers']} workers x {best['torch_threads']} threads, "
+          f"batch {best['batch_max_size']}: {best['throughput']:.1f} req/s, "
+          f"p99 {best['latency_ms']['p99']:.1f} ms")
+    print(f"Settings written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+"""
+Load generator and capacity report for /detect and /predict.
+
+Sends real HTTP requests to a running instance (or starts gunicorn itself
+with --start) and raises the load step by step until the p99 latency target
+or the error budget is breached. Two load models:
+
+- closed: a fixed number of clients, each sending its next request as soon
+  as the previous one is answered (the step raises the concurrency)
+- open: requests arrive as a Poisson process at a fixed rate, whether or not
+  earlier ones were answered (the step raises the rate). Latency is measured
+  from the scheduled send time, so a server that falls behind is not hidden
+  by the generator slowing down with it.
+
+The capacity report (JSON) records every step and the largest load that met
+the targets; pass a previous report with --compare to see the change.
+
+Usage:
+    python benchmarks/loadgen.py --start --workers 4 --images path/to/images \
+        --mode open --initial 5 --step 5 --p99-ms 500 --output capacity.json
+"""
+import argparse
+import http.client
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.memory_report import wait_until_ready
+from benchmarks.suite import make_scene, multipart_body
+
+ENDPOINT_FIELDS = {"/detect": "file", "/predict": "image"}
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png"}
+
+
+def load_images(folder, limit):
+    """Encoded images of a folder, or synthetic 1280x720 scenes without one."""
+    if folder:
+        paths = sorted(path for path in Path(folder).iterdir() if path.suffix.lower() in IMAGE_SUFFIXES)
+        if not paths:
+            raise ValueError(f"No images found in {folder}")
+        return [path.read_bytes() for path in paths[:limit]]
+    return [make_scene(1280, 720, 4, seed) for seed in range(limit)]
+
+
+class Client:
+    """One keep-alive HTTP connection per thread."""
+
+    def __init__(self, url, timeout):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def post(self, path, body, content_type):
+        connection = getattr(self._local, "connection", None)
+        reused = connection is not None
+        if connection is None:
+            connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            self._local.connection = connection
+        try:
+            connection.request("POST", path, body=body, headers={"Content-Type": content_type})
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        except (OSError, http.client.HTTPException) as e:
+            connection.close()
+            self._local.connection = None
+            stale = isinstance(e, (BrokenPipeError, ConnectionResetError, http.client.RemoteDisconnected))
+            if reused and stale:
+                # The server closed the idle keep-alive connection: not a failed request
+                return self.post(path, body, content_type)
+            raise
+
+
+class Step:
+    """Latencies and outcomes of one load step."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.outcomes = Counter()
+
+    def record(self, latency, outcome):
+        with self.lock:
+            self.latencies.append(latency)
+            self.outcomes[outcome] += 1
+
+    def summary(self, load, elapsed):
+        latencies = np.array(self.latencies) * 1000.0
+        total = int(latencies.size)
+        errors = total - self.outcomes.get("200", 0)
+        summary = {
+            "load": load,
+            "requests": total,
+            "throughput": self.outcomes.get("200", 0) / elapsed if elapsed else 0.0,
+            "error_rate": errors / total if total else 0.0,
+            "outcomes": dict(self.outcomes),
+        }
+        if total:
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+            summary["latency_ms"] = {
+                "p50": float(p50), "p90": float(p90), "p99": float(p99), "max": float(latencies.max())
+            }
+        return summary
+
+
+def make_request(client, payloads, rng_lock, rng):
+    """Pick a random (endpoint, body) and return a function that sends it and reports the outcome."""
+    with rng_lock:
+        path, body, content_type = payloads[int(rng.integers(len(payloads)))]
+
+    def send():
+        try:
+            return str(client.post(path, body, content_type))
+        except (OSError, http.client.HTTPException) as e:
+            return type(e).__name__
+    return send
+
+
+def run_closed(client, payloads, concurrency, duration, rng):
+    step, rng_lock = Step(), threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def user():
+        while time.perf_counter() < deadline:
+            send = make_request(client, payloads, rng_lock, rng)
+            start = time.perf_counter()
+            outcome = send()
+            step.record(time.perf_counter() - start, outcome)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=user, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return step, time.perf_counter() - started
+
+
+def run_open(client, payloads, rate, duration, rng, max_in_flight):
+    step, rng_lock = Step(), threading.Lock()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        scheduled = started
+        while True:
+            scheduled += float(rng.exponential(1.0 / rate))
+            if scheduled - started >= duration:
+                break
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            send = make_request(client, payloads, rng_lock, rng)
+
+            def job(send=send, scheduled=scheduled):
+                outcome = send()
+                # From the scheduled time: includes any wait for a free sender
+                step.record(time.perf_counter() - scheduled, outcome)
+            executor.submit(job)
+    return step, time.perf_counter() - started
+
+
+def start_gunicorn(args):
+    bind = f"127.0.0.1:{args.port}"
+    master = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--workers", str(args.workers),
+         "--threads", str(args.threads), "--bind", bind, "app.app:app"],
+        cwd=ROOT, env=dict(os.environ), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        wait_until_ready(f"http://{bind}/", master, args.workers, args.startup_timeout)
+    except Exception:
+        master.kill()
+        raise
+    return master, f"http://{bind}"
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find the largest load that meets a p99 latency target")
+    parser.add_argument("--url", default="http://127.0.0.1:5000", help="Instance to test")
+    parser.add_argument("--start", action="store_true", help="Start gunicorn locally instead of using --url")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers with --start")
+    parser.add_argument("--threads", type=int, default=8, help="gunicorn threads per worker with --start")
+    parser.add_argument("--port", type=int, default=18100, help="Port for gunicorn with --start")
+    parser.add_argument("--startup-timeout", type=float, default=180.0, help="Seconds to wait for gunicorn")
+    parser.add_argument("--images", help="Folder of images to send (default: synthetic scenes)")
+    parser.add_argument("--max-images", type=int, default=50, help="Images loaded from the folder")
+    parser.add_argument("--endpoints", default="/detect,/predict", help="Comma-separated endpoints to drive")
+    parser.add_argument("--predict-response", default="detections",
+                        help="response mode of the /predict requests")
+    parser.add_argument("--mode", choices=["closed", "open"], default="closed", help="Load model")
+    parser.add_argument("--initial", type=float, default=1, help="First concurrency (closed) or rate/s (open)")
+    parser.add_argument("--step", type=float, default=1, help="Load added after every passing step")
+    parser.add_argument("--max-steps", type=int, default=20, help="Give up after this many steps")
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds per step")
+    parser.add_argument("--p99-ms", type=float, default=500.0, help="p99 latency target")
+    parser.add_argument("--max-error-rate", type=float, default=0.01, help="Error budget per step")
+    parser.add_argument("--max-in-flight", type=int, default=256, help="Open mode: concurrent senders")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Request timeout in seconds")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the request mix and arrivals")
+    parser.add_argument("--output", help="Write the capacity report to this JSON file")
+    parser.add_argument("--compare", help="Previous capacity report to compare with")
+    args = parser.parse_args()
+
+    endpoints = [endpoint for endpoint in args.endpoints.split(",") if endpoint]
+    for endpoint in endpoints:
+        if endpoint not in ENDPOINT_FIELDS:
+            parser.error(f"unsupported endpoint {endpoint}")
+    payloads = []
+    for data in load_images(args.images, args.max_images):
+        for endpoint in endpoints:
+            body, content_type = multipart_body(ENDPOINT_FIELDS[endpoint], data)
+            path = endpoint if endpoint != "/predict" else f"/predict?response={args.predict_response}"
+            payloads.append((path, body, content_type))
+
+    master = None
+    url = args.url
+    if args.start:
+        master, url = start_gunicorn(args)
+    client = Client(url, args.timeout)
+    rng = np.random.default_rng(args.seed)
+    unit = "clients" if args.mode == "closed" else "req/s"
+
+    steps, sustainable = [], None
+    try:
+        load = args.initial
+        for _ in range(args.max_steps):
+            if args.mode == "closed":
+                step, elapsed = run_closed(client, payloads, int(load), args.duration, rng)
+            else:
+                step, elapsed = run_open(client, payloads, load, args.duration, rng, args.max_in_flight)
+            summary = step.summary(load, elapsed)
+            p99 = summary.get("latency_ms", {}).get("p99", float("inf"))
+            summary["passed"] = p99 <= args.p99_ms and summary["error_rate"] <= args.max_error_rate
+            steps.append(summary)
+            print(f"{load:>8g} {unit}: {summary['throughput']:7.1f} ok/s, p99 {p99:8.1f} ms, "
+                  f"errors {summary['error_rate']:6.1%} {'ok' if summary['passed'] else 'BREACHED'}")
+            if not summary["passed"]:
+                break
+            sustainable = summary
+            load += args.step
+    finally:
+        if master is not None:
+            master.send_signal(signal.SIGTERM)
+            try:
+                master.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                master.kill()
+
+    report = {
+        "commit": git_commit(),
+        "url": url,
+        "workers": args.workers if args.start else None,
+        "threads": args.threads if args.start else None,
+        "mode": args.mode,
+        "endpoints": endpoints,
+        "targets": {"p99_ms": args.p99_ms, "max_error_rate": args.max_error_rate},
+        "steps": steps,
+        "max_sustainable_load": sustainable["load"] if sustainable else None,
+        "max_sustainable_throughput": sustainable["throughput"] if sustainable else None,
+    }
+    if sustainable:
+        print(f"\nLargest load meeting p99 <= {args.p99_ms:g} ms: {sustainable['load']:g} {unit} "
+              f"({sustainable['throughput']:.1f} ok/s)")
+    else:
+        print(f"\nEven the first step breached p99 <= {args.p99_ms:g} ms")
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+
+    if args.compare:
+        previous = json.loads(Path(args.compare).read_text())
+        if previous.get("mode") != args.mode:
+            print(f"Warning: {args.compare} used the {previous.get('mode')} load model")
+        def describe(capacity):
+            if capacity.get("max_sustainable_load") is None:
+                return "none"
+            return f"{capacity['max_sustainable_load']:g} {unit} ({capacity['max_sustainable_throughput']:.1f} ok/s)"
+        print(f"Compared with {args.compare} (commit {previous.get('commit')}): "
+              f"{describe(previous)} -> {describe(report)}")
+
+
+if __name__ == "__main__":
+    main()
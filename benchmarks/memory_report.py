@@ -0,0 +1,117 @@
+"""
+Compare gunicorn memory use with and without the preloaded, shared model.
+
+Starts the app under gunicorn once per mode, optionally sends a few /detect
+requests so every worker has run the model, and reports RSS and PSS of the
+master and each worker (Linux only, read from /proc/<pid>/smaps_rollup).
+
+Usage:
+    python benchmarks/memory_report.py --workers 4 --image path/to/image.jpg
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def read_memory(pid):
+    """Return (rss, pss) of a process in MiB."""
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if parts[0] in ("Rss:", "Pss:"):
+                values[parts[0][:-1]] = int(parts[1]) / 1024.0
+    return values["Rss"], values["Pss"]
+
+
+def child_pids(pid):
+    children = []
+    for task in Path(f"/proc/{pid}/task").iterdir():
+        children.extend(int(child) for child in (task / "children").read_text().split())
+    return children
+
+
+def wait_until_ready(url, master, workers, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if master.poll() is not None:
+            raise RuntimeError("gunicorn exited during startup")
+        if len(child_pids(master.pid)) >= workers:
+            try:
+                with urllib.request.urlopen(url, timeout=2):
+                    return
+            except OSError:
+                pass
+        time.sleep(0.5)
+    raise TimeoutError("gunicorn did not become ready in time")
+
+
+def post_image(url, image_path):
+    boundary = "----memory-report"
+    data = Path(image_path).read_bytes()
+    body = (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"image.jpg\"\r\n"
+        f"Content-Type: image/jpeg\r\n\r\n"
+    ).encode() + data + f"\r\n--{boundary}--\r\n".encode()
+    request = urllib.request.Request(
+        url, data=body, headers={"Content-Type": f"multipart/form-data; boundary={boundary}"}
+    )
+    with urllib.request.urlopen(request, timeout=60) as response:
+        response.read()
+
+
+def measure(preload, args):
+    """Run gunicorn in one mode and return the memory of master and workers."""
+    # Without the result cache every request really runs the model
+    env = dict(os.environ, PRELOAD_MODEL="1" if preload else "0", CACHE_MAX_ENTRIES="0")
+    bind = f"127.0.0.1:{args.port}"
+    master = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+         "--workers", str(args.workers), "--bind", bind, "app.app:app"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        wait_until_ready(f"http://{bind}/", master, args.workers, args.timeout)
+        if args.image:
+            for _ in range(args.requests):
+                post_image(f"http://{bind}/detect", args.image)
+        time.sleep(1.0)
+        rows = [("master", master.pid, *read_memory(master.pid))]
+        for i, pid in enumerate(sorted(child_pids(master.pid))):
+            rows.append((f"worker {i}", pid, *read_memory(pid)))
+        return rows
+    finally:
+        master.send_signal(signal.SIGTERM)
+        try:
+            master.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            master.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report gunicorn RSS/PSS with and without model preloading")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers")
+    parser.add_argument("--port", type=int, default=18000, help="Port to bind gunicorn to")
+    parser.add_argument("--image", help="Image sent to /detect so the workers run the model")
+    parser.add_argument("--requests", type=int, default=20, help="Requests sent when --image is set")
+    parser.add_argument("--timeout", type=float, default=180.0, help="Startup timeout in seconds")
+    args = parser.parse_args()
+
+    for preload in (False, True):
+        rows = measure(preload, args)
+        print(f"\nPRELOAD_MODEL={int(preload)}")
+        print(f"{'process':<10} {'pid':>8} {'RSS MiB':>10} {'PSS MiB':>10}")
+        for name, pid, rss, pss in rows:
+            print(f"{name:<10} {pid:>8} {rss:>10.1f} {pss:>10.1f}")
+        print(f"{'total':<10} {'':>8} {sum(r[2] for r in rows):>10.1f} {sum(r[3] for r in rows):>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+Offline run of the image scraper against a local stand-in image server.
+
+Starts one HTTP server per fake host, serving synthetic images with a fixed
+latency: valid JPEGs, PNGs (converted on save), exact duplicates of other
+images under a different URL, near duplicates (the same image resized and
+recompressed), truncated JPEGs, images below the minimum size and 404s. It writes a URL list for every character and runs
+data_preparation/1_web_scraper.py on it three times:
+
+1. interrupted after --interrupt-after seconds (a crash),
+2. resumed until every character has its images,
+3. once more, which must not download anything.
+
+The report gives the images/s of each run, the requests served, and the
+peak concurrency and request rate seen per host, to check the limits.
+
+Usage:
+    python benchmarks/scraper_offline.py --hosts 4 --num-images 20 --latency-ms 100
+"""
+import argparse
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PIL import Image
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.standin import CLASS_NAMES
+from benchmarks.suite import make_scene
+
+SCRAPER = ROOT / "data_preparation" / "1_web_scraper.py"
+# Proporción de cada tipo de URL en la lista de un personaje
+KINDS = ["img"] * 6 + ["png", "dup", "near", "broken", "small", "missing"]
+
+
+class ImageServer:
+    """One fake image host: synthetic responses by URL kind, with request accounting."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.requests = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.started = []
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with server._lock:
+                    server.requests += 1
+                    server.in_flight += 1
+                    server.peak_in_flight = max(server.peak_in_flight, server.in_flight)
+                    server.started.append(time.monotonic())
+                try:
+                    time.sleep(server.latency)
+                    status, body, content_type = server.respond(self.path)
+                    self.send_response(status)
+                    self.send_header("Content-Type", content_type)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # El cliente interrumpido cerró la conexión
+                finally:
+                    with server._lock:
+                        server.in_flight -= 1
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    @staticmethod
+    def respond(path):
+        _, kind, name = path.split("/", 2)
+        seed = int(name.split(".")[0])
+        if kind == "missing":
+            return 404, b"not found", "text/plain"
+        if kind == "small":
+            return 200, make_scene(32, 32, 1, seed), "image/jpeg"
+        # Una duplicada sirve los mismos bytes que la imagen original
+        data = make_scene(320, 240, 3, seed)
+        if kind == "near":
+            image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+            ok, encoded = cv2.imencode(".jpg", cv2.resize(image, (240, 180)), [cv2.IMWRITE_JPEG_QUALITY, 70])
+            return 200, encoded.tobytes(), "image/jpeg"
+        if kind == "broken":
+            return 200, data[:len(data) // 2], "image/jpeg"
+        if kind == "png":
+            output = BytesIO()
+            Image.open(BytesIO(data)).save(output, format="PNG")
+            return 200, output.getvalue(), "image/png"
+        return 200, data, "image/jpeg"
+
+    def peak_rate(self, window=1.0):
+        """Most requests started within any `window` seconds."""
+        times = sorted(self.started)
+        peak, first = 0, 0
+        for last, started in enumerate(times):
+            while started - times[first] > window:
+                first += 1
+            peak = max(peak, last - first + 1)
+        return peak / window
+
+    def reset(self):
+        with self._lock:
+            self.requests, self.peak_in_flight, self.started = 0, 0, []
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def make_url_list(servers, characters, per_character):
+    """Candidate URLs of every character, spread over the hosts; seeds are unique per image."""
+    urls = {}
+    for c, character in enumerate(characters):
+        urls[character] = []
+        for i in range(per_character):
+            kind = KINDS[i % len(KINDS)]
+            seed = c * 100000 + i
+            if kind in ("dup", "near"):
+                seed -= i % len(KINDS)  # Mismos bytes que la primera imagen válida del ciclo
+            server = servers[(c + i) % len(servers)]
+            urls[character].append(f"http://127.0.0.1:{server.port}/{kind}/{seed}.jpg")
+    return urls
+
+
+def run_scraper(args, output_dir, urls_path, timeout=None):
+    """Run the scraper CLI; return (seconds, new images saved, interrupted)."""
+    command = [
+        sys.executable, str(SCRAPER), "--output-dir", str(output_dir), "--urls", str(urls_path), "--no-search",
+        "--num-images", str(args.num_images), "--concurrency", str(args.concurrency),
+        "--rate", str(args.rate), "--max-per-host", str(args.max_per_host),
+        "--host-interval", str(args.host_interval),
+    ]
+    before = len(list(output_dir.glob("*/*.jpg")))
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    try:
+        _, stderr = process.communicate(timeout=timeout)
+        if process.returncode:
+            raise RuntimeError(f"Scraper failed:\n{stderr}")
+        interrupted = False
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        interrupted = True
+    elapsed = time.perf_counter() - start
+    return elapsed, len(list(output_dir.glob("*/*.jpg"))) - before, interrupted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the scraper offline against stand-in image hosts")
+    parser.add_argument("--hosts", type=int, default=4, help="Fake image hosts")
+    parser.add_argument("--num-images", type=int, default=20, help="Images per character")
+    parser.add_argument("--candidates", type=int, default=40, help="Candidate URLs per character")
+    parser.add_argument("--latency-ms", type=float, default=100.0, help="Response latency of the hosts")
+    parser.add_argument("--concurrency", type=int, default=16, help="Scraper concurrent downloads")
+    parser.add_argument("--rate", type=float, default=40.0, help="Scraper global requests per second")
+    parser.add_argument("--max-per-host", type=int, default=2, help="Scraper concurrent requests per host")
+    parser.add_argument("--host-interval", type=float, default=0.05, help="Scraper seconds between host requests")
+    parser.add_argument("--interrupt-after", type=float, default=2.0, help="Seconds before killing the first run")
+    parser.add_argument("--output-dir", help="Keep the collected images here (default: a temporary folder)")
+    parser.add_argument("--output", help="Write the report to this JSON file")
+    args = parser.parse_args()
+
+    servers = [ImageServer(args.latency_ms / 1000.0) for _ in range(args.hosts)]
+    workdir = Path(tempfile.mkdtemp(prefix="scraper-offline-"))
+    output_dir = Path(args.output_dir).resolve() if args.output_dir else workdir / "dataset_raw"
+    urls_path = workdir / "urls.json"
+    urls_path.write_text(json.dumps(make_url_list(servers, CLASS_NAMES, args.candidates)))
+
+    report = {"characters": len(CLASS_NAMES), "num_images": args.num_images, "hosts": args.hosts, "runs": {}}
+    try:
+        runs = [("interrupted", args.interrupt_after), ("resumed", None), ("rerun", None)]
+        for name, timeout in runs:
+            for server in servers:
+                server.reset()
+            elapsed, saved, interrupted = run_scraper(args, output_dir, urls_path, timeout)
+            report["runs"][name] = {
+                "seconds": elapsed,
+                "images_saved": saved,
+                "images_per_second": saved / elapsed,
+                "interrupted": interrupted,
+                "requests": sum(server.requests for server in servers),
+                "peak_in_flight_per_host": max(server.peak_in_flight for server in servers),
+                "peak_requests_per_second_per_host": max(server.peak_rate() for server in servers),
+            }
+        manifest = json.loads((output_dir / "manifest.json").read_text())
+        statuses = defaultdict(int)
+        for state in manifest["characters"].values():
+            for entry in state["urls"].values():
+                statuses[entry["status"]] += 1
+        report["statuses"] = dict(statuses)
+        report["images"] = {c: len(state["images"]) for c, state in manifest["characters"].items()}
+        report["complete"] = all(count >= args.num_images for count in report["images"].values())
+    finally:
+        for server in servers:
+            server.close()
+        if not args.output_dir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'run':>12} {'seconds':>8} {'saved':>6} {'img/s':>7} {'requests':>9} {'host peak':>10} {'host req/s':>11}")
+    for name, run in report["runs"].items():
+        print(f"{name:>12} {run['seconds']:>8.1f} {run['images_saved']:>6} {run['images_per_second']:>7.1f} "
+              f"{run['requests']:>9} {run['peak_in_flight_per_host']:>10} "
+              f"{run['peak_requests_per_second_per_host']:>11.1f}")
+    print(f"\nURL statuses: {report['statuses']}")
+    print(f"Every character complete: {report['complete']}")
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    if not report["complete"] or report["runs"]["rerun"]["requests"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
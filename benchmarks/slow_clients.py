@@ -0,0 +1,221 @@
+"""
+Concurrency per GiB under slow clients: Procfile (gthread) vs ASGI worker.
+
+Starts the app under gunicorn once per serving mode and opens a growing
+number of slow clients, each trickling its /detect upload in small chunks
+(a phone on a bad network). While they upload, a fast client keeps sending
+normal requests. A step passes when every slow upload is answered and the
+fast requests meet the p99 target. For each mode the report gives the
+largest passing number of slow clients, the peak PSS of master and workers
+(Linux only, see memory_report.py) and slow clients per GiB.
+
+- wsgi: the Procfile command (gthread worker, --threads 8): a slow upload
+  holds one of the worker threads until its last byte arrives
+- asgi: app.asgi:app under uvicorn.workers.UvicornWorker: uploads are read
+  by the event loop and only decode/inference/encode take a thread
+
+Usage:
+    python benchmarks/slow_clients.py --workers 2 --clients 8,16,32,64,128
+"""
+import argparse
+import http.client
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.loadgen import Client
+from benchmarks.memory_report import child_pids, read_memory, wait_until_ready
+from benchmarks.suite import make_scene, multipart_body
+
+MODES = {
+    "wsgi": ["--threads", "8", "app.app:app"],
+    "asgi": ["-k", "uvicorn.workers.UvicornWorker", "app.asgi:app"],
+}
+
+
+def slow_post(port, path, body, content_type, chunk_size, interval, timeout):
+    """Send a POST trickling the body; return the HTTP status (0 on a failed connection)."""
+    head = (
+        f"POST {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+    ).encode()
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=timeout) as sock:
+            sock.sendall(head)
+            for offset in range(0, len(body), chunk_size):
+                sock.sendall(body[offset:offset + chunk_size])
+                time.sleep(interval)
+            response = b""
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                response += data
+    except OSError:
+        return 0
+    try:
+        return int(response.split(b" ", 2)[1])
+    except (IndexError, ValueError):
+        return 0
+
+
+class MemorySampler(threading.Thread):
+    """Peak of the summed PSS of the gunicorn master and workers."""
+
+    def __init__(self, master_pid, interval=0.25):
+        super().__init__(daemon=True)
+        self.master_pid = master_pid
+        self.interval = interval
+        self.peak_pss = 0.0
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        total = 0.0
+        for pid in [self.master_pid, *child_pids(self.master_pid)]:
+            try:
+                total += read_memory(pid)[1]
+            except (OSError, KeyError):
+                pass
+        self.peak_pss = max(self.peak_pss, total)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.sample()
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.sample()
+
+
+def run_step(args, clients, slow_body, fast_body, content_type):
+    """One step: `clients` slow uploads in parallel with a fast client."""
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        started = time.perf_counter()
+        futures = [
+            executor.submit(slow_post, args.port, "/detect", slow_body, content_type,
+                            args.chunk_size, args.chunk_interval, args.timeout)
+            for _ in range(clients)
+        ]
+        # The fast client runs while the slow uploads are in progress
+        fast_client = Client(f"http://127.0.0.1:{args.port}", args.timeout)
+        latencies, fast_errors = [], 0
+        while not all(future.done() for future in futures):
+            start = time.perf_counter()
+            try:
+                status = fast_client.post("/detect", fast_body, content_type)
+            except (OSError, http.client.HTTPException):
+                status = 0
+            latencies.append(time.perf_counter() - start)
+            fast_errors += status != 200
+            if time.perf_counter() - started > args.timeout:
+                break
+        statuses = [future.result() for future in futures]
+    slow_ok = sum(status == 200 for status in statuses)
+    p99 = float(np.percentile(np.array(latencies) * 1000.0, 99)) if latencies else float("inf")
+    return {
+        "clients": clients,
+        "slow_ok": slow_ok,
+        "fast_requests": len(latencies),
+        "fast_errors": fast_errors,
+        "fast_p99_ms": p99,
+        "seconds": time.perf_counter() - started,
+        "passed": slow_ok == clients and fast_errors == 0 and p99 <= args.p99_ms,
+    }
+
+
+def measure_mode(mode, args, slow_body, fast_body, content_type):
+    bind = f"127.0.0.1:{args.port}"
+    # Without the result cache every request really runs the model
+    env = dict(os.environ, CACHE_MAX_ENTRIES="0")
+    master = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--workers", str(args.workers),
+         "--bind", bind, "--timeout", str(int(args.timeout) + 30), *MODES[mode]],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    sampler = None
+    try:
+        wait_until_ready(f"http://{bind}/", master, args.workers, args.startup_timeout)
+        sampler = MemorySampler(master.pid)
+        sampler.start()
+        steps, sustainable = [], None
+        for clients in args.clients:
+            step = run_step(args, clients, slow_body, fast_body, content_type)
+            steps.append(step)
+            print(f"{mode:>5} {clients:>5} slow clients: {step['slow_ok']:>5} answered, fast p99 "
+                  f"{step['fast_p99_ms']:8.1f} ms ({step['fast_requests']} requests) "
+                  f"{'ok' if step['passed'] else 'BREACHED'}")
+            if not step["passed"]:
+                break
+            sustainable = clients
+        sampler.stop()
+        peak_gib = sampler.peak_pss / 1024.0
+        return {
+            "steps": steps,
+            "max_slow_clients": sustainable,
+            "peak_pss_mib": sampler.peak_pss,
+            "slow_clients_per_gib": sustainable / peak_gib if sustainable and peak_gib else 0.0,
+        }
+    finally:
+        if sampler is not None and sampler.is_alive():
+            sampler.stop()
+        master.send_signal(signal.SIGTERM)
+        try:
+            master.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            master.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare slow-client concurrency per GiB of the serving modes")
+    parser.add_argument("--modes", default="wsgi,asgi", help="Comma-separated serving modes to compare")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--port", type=int, default=18200, help="Port to bind gunicorn to")
+    parser.add_argument("--clients", default="8,16,32,64,128",
+                        help="Comma-separated numbers of slow clients, one step each")
+    parser.add_argument("--image", help="Image to upload (default: a synthetic 1280x720 scene)")
+    parser.add_argument("--chunk-size", type=int, default=16384, help="Bytes sent per chunk by a slow client")
+    parser.add_argument("--chunk-interval", type=float, default=0.5, help="Seconds between chunks")
+    parser.add_argument("--p99-ms", type=float, default=1000.0, help="p99 target of the fast requests")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Request timeout in seconds")
+    parser.add_argument("--startup-timeout", type=float, default=180.0, help="Seconds to wait for gunicorn")
+    parser.add_argument("--output", help="Write the report to this JSON file")
+    args = parser.parse_args()
+    args.clients = [int(value) for value in args.clients.split(",") if value]
+
+    modes = [mode for mode in args.modes.split(",") if mode]
+    for mode in modes:
+        if mode not in MODES:
+            parser.error(f"unknown mode {mode}")
+    data = Path(args.image).read_bytes() if args.image else make_scene(1280, 720, 4, 0)
+    slow_body, content_type = multipart_body("file", data)
+    # A different image for the fast client (same content type and boundary)
+    fast_body, _ = multipart_body("file", make_scene(640, 480, 4, 1))
+
+    report = {}
+    for mode in modes:
+        report[mode] = measure_mode(mode, args, slow_body, fast_body, content_type)
+
+    print(f"\n{'mode':>5} {'slow clients':>13} {'peak PSS MiB':>13} {'clients/GiB':>12}")
+    for mode, result in report.items():
+        print(f"{mode:>5} {result['max_slow_clients'] or 0:>13} {result['peak_pss_mib']:>13.1f} "
+              f"{result['slow_clients_per_gib']:>12.1f}")
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Tiny randomly initialized stand-in for the trained detector.
+
+Lets the benchmarks run offline when best.pt is missing: the network has the
+same architecture and class count as the real one, so inference cost is
+representative, but its detections are meaningless.
+
+Usage:
+    python benchmarks/standin.py --output benchmarks/.standin/standin.pt
+"""
+import argparse
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_STANDIN_PATH = ROOT / "benchmarks" / ".standin" / "standin.pt"
+CLASS_NAMES = [
+    "Darth Vader",
+    "Luke Skywalker",
+    "Yoda",
+    "R2-D2",
+    "C-3PO",
+    "Chewbacca",
+    "Han Solo",
+    "Leia Organa"
+]
+
+
+def build_standin_model(path=DEFAULT_STANDIN_PATH, config="yolov8n.yaml", seed=0):
+    """
+    Save a randomly initialized YOLOv8 checkpoint, unless it already exists.
+
+    Args:
+        path: Where to save the checkpoint
+        config: ultralytics model config (bundled with the package, no download)
+        seed: Seed of the random weights, so every run builds the same model
+
+    Returns:
+        Path of the checkpoint
+    """
+    path = Path(path)
+    if path.exists():
+        return path
+    import torch
+    from ultralytics.nn.tasks import DetectionModel
+
+    torch.manual_seed(seed)
+    model = DetectionModel(config, nc=len(CLASS_NAMES), verbose=False)
+    model.names = dict(enumerate(CLASS_NAMES))
+    model.eval()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    torch.save({"model": model, "train_args": {"imgsz": 640}}, tmp_path)
+    tmp_path.replace(path)
+    return path
+
+
+def resolve_model(model_path, allow_standin=True):
+    """
+    Return model_path if it exists, else the stand-in checkpoint.
+
+    Returns:
+        Tuple of (path, whether it is the stand-in)
+    """
+    if model_path and Path(model_path).exists():
+        return Path(model_path), False
+    if not allow_standin:
+        raise FileNotFoundError(f"Model not found: {model_path}")
+    print(f"{model_path} not found, using a randomly initialized stand-in model")
+    return build_standin_model(), True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the stand-in detector checkpoint")
+    parser.add_argument("--output", default=str(DEFAULT_STANDIN_PATH), help="Where to save it")
+    parser.add_argument("--config", default="yolov8n.yaml", help="ultralytics model config")
+    args = parser.parse_args()
+    print(f"Stand-in model: {build_standin_model(args.output, args.config)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+"""
+Reproducible performance benchmarks of the detector and the Flask endpoints.
+
+Synthetic JPEGs at several resolutions and object densities (seeded, so every
+run sees the same pixels) go through:
+
+- detect_characters: StarWarsDetector.detect_characters (detections + drawn image)
+- detect: StarWarsDetector.detect (Detections only)
+- route_detect: POST /detect through the Flask test client
+- route_predict: POST /predict through the Flask test client
+
+For each case the suite reports throughput, p50/p95/p99 latency, the peak of
+traced (Python and numpy) allocations and the process max RSS, and compares
+the results with a stored baseline. Runs offline on CPU; without best.pt a
+randomly initialized stand-in model is used (see benchmarks/standin.py).
+
+Usage:
+    python benchmarks/suite.py --save-baseline           # record benchmarks/baseline.json
+    python benchmarks/suite.py --tolerance 0.15          # compare, exit 1 on regressions
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.standin import resolve_model
+
+TARGETS = ("detect_characters", "detect", "route_detect", "route_predict")
+DEFAULT_BASELINE = ROOT / "benchmarks" / "baseline.json"
+
+
+def parse_resolutions(value):
+    """Parse '640x480,1280x720' into [(640, 480), (1280, 720)]."""
+    return [tuple(int(side) for side in part.split("x")) for part in value.split(",") if part]
+
+
+def make_scene(width, height, objects, seed=0, quality=90):
+    """
+    Encode a synthetic scene as JPEG bytes.
+
+    A blurred noise background with `objects` filled shapes of random color
+    and size (5-20% of the short side), so density changes both the JPEG
+    size and what the detector sees.
+    """
+    rng = np.random.default_rng(seed)
+    image = cv2.GaussianBlur(rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8), (9, 9), 0)
+    short_side = min(width, height)
+    for _ in range(objects):
+        size = int(short_side * rng.uniform(0.05, 0.2))
+        x, y = int(rng.integers(0, max(1, width - size))), int(rng.integers(0, max(1, height - size)))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        if rng.random() < 0.5:
+            cv2.rectangle(image, (x, y), (x + size, y + size * 2), color, -1)
+        else:
+            cv2.ellipse(image, (x + size // 2, y + size), (size // 2, size), 0, 0, 360, color, -1)
+    ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise RuntimeError("Could not encode synthetic image")
+    return encoded.tobytes()
+
+
+def multipart_body(field, data, boundary="----benchmark"):
+    body = (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"{field}\"; filename=\"image.jpg\"\r\n"
+        f"Content-Type: image/jpeg\r\n\r\n"
+    ).encode() + data + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+def make_runners(detector, client, conf):
+    """One callable per target; each takes the encoded image and returns the number of detections."""
+    def run_detect_characters(data):
+        detections, _ = detector.detect_characters(data, conf)
+        return len(detections)
+
+    def run_detect(data):
+        return len(detector.detect(data, conf))
+
+    def run_route(path, field):
+        def run(data):
+            body, content_type = multipart_body(field, data)
+            response = client.post(path, data=body, content_type=content_type)
+            if response.status_code != 200:
+                raise RuntimeError(f"{path} returned {response.status_code}: {response.get_data(as_text=True)}")
+            return len(response.get_json()["detections"])
+        return run
+
+    runners = {"detect_characters": run_detect_characters, "detect": run_detect}
+    if client is not None:
+        runners["route_detect"] = run_route("/detect", "file")
+        runners["route_predict"] = run_route("/predict", "image")
+    return runners
+
+
+def measure(run, images, iterations, warmup):
+    """Run one case and return its latency, throughput and memory statistics."""
+    for i in range(warmup):
+        run(images[i % len(images)])
+    latencies = np.empty(iterations)
+    detections = 0
+    tracemalloc.start()
+    started = time.perf_counter()
+    for i in range(iterations):
+        start = time.perf_counter()
+        detections += run(images[i % len(images)])
+        latencies[i] = time.perf_counter() - start
+    elapsed = time.perf_counter() - started
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    latencies *= 1000.0
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "iterations": iterations,
+        "throughput": iterations / elapsed,
+        "latency_ms": {
+            "mean": float(latencies.mean()),
+            "p50": float(p50),
+            "p95": float(p95),
+            "p99": float(p99),
+        },
+        "detections_per_image": detections / iterations,
+        "peak_traced_mib": traced_peak / 2 ** 20,
+        # ru_maxrss is in KiB on Linux: the process high-water mark so far
+        "max_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+
+
+def environment(model_path, standin, detector):
+    def version(module):
+        try:
+            return __import__(module).__version__
+        except ImportError:
+            return None
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "torch": version("torch"),
+        "onnxruntime": version("onnxruntime"),
+        "model": str(model_path),
+        "standin_model": standin,
+        "model_version": detector.model_version,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare p50 latency and throughput of every case found in both runs.
+
+    Returns:
+        List of (case, metric, baseline value, current value, relative change, regressed)
+    """
+    rows = []
+    for case, current in results["cases"].items():
+        previous = baseline.get("cases", {}).get(case)
+        if previous is None:
+            continue
+        for metric, higher_is_better in (("p50", False), ("throughput", True)):
+            old = previous["latency_ms"]["p50"] if metric == "p50" else previous["throughput"]
+            new = current["latency_ms"]["p50"] if metric == "p50" else current["throughput"]
+            change = (new - old) / old if old else 0.0
+            regressed = change < -tolerance if higher_is_better else change > tolerance
+            rows.append((case, metric, old, new, change, regressed))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the detector and the Flask endpoints")
+    parser.add_argument("--model", default=str(ROOT / "ml_model" / "best.pt"),
+                        help="Trained model; a stand-in is used when it does not exist")
+    parser.add_argument("--no-standin", action="store_true", help="Fail instead of using the stand-in model")
+    parser.add_argument("--backend", choices=["pytorch", "onnx"], help="Inference backend")
+    parser.add_argument("--targets", default=",".join(TARGETS), help="Comma-separated targets to run")
+    parser.add_argument("--resolutions", default="320x240,640x480,1280x720,1920x1080",
+                        help="Comma-separated WIDTHxHEIGHT of the synthetic images")
+    parser.add_argument("--densities", default="0,4,16", help="Comma-separated objects per synthetic image")
+    parser.add_argument("--images", type=int, default=4, help="Distinct images per case")
+    parser.add_argument("--iterations", type=int, default=30, help="Timed calls per case")
+    parser.add_argument("--warmup", type=int, default=3, help="Untimed calls per case")
+    parser.add_argument("--conf", type=float, default=0.25, help="Confidence threshold")
+    parser.add_argument("--threads", type=int, default=1, help="Inference threads (fixed for reproducibility)")
+    parser.add_argument("--baseline", default=str(DEFAULT_BASELINE), help="Baseline results to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="Write the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="Relative p50/throughput change counted as a regression")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    targets = [target for target in args.targets.split(",") if target]
+    unknown = set(targets) - set(TARGETS)
+    if unknown:
+        parser.error(f"unknown targets: {', '.join(sorted(unknown))}")
+    model_path, standin = resolve_model(args.model, allow_standin=not args.no_standin)
+
+    os.chdir(ROOT)
+    client = None
+    if any(target.startswith("route_") for target in targets):
+        # The app builds its detector at import time: configure it first. Without
+        # the result cache every request really runs the model
+        os.environ["MODEL_PATH"] = str(model_path)
+        os.environ["CACHE_MAX_ENTRIES"] = "0"
+        os.environ["WARMUP_RUNS"] = "0"
+        if args.backend:
+            os.environ["DETECTOR_BACKEND"] = args.backend
+        from app.app import app, detector
+
+        client = app.test_client()
+    else:
+        from ml_model.detect import StarWarsDetector
+
+        detector = StarWarsDetector(model_path, backend=args.backend)
+    detector.set_num_threads(args.threads)
+    runners = make_runners(detector, client, args.conf)
+
+    results = {"environment": environment(model_path, standin, detector), "cases": {}}
+    print(f"{'case':<40} {'img/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'det/img':>8} {'peak MiB':>9}")
+    for width, height in parse_resolutions(args.resolutions):
+        for density in (int(value) for value in args.densities.split(",") if value):
+            images = [make_scene(width, height, density, seed) for seed in range(args.images)]
+            for target in targets:
+                case = f"{target}/{width}x{height}/objects={density}"
+                stats = measure(runners[target], images, args.iterations, args.warmup)
+                results["cases"][case] = stats
+                latency = stats["latency_ms"]
+                print(f"{case:<40} {stats['throughput']:>8.1f} {latency['p50']:>8.1f} {latency['p95']:>8.1f} "
+                      f"{latency['p99']:>8.1f} {stats['detections_per_image']:>8.1f} "
+                      f"{stats['peak_traced_mib']:>9.1f}")
+    print(f"\nMax RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0:.1f} MiB")
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+    baseline_path = Path(args.baseline)
+    if args.save_baseline:
+        baseline_path.write_text(json.dumps(results, indent=2))
+        print(f"Baseline saved to {baseline_path}")
+        return
+    if not baseline_path.exists():
+        print(f"No baseline at {baseline_path}; run with --save-baseline to record one")
+        return
+
+    baseline = json.loads(baseline_path.read_text())
+    if baseline["environment"].get("model_version") != results["environment"]["model_version"]:
+        print("Warning: the baseline was recorded with a different model")
+    rows = compare(results, baseline, args.tolerance)
+    print(f"\nCompared with {baseline_path} (commit {baseline['environment'].get('commit')}):")
+    for case, metric, old, new, change, regressed in rows:
+        flag = "REGRESSION" if regressed else ""
+        print(f"{case:<40} {metric:>10} {old:>9.2f} -> {new:>9.2f} {change:>+7.1%} {flag}")
+    regressions = sum(row[5] for row in rows)
+    print(f"\n{regressions} regression(s) beyond {args.tolerance:.0%}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Compare the upload decode paths used by the Flask endpoints.
+
+- disk: the old path, file.save() into uploads/, cv2.imread() and os.remove()
+- memory: StarWarsDetector.load_image() straight from the upload stream
+
+Usage:
+    python benchmarks/upload_decode.py --size 1280x720 --iterations 500 --threads 4
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+
+import cv2
+import numpy as np
+from werkzeug.datastructures import FileStorage
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from ml_model.detect import StarWarsDetector
+
+
+def make_jpeg(width, height, seed=0):
+    """Encode a synthetic noisy image as JPEG bytes."""
+    rng = np.random.default_rng(seed)
+    image = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    image = cv2.GaussianBlur(image, (9, 9), 0)
+    ok, encoded = cv2.imencode(".jpg", image)
+    if not ok:
+        raise RuntimeError("Could not encode synthetic image")
+    return encoded.tobytes()
+
+
+def decode_from_disk(data, upload_dir, index):
+    file = FileStorage(stream=BytesIO(data), filename="upload.jpg")
+    filepath = os.path.join(upload_dir, f"{index}_{file.filename}")
+    file.save(filepath)
+    try:
+        image = cv2.imread(filepath)
+    finally:
+        os.remove(filepath)
+    return image
+
+
+def decode_in_memory(data, upload_dir, index):
+    file = FileStorage(stream=BytesIO(data), filename="upload.jpg")
+    return StarWarsDetector.load_image(file.stream)
+
+
+def run(path_fn, data, iterations, threads, upload_dir):
+    """Run one decode path and return (throughput, latencies in ms)."""
+    def timed(index):
+        start = time.perf_counter()
+        path_fn(data, upload_dir, index)
+        return (time.perf_counter() - start) * 1000.0
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        latencies = np.fromiter(pool.map(timed, range(iterations)), dtype=np.float64)
+    elapsed = time.perf_counter() - start
+    return iterations / elapsed, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark disk vs in-memory upload decoding")
+    parser.add_argument("--size", default="1280x720", help="Synthetic image size as WIDTHxHEIGHT")
+    parser.add_argument("--iterations", type=int, default=500, help="Uploads per path")
+    parser.add_argument("--threads", type=int, default=4, help="Concurrent uploads")
+    parser.add_argument("--upload-dir", help="Directory for the disk path (default: a temp dir)")
+    args = parser.parse_args()
+
+    width, height = map(int, args.size.lower().split("x"))
+    data = make_jpeg(width, height)
+    print(f"Image: {width}x{height}, {len(data) / 1024:.1f} KiB JPEG, "
+          f"{args.iterations} uploads, {args.threads} threads\n")
+
+    with tempfile.TemporaryDirectory(dir=args.upload_dir) as upload_dir:
+        print(f"{'path':<8} {'img/s':>10} {'p50 ms':>10} {'p99 ms':>10}")
+        for name, path_fn in (("disk", decode_from_disk), ("memory", decode_in_memory)):
+            run(path_fn, data, min(args.iterations, 20), args.threads, upload_dir)  # warmup
+            throughput, latencies = run(path_fn, data, args.iterations, args.threads, upload_dir)
+            p50, p99 = np.percentile(latencies, [50, 99])
+            print(f"{name:<8} {throughput:>10.1f} {p50:>10.2f} {p99:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
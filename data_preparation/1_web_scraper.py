@@ -1,15 +1,243 @@
-import os
-import time
+"""
+Collect Star Wars character images into dataset_raw/<Character>/.
+
+All characters are collected at the same time by a pool of asynchronous
+downloaders, under a global request rate and a per-host limit (concurrent
+requests and minimum interval). Every image is validated (decodable, big
+enough) and deduplicated as it arrives, and only then saved: exact copies by
+content hash, and re-encoded, resized or slightly cropped copies by
+perceptual hash (ml_model/near_duplicates.py), across all characters.
+
+Progress is kept in dataset_raw/manifest.json: the candidate URLs found for
+each character and what happened to each one. A rerun skips characters that
+already have enough images, resumes the pending URLs of the others and only
+searches again when those run out. Failed downloads are retried on later
+runs, up to --max-attempts.
+
+Usage:
+    python data_preparation/1_web_scraper.py --num-images 150
+    python data_preparation/1_web_scraper.py --urls urls.json --no-search   # offline, from a URL list
+"""
+import argparse
+import asyncio
+import hashlib
+import json
 import random
-import requests
+import sys
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from io import BytesIO
 from pathlib import Path
-from tqdm import tqdm
+from urllib.parse import urlsplit
+
+import httpx
 from PIL import Image
-from io import BytesIO
-from icrawler.builtin import GoogleImageCrawler, BingImageCrawler
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from ml_model.near_duplicates import DEFAULT_MAX_DISTANCE, NearDuplicateIndex, image_hash
+
+MANIFEST_NAME = "manifest.json"
+INDEX_NAME = "phash_index.npz"
+IMAGE_FORMATS = {"JPEG", "PNG", "WEBP", "GIF", "BMP"}
+
+
+class RateLimiter:
+    """Token bucket shared by all downloads: at most `rate` requests per second."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if not self.rate:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class HostLimiter:
+    """At most `max_per_host` requests in flight per host, started at least `interval` seconds apart."""
+
+    def __init__(self, max_per_host=2, interval=0.0):
+        self.interval = interval
+        self._slots = defaultdict(lambda: asyncio.Semaphore(max_per_host))
+        self._locks = defaultdict(asyncio.Lock)
+        self._last_start = defaultdict(float)
+
+    @asynccontextmanager
+    async def slot(self, url):
+        host = urlsplit(url).netloc.lower()
+        async with self._slots[host]:
+            async with self._locks[host]:
+                wait = self._last_start[host] + self.interval - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                self._last_start[host] = time.monotonic()
+            yield
+
+
+class Manifest:
+    """
+    Persistent record of the collection, saved atomically to manifest.json.
+
+    For each character: the target number of images, the search sources
+    already queried, and every candidate URL with its status (pending,
+    saved, duplicate, near_duplicate, invalid or failed) and number of
+    attempts. Saved
+    images are also indexed by content hash to drop duplicates across
+    characters and runs.
+    """
+
+    def __init__(self, path, save_interval=5.0):
+        self.path = Path(path)
+        self.save_interval = save_interval
+        self.data = {"version": 1, "characters": {}}
+        self.digests = {}
+        self._saved_at = 0.0
+        if self.path.exists():
+            self.data = json.loads(self.path.read_text())
+        for character, state in self.data["characters"].items():
+            for digest in state["images"]:
+                self.digests[digest] = character
+
+    def character(self, character):
+        return self.data["characters"].setdefault(
+            character, {"target": 0, "searched": [], "urls": {}, "images": {}}
+        )
+
+    def saved_count(self, character):
+        return len(self.character(character)["images"])
+
+    def add_candidates(self, character, source, urls):
+        """Add search results as pending URLs; return how many were new."""
+        state = self.character(character)
+        new = 0
+        for url in urls:
+            if url not in state["urls"]:
+                state["urls"][url] = {"status": "pending", "attempts": 0}
+                new += 1
+        if source not in state["searched"]:
+            state["searched"].append(source)
+        self.save()
+        return new
+
+    def pending(self, character, max_attempts):
+        """URLs never tried, plus failed ones with attempts left, in discovery order."""
+        return [
+            url for url, entry in self.character(character)["urls"].items()
+            if entry["status"] == "pending" or (entry["status"] == "failed" and entry["attempts"] < max_attempts)
+        ]
+
+    def record(self, character, url, status, **details):
+        entry = self.character(character)["urls"].setdefault(url, {"status": "pending", "attempts": 0})
+        entry.update(details, status=status, attempts=entry["attempts"] + 1)
+        self.save(force=False)
+
+    def add_image(self, character, digest, filename, url=None):
+        self.character(character)["images"][digest] = filename
+        self.digests[digest] = character
+        if url is not None:
+            self.record(character, url, "saved", digest=digest)
+
+    def reconcile(self, character, char_dir):
+        """
+        Align the manifest with the files on disk.
+
+        Images deleted by hand are forgotten (their URLs become pending
+        again) and .jpg files the manifest does not know about, such as those
+        from an earlier collection, are adopted.
+        """
+        state = self.character(character)
+        for digest, filename in list(state["images"].items()):
+            if not (char_dir / filename).exists():
+                del state["images"][digest]
+                self.digests.pop(digest, None)
+                for entry in state["urls"].values():
+                    if entry.get("digest") == digest:
+                        entry.update(status="pending", attempts=0)
+        known = set(state["images"].values())
+        for path in sorted(char_dir.glob("*.jpg")):
+            if path.name not in known:
+                digest = hashlib.sha256(path.read_bytes()).hexdigest()
+                if digest not in self.digests:
+                    self.add_image(character, digest, path.name)
+
+    def save(self, force=True):
+        """Write the manifest (at most every save_interval seconds unless forced)."""
+        if not force and time.monotonic() - self._saved_at < self.save_interval:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        tmp_path.write_text(json.dumps(self.data, indent=1))
+        tmp_path.replace(self.path)
+        self._saved_at = time.monotonic()
+
+
+class DuckDuckGoSource:
+    """Image search through duckduckgo-search."""
+
+    name = "duckduckgo"
+
+    def search(self, character, limit):
+        from duckduckgo_search import DDGS
+
+        with DDGS() as ddgs:
+            results = ddgs.images(f"{character} Star Wars character", max_results=limit)
+            return [result["image"] for result in results if result.get("image")]
+
+
+class UrlFileSource:
+    """Candidate URLs from a JSON file mapping each character to a list of URLs (offline runs)."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.name = f"file:{self.path.name}"
+        self.urls = json.loads(self.path.read_text())
+
+    def search(self, character, limit):
+        return self.urls.get(character, [])[:limit]
+
+
+def validate_image(data, min_size=64):
+    """
+    Check that data is a complete image of an accepted format and size.
+
+    Returns:
+        Tuple of (JPEG bytes to save or None, reason when rejected). JPEG
+        images are kept as downloaded; other formats are converted.
+    """
+    try:
+        with Image.open(BytesIO(data)) as image:
+            if image.format not in IMAGE_FORMATS:
+                return None, f"format {image.format}"
+            if min(image.size) < min_size:
+                return None, f"too small {image.size[0]}x{image.size[1]}"
+            image.load()  # Decodifica todo: detecta imágenes truncadas
+            if image.format == "JPEG" and image.mode in ("RGB", "L"):
+                return data, None
+            output = BytesIO()
+            image.convert("RGB").save(output, format="JPEG", quality=95)
+            return output.getvalue(), None
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+        return None, f"undecodable: {e}"
+
 
 class StarWarsImageScraper:
-    def __init__(self, output_dir="dataset_raw"):
+    def __init__(self, output_dir="dataset_raw", sources=None, concurrency=16, rate=8.0, max_per_host=2,
+                 host_interval=0.5, timeout=15.0, max_attempts=3, min_size=64, max_bytes=10 * 1024 * 1024,
+                 near_duplicate_distance=DEFAULT_MAX_DISTANCE):
         self.output_dir = Path(output_dir)
         self.characters = [
             "Darth Vader",
@@ -28,70 +256,246 @@ class StarWarsImageScraper:
             "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
             "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36 Edg/120.0.0.0"
         ]
-        
+        self.sources = [DuckDuckGoSource()] if sources is None else sources
+        self.concurrency = concurrency
+        self.rate = rate
+        self.max_per_host = max_per_host
+        self.host_interval = host_interval
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.min_size = min_size
+        self.max_bytes = max_bytes
+        self.manifest = Manifest(self.output_dir / MANIFEST_NAME)
+        # Índice de hashes perceptuales de las imágenes guardadas (None: desactivado)
+        self.near_duplicate_distance = near_duplicate_distance
+        self.index = None
+        self.stats = defaultdict(int)
+        self._outstanding = defaultdict(int)
+
     def get_random_user_agent(self):
         return random.choice(self.user_agents)
-    
+
     def create_character_directory(self, character):
         """Create directory for character images if it doesn't exist."""
         char_dir = self.output_dir / character.replace(" ", "_")
         char_dir.mkdir(parents=True, exist_ok=True)
         return char_dir
-    
-    def download_images(self, character, num_images=150):
-        """Download images for a character using multiple crawlers."""
-        print(f"\nSearching for images of {character}...")
-        char_dir = self.create_character_directory(character)
-        
-        # Try Google first
-        google_crawler = GoogleImageCrawler(
-            downloader_threads=4,
-            storage={'root_dir': str(char_dir)}
-        )
-        google_crawler.crawl(
-            keyword=f"{character} Star Wars character",
-            max_num=num_images,
-            file_idx_offset=0
-        )
-        
-        # If we don't have enough images, try Bing
-        downloaded = len(list(char_dir.glob('*.jpg')))
-        if downloaded < num_images:
-            remaining = num_images - downloaded
-            bing_crawler = BingImageCrawler(
-                downloader_threads=4,
-                storage={'root_dir': str(char_dir)}
-            )
-            bing_crawler.crawl(
-                keyword=f"{character} Star Wars character",
-                max_num=remaining,
-                file_idx_offset=downloaded
-            )
-        
-        # Count final number of images
-        downloaded = len(list(char_dir.glob('*.jpg')))
-        print(f"Downloaded {downloaded} images for {character}")
-        return downloaded
-    
-    def run(self):
+
+    async def fetch(self, client, url):
+        """Download url under the rate and host limits; raise httpx.HTTPError or ValueError."""
+        await self._rate_limiter.acquire()
+        async with self._host_limiter.slot(url):
+            headers = {"User-Agent": self.get_random_user_agent()}
+            async with client.stream("GET", url, headers=headers) as response:
+                response.raise_for_status()
+                if int(response.headers.get("content-length") or 0) > self.max_bytes:
+                    raise ValueError("too large")
+                data = bytearray()
+                async for chunk in response.aiter_bytes():
+                    data += chunk
+                    if len(data) > self.max_bytes:
+                        raise ValueError("too large")
+                return bytes(data)
+
+    async def collect(self, client, character, url, target):
+        """Download, validate, deduplicate and save one candidate image."""
+        if self.manifest.saved_count(character) >= target:
+            return  # Se queda pendiente para una ejecución con más objetivo
+        try:
+            data = await self.fetch(client, url)
+        except (httpx.HTTPError, ValueError) as e:
+            self.stats["failed"] += 1
+            self.manifest.record(character, url, "failed", error=str(e) or type(e).__name__)
+            return
+        self.stats["downloaded"] += 1
+        digest = hashlib.sha256(data).hexdigest()
+        if digest in self.manifest.digests:
+            self.stats["duplicate"] += 1
+            self.manifest.record(character, url, "duplicate", digest=digest)
+            return
+        jpeg, reason, phash = await asyncio.to_thread(self.inspect, data)
+        if jpeg is None:
+            self.stats["invalid"] += 1
+            self.manifest.record(character, url, "invalid", error=reason)
+            return
+        # Sin await entre la comprobación y la reserva: ningún otro
+        # descargador puede guardar el mismo contenido ni pasarse del objetivo
+        if digest in self.manifest.digests:
+            self.stats["duplicate"] += 1
+            self.manifest.record(character, url, "duplicate", digest=digest)
+            return
+        if self.index is not None:
+            matches = self.index.query(phash)
+            if matches:
+                match, distance = matches[0]
+                self.stats["near_duplicate"] += 1
+                self.manifest.record(character, url, "near_duplicate", duplicate_of=match, distance=distance)
+                return
+        if self.manifest.saved_count(character) >= target:
+            return
+        char_dir = self.output_dir / character.replace(" ", "_")
+        filename = f"{digest[:16]}.jpg"
+        self.manifest.add_image(character, digest, filename)
+        if self.index is not None:
+            self.index.add(digest, phash)
+        await asyncio.to_thread(self._write_atomic, char_dir / filename, jpeg)
+        self.manifest.record(character, url, "saved", digest=digest)
+        self.stats["saved"] += 1
+
+    def inspect(self, data):
+        """Validate an image and compute its perceptual hash (runs in a thread)."""
+        jpeg, reason = validate_image(data, self.min_size)
+        if jpeg is None or self.index is None:
+            return jpeg, reason, None
+        return jpeg, reason, image_hash(jpeg)
+
+    def load_index(self):
+        """
+        Load the near-duplicate index and align it with the saved images.
+
+        The index is only written at the end of a run, so after a crash it
+        can miss images the manifest has (they are hashed again) or keep
+        images that were deleted (they are dropped).
+        """
+        path = self.output_dir / INDEX_NAME
+        index = NearDuplicateIndex.load(path, self.near_duplicate_distance)
+        for digest in index.keys():
+            if digest not in self.manifest.digests:
+                index.remove(digest)
+        for character, state in self.manifest.data["characters"].items():
+            char_dir = self.output_dir / character.replace(" ", "_")
+            for digest, filename in state["images"].items():
+                if digest not in index:
+                    value = image_hash(char_dir / filename)
+                    if value is not None:
+                        index.add(digest, value)
+        return index
+
+    @staticmethod
+    def _write_atomic(path, data):
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        tmp_path.write_bytes(data)
+        tmp_path.replace(path)
+
+    async def _worker(self, client, queue):
+        while True:
+            character, url, target = await queue.get()
+            try:
+                await self.collect(client, character, url, target)
+            except Exception as e:
+                self.stats["failed"] += 1
+                self.manifest.record(character, url, "failed", error=f"{type(e).__name__}: {e}")
+            finally:
+                async with self._done:
+                    self._outstanding[character] -= 1
+                    self._done.notify_all()
+                queue.task_done()
+
+    async def _feed(self, character, target, queue):
+        """Queue the pending URLs of a character, searching for more only when they run out."""
+        self.manifest.character(character)["target"] = target
+        passes = [None] + [source for source in self.sources
+                           if source.name not in self.manifest.character(character)["searched"]]
+        for source in passes:
+            if self.manifest.saved_count(character) >= target:
+                break
+            if source is not None:
+                missing = target - self.manifest.saved_count(character)
+                try:
+                    # Se piden de más: parte serán duplicadas o no válidas
+                    urls = await asyncio.to_thread(source.search, character, missing * 3)
+                except Exception as e:
+                    print(f"Search {source.name} failed for {character}: {e}")
+                    continue
+                new = self.manifest.add_candidates(character, source.name, urls)
+                print(f"{character}: {new} new candidate URLs from {source.name}")
+            for url in self.manifest.pending(character, self.max_attempts):
+                if self.manifest.saved_count(character) >= target:
+                    break
+                self._outstanding[character] += 1
+                await queue.put((character, url, target))
+            # Espera a que terminen sus descargas antes de decidir si buscar más
+            async with self._done:
+                await self._done.wait_for(lambda: self._outstanding[character] == 0)
+        return self.manifest.saved_count(character)
+
+    async def collect_all(self, num_images):
+        self._rate_limiter = RateLimiter(self.rate)
+        self._host_limiter = HostLimiter(self.max_per_host, self.host_interval)
+        self._done = asyncio.Condition()
+        for character in self.characters:
+            self.manifest.reconcile(character, self.create_character_directory(character))
+        if self.near_duplicate_distance is not None:
+            self.index = self.load_index()
+        queue = asyncio.Queue(maxsize=2 * self.concurrency)
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        async with httpx.AsyncClient(timeout=self.timeout, limits=limits, follow_redirects=True) as client:
+            workers = [asyncio.create_task(self._worker(client, queue)) for _ in range(self.concurrency)]
+            try:
+                counts = await asyncio.gather(*(self._feed(c, num_images, queue) for c in self.characters))
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+                self.manifest.save()
+                if self.index is not None:
+                    self.index.save(self.output_dir / INDEX_NAME)
+        return dict(zip(self.characters, counts))
+
+    def run(self, num_images=150):
         """Run the scraper for all characters."""
         print("Starting Star Wars character image collection...")
         self.output_dir.mkdir(parents=True, exist_ok=True)
-        
-        total_downloaded = 0
-        for character in self.characters:
-            downloaded = self.download_images(character)
-            total_downloaded += downloaded
-            
-            # Add a delay between characters
-            if character != self.characters[-1]:  # Don't wait after the last character
-                wait_time = random.uniform(5, 10)
-                print(f"\nWaiting {wait_time:.1f} seconds before next character...")
-                time.sleep(wait_time)
-        
-        print(f"\nDownload complete! Total images downloaded: {total_downloaded}")
+        start = time.perf_counter()
+        counts = asyncio.run(self.collect_all(num_images))
+        elapsed = time.perf_counter() - start
+
+        for character, count in counts.items():
+            note = "" if count >= num_images else f" (short of {num_images}: no more candidates)"
+            print(f"{character}: {count} images{note}")
+        print(f"\nDownload complete! Total images: {sum(counts.values())} "
+              f"({self.stats['saved']} new in {elapsed:.1f}s, {self.stats['saved'] / max(elapsed, 1e-9):.1f} images/s)")
+        print(f"Rejected: {self.stats['duplicate']} duplicates, {self.stats['near_duplicate']} near duplicates, "
+              f"{self.stats['invalid']} invalid, "
+              f"{self.stats['failed']} failed downloads")
         print(f"Images saved in: {self.output_dir.absolute()}")
+        return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Collect Star Wars character images")
+    parser.add_argument("--output-dir", default="dataset_raw", help="Where to save the images and manifest")
+    parser.add_argument("--num-images", type=int, default=150, help="Images per character")
+    parser.add_argument("--characters", help="Comma-separated subset of characters")
+    parser.add_argument("--urls", help="JSON file mapping characters to candidate URLs")
+    parser.add_argument("--no-search", action="store_true", help="Do not use the image search")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent downloads")
+    parser.add_argument("--rate", type=float, default=8.0, help="Requests per second over all hosts (0: no limit)")
+    parser.add_argument("--max-per-host", type=int, default=2, help="Concurrent requests per host")
+    parser.add_argument("--host-interval", type=float, default=0.5, help="Seconds between requests to a host")
+    parser.add_argument("--timeout", type=float, default=15.0, help="Timeout of a download in seconds")
+    parser.add_argument("--max-attempts", type=int, default=3, help="Attempts per URL over all runs")
+    parser.add_argument("--min-size", type=int, default=64, help="Minimum width and height of an image")
+    parser.add_argument("--near-duplicate-distance", type=int, default=DEFAULT_MAX_DISTANCE,
+                        help="Perceptual hash distance (bits out of 64) below which an image is a near duplicate")
+    parser.add_argument("--keep-near-duplicates", action="store_true", help="Only drop exact duplicates")
+    args = parser.parse_args()
+
+    sources = [] if args.no_search else [DuckDuckGoSource()]
+    if args.urls:
+        sources.insert(0, UrlFileSource(args.urls))
+    if not sources:
+        parser.error("--no-search needs --urls")
+    scraper = StarWarsImageScraper(
+        args.output_dir, sources=sources, concurrency=args.concurrency, rate=args.rate,
+        max_per_host=args.max_per_host, host_interval=args.host_interval, timeout=args.timeout,
+        max_attempts=args.max_attempts, min_size=args.min_size,
+        near_duplicate_distance=None if args.keep_near_duplicates else args.near_duplicate_distance
+    )
+    if args.characters:
+        scraper.characters = [c.strip() for c in args.characters.split(",") if c.strip()]
+    scraper.run(args.num_images)
+
 
 if __name__ == "__main__":
-    scraper = StarWarsImageScraper()
-    scraper.run() 
\ No newline at end of file
+    main()
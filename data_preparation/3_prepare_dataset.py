@@ -1,19 +1,130 @@
+"""
+Build the YOLO dataset (dataset/train, dataset/val) from dataset_raw.
+
+The split is decided by the content hash of each image, so it does not
+depend on file order or on which other images exist: adding images never
+moves the old ones between train and val. Near duplicates (found with the
+perceptual hash index of ml_model/near_duplicates.py) join the group of the
+first matching image and land on its side, so they cannot leak across the
+split; with --near-duplicates drop they are left out instead. Images are
+placed with hardlinks or reflinks where the filesystem allows and copied in
+parallel otherwise.
+
+dataset/prepare_manifest.json records, for every raw image, its size,
+mtime, content hash, split and destination. A rerun only hashes raw files
+whose size or mtime changed, places added and changed images, moves images
+whose split changed (with their labels) and deletes the ones whose raw
+file was removed. Labels of unchanged images, such as those written by
+4_auto_annotate.py or by hand, are left alone.
+
+Images in train/ and val/ that the manifest does not know about (e.g. a
+dataset made by an earlier version of this script, with a random split) are
+adopted when their content matches a raw image: they move to the split of
+that image, with their labels. Any other unmanaged image or label would
+sit next to the new copies, so the script stops unless --remove-unmanaged
+is given, which deletes them.
+
+Usage:
+    python data_preparation/3_prepare_dataset.py --val-split 0.2 --link auto
+"""
+import argparse
+import hashlib
+import json
 import os
 import shutil
-import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+
 import yaml
 from tqdm import tqdm
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from ml_model.near_duplicates import DEFAULT_MAX_DISTANCE, NearDuplicateIndex, image_hash
+
+MANIFEST_NAME = "prepare_manifest.json"
+LINK_MODES = ("auto", "hardlink", "reflink", "copy")
+NEAR_DUPLICATE_MODES = ("group", "drop", "off")
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """SHA-256 of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_split(key, val_split):
+    """'val' for a stable val_split fraction of keys (hex content hashes), else 'train'."""
+    return "val" if int(key[:8], 16) / 0x100000000 < val_split else "train"
+
+
+def reflink(source, target):
+    """Copy-on-write clone (FICLONE: btrfs, XFS, ...); raise OSError where unsupported."""
+    import fcntl
+
+    ficlone = 0x40049409
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), ficlone, src.fileno())
+        except OSError:
+            dst.close()
+            os.unlink(target)
+            raise
+
+
+def place_file(source, target, mode="auto"):
+    """
+    Put source at target without copying the data when possible.
+
+    Args:
+        source: Raw image
+        target: Destination in the dataset (replaced if it exists)
+        mode: 'hardlink', 'reflink', 'copy', or 'auto' to try them in that order
+
+    Returns:
+        The method that worked
+    """
+    tmp_path = target.with_name(f".{target.name}.tmp")
+    if tmp_path.exists():
+        tmp_path.unlink()
+    methods = ("hardlink", "reflink", "copy") if mode == "auto" else (mode,)
+    for method in methods:
+        try:
+            if method == "hardlink":
+                os.link(source, tmp_path)
+            elif method == "reflink":
+                reflink(source, tmp_path)
+            else:
+                shutil.copy2(source, tmp_path)
+        except (OSError, ImportError):
+            if method == methods[-1]:
+                raise
+            continue
+        tmp_path.replace(target)
+        return method
+
+
 class DatasetPreparator:
-    def __init__(self, raw_dir="dataset_raw", output_dir="dataset"):
+    def __init__(self, raw_dir="dataset_raw", output_dir="dataset", val_split=0.2, link_mode="auto", workers=None,
+                 near_duplicates="group", max_distance=DEFAULT_MAX_DISTANCE, remove_unmanaged=False):
         self.raw_dir = Path(raw_dir)
         self.output_dir = Path(output_dir)
         self.train_dir = self.output_dir / "train"
         self.val_dir = self.output_dir / "val"
         self.images_dir = self.output_dir / "images"
         self.labels_dir = self.output_dir / "labels"
-        
+        self.val_split = val_split
+        self.link_mode = link_mode
+        self.workers = workers or min(32, (os.cpu_count() or 1) * 4)
+        self.near_duplicates = near_duplicates
+        self.max_distance = max_distance
+        self.remove_unmanaged = remove_unmanaged
+        self.manifest_path = self.output_dir / MANIFEST_NAME
+
         # Create directories
         self.train_dir.mkdir(parents=True, exist_ok=True)
         self.val_dir.mkdir(parents=True, exist_ok=True)
@@ -21,7 +132,7 @@ class DatasetPreparator:
         (self.train_dir / "labels").mkdir(parents=True, exist_ok=True)
         (self.val_dir / "images").mkdir(parents=True, exist_ok=True)
         (self.val_dir / "labels").mkdir(parents=True, exist_ok=True)
-        
+
         # Character classes
         self.classes = [
             "Darth Vader",
@@ -33,51 +144,275 @@ class DatasetPreparator:
             "Han Solo",
             "Leia Organa"
         ]
-        
+
         # Create class mapping
         self.class_to_id = {name: idx for idx, name in enumerate(self.classes)}
-        
-    def split_dataset(self, val_split=0.2):
-        """Split dataset into training and validation sets."""
-        print("Splitting dataset into training and validation sets...")
-        
+
+    def load_manifest(self):
+        if self.manifest_path.exists():
+            return json.loads(self.manifest_path.read_text())
+        return {"version": 1, "files": {}}
+
+    def save_manifest(self, manifest):
+        tmp_path = self.manifest_path.with_name(f".{self.manifest_path.name}.tmp")
+        tmp_path.write_text(json.dumps(manifest, indent=1))
+        tmp_path.replace(self.manifest_path)
+
+    def scan_raw(self, previous):
+        """
+        Describe every raw image, hashing only files whose size or mtime changed.
+
+        Both hashes are kept: the content hash (SHA-256) and the perceptual
+        hash used to find near duplicates.
+
+        Returns:
+            Dict of raw path (relative to raw_dir) to its manifest entry
+        """
+        found = []
         for character in self.classes:
             char_dir = self.raw_dir / character.replace(" ", "_")
             if not char_dir.exists():
                 print(f"Warning: No images found for {character}")
                 continue
-                
-            # Get all images for this character
-            images = list(char_dir.glob("*.jpg"))
-            random.shuffle(images)
-            
-            # Calculate split
-            val_size = int(len(images) * val_split)
-            train_images = images[val_size:]
-            val_images = images[:val_size]
-            
-            # Copy images and create labels
-            self._process_images(train_images, character, is_train=True)
-            self._process_images(val_images, character, is_train=False)
-            
-    def _process_images(self, images, character, is_train=True):
-        """Process images and create YOLO format labels."""
-        target_dir = self.train_dir if is_train else self.val_dir
-        class_id = self.class_to_id[character]
-        
-        for img_path in tqdm(images, desc=f"Processing {character} {'training' if is_train else 'validation'} images"):
-            # Copy image
-            shutil.copy2(img_path, target_dir / "images" / img_path.name)
-            
-            # Create YOLO format label
-            # For now, we'll create a simple bounding box that covers the whole image
-            # In a real scenario, you would need to annotate the actual bounding boxes
-            label_path = target_dir / "labels" / f"{img_path.stem}.txt"
-            with open(label_path, "w") as f:
-                # Format: class_id x_center y_center width height
-                # All values normalized to [0,1]
-                f.write(f"{class_id} 0.5 0.5 1.0 1.0\n")
-    
+            for img_path in sorted(char_dir.glob("*.jpg")):
+                found.append((character, img_path))
+
+        def describe(item):
+            character, img_path = item
+            key = img_path.relative_to(self.raw_dir).as_posix()
+            stat = img_path.stat()
+            old = previous.get(key)
+            if old and old["size"] == stat.st_size and old["mtime_ns"] == stat.st_mtime_ns and "phash" in old:
+                digest, phash = old["digest"], old["phash"]
+            else:
+                digest = file_digest(img_path)
+                value = image_hash(img_path)
+                phash = None if value is None else f"{value:016x}"
+            return key, {
+                "source": key,
+                "character": character,
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "digest": digest,
+                "phash": phash,
+                # El nombre incluye el personaje: los nombres de dataset_raw se repiten entre carpetas
+                "name": f"{img_path.parent.name}_{img_path.name}",
+            }
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return dict(tqdm(executor.map(describe, found), total=len(found), desc="Scanning raw images"))
+
+    def assign_splits(self, current, previous, regroup=False):
+        """
+        Decide the split of every image from the content hash of its group.
+
+        Images already in the manifest keep their group. A new or changed
+        image joins the group of the first earlier image within
+        max_distance of its perceptual hash (or is marked duplicate_of it
+        when near_duplicates is 'drop'); otherwise it starts its own group.
+        New images are taken in path order, so the result is reproducible.
+
+        Args:
+            current: Entries from scan_raw, updated in place
+            previous: Entries of the last run
+            regroup: Ignore the previous groups (near-duplicate settings changed)
+
+        Returns:
+            Number of images grouped with an earlier one, and number dropped
+        """
+        index = NearDuplicateIndex(self.max_distance)
+        fresh = []
+        for key, entry in current.items():
+            old = previous.get(key)
+            duplicate_of = old.get("duplicate_of") if old else None
+            if (not regroup and old and old["digest"] == entry["digest"] and "group" in old
+                    and (duplicate_of is None or duplicate_of in current)):
+                entry["group"] = old["group"]
+                if duplicate_of is not None:
+                    entry["duplicate_of"] = duplicate_of
+                elif entry["phash"] is not None:
+                    index.add(key, int(entry["phash"], 16))
+            else:
+                fresh.append(key)
+
+        for key in sorted(fresh):
+            entry = current[key]
+            entry["group"] = entry["digest"]
+            if self.near_duplicates == "off" or entry["phash"] is None:
+                continue
+            value = int(entry["phash"], 16)
+            matches = index.query(value)
+            if matches:
+                match = matches[0][0]
+                entry["group"] = current[match]["group"]
+                if self.near_duplicates == "drop":
+                    entry["duplicate_of"] = match
+                    continue
+            index.add(key, value)
+
+        for entry in current.values():
+            entry["split"] = hash_split(entry["group"], self.val_split)
+        grouped = sum(entry["group"] != entry["digest"] and "duplicate_of" not in entry for entry in current.values())
+        dropped = sum("duplicate_of" in entry for entry in current.values())
+        return grouped, dropped
+
+    def split_dataset(self):
+        """Split dataset into training and validation sets, touching only what changed."""
+        print("Splitting dataset into training and validation sets...")
+        manifest = self.load_manifest()
+        previous = manifest["files"]
+        current = self.scan_raw(previous)
+        settings = {"mode": self.near_duplicates, "max_distance": self.max_distance}
+        grouped, dropped = self.assign_splits(current, previous, regroup=manifest.get("near_duplicates") != settings)
+        adopted, unmanaged = self.adopt_unmanaged(current, previous)
+
+        added, changed, moved, removed, unchanged = [], [], [], [], 0
+        for key, entry in current.items():
+            old = previous.get(key)
+            if old is not None and "duplicate_of" in old:
+                old = None  # Descartada en la ejecución anterior: nunca se colocó
+            if "duplicate_of" in entry:
+                if old is not None:
+                    removed.append(old)
+                continue
+            image_path = self._image_path(entry)
+            if old is None and key in adopted:
+                unchanged += 1
+            elif old is None:
+                added.append(entry)
+            elif old["digest"] != entry["digest"]:
+                changed.append((old, entry))
+            elif old["split"] != entry["split"] or old["name"] != entry["name"]:
+                moved.append((old, entry))
+            elif not image_path.exists():
+                # Borrada a mano del dataset: se vuelve a colocar
+                added.append(entry)
+            else:
+                unchanged += 1
+        removed += [old for key, old in previous.items() if key not in current and "duplicate_of" not in old]
+
+        for old in removed + [old for old, _ in changed]:
+            self._remove(old)
+        for old, entry in moved:
+            self._move(old, entry)
+        placed = self._place_all(added + [entry for _, entry in changed])
+
+        manifest["files"] = current
+        manifest["val_split"] = self.val_split
+        manifest["near_duplicates"] = settings
+        self.save_manifest(manifest)
+
+        methods = {method: placed.count(method) for method in set(placed)}
+        print(f"Added {len(added)}, changed {len(changed)}, moved {len(moved)}, removed {len(removed)}, "
+              f"unchanged {unchanged}")
+        if adopted or unmanaged:
+            print(f"Unmanaged files: adopted {len(adopted)} images already in the dataset (with their labels), "
+                  f"removed {unmanaged} files")
+        if self.near_duplicates != "off":
+            print(f"Near duplicates: {grouped} kept on the side of an earlier image, {dropped} dropped")
+        if methods:
+            print("Placed by " + ", ".join(f"{method}: {count}" for method, count in sorted(methods.items())))
+
+    def adopt_unmanaged(self, current, previous):
+        """
+        Deal with images and labels in train/ and val/ that no manifest entry placed.
+
+        An unmanaged image with the content of a raw image that is not placed
+        yet is moved, with its label, to where that image belongs. The rest
+        are deleted with remove_unmanaged; otherwise nothing is touched and
+        ValueError is raised, since they would duplicate or leak across the
+        split.
+
+        Returns:
+            Keys of the adopted images, and number of files removed
+        """
+        entries = [entry for entry in list(previous.values()) + list(current.values()) if "duplicate_of" not in entry]
+        managed = {self._image_path(entry) for entry in entries} | {self._label_path(entry) for entry in entries}
+        images, labels = [], []
+        for split_dir in (self.train_dir, self.val_dir):
+            images += [path for path in sorted((split_dir / "images").iterdir())
+                       if path.is_file() and not path.name.startswith(".") and path not in managed]
+            labels += [path for path in sorted((split_dir / "labels").glob("*.txt")) if path not in managed]
+        if not images and not labels:
+            return set(), 0
+
+        # Contenido -> imagen aún sin colocar
+        pending = {entry["digest"]: key for key, entry in sorted(current.items(), reverse=True)
+                   if "duplicate_of" not in entry and key not in previous
+                   and not self._image_path(entry).exists()}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            digests = list(executor.map(file_digest, images))
+        adoptions, leftover = [], []
+        for path, digest in zip(images, digests):
+            key = pending.pop(digest, None)
+            if key is None:
+                leftover.append(path)
+            else:
+                adoptions.append((key, path, path.parent.parent / "labels" / f"{path.stem}.txt"))
+        adopted_labels = {label for _, _, label in adoptions}
+        leftover += [label for label in labels if label not in adopted_labels]
+        if leftover and not self.remove_unmanaged:
+            raise ValueError(
+                f"{len(leftover)} images or labels in {self.train_dir} and {self.val_dir} were not placed by this "
+                f"script and match no raw image (e.g. {leftover[0]}). They would end up next to the new copies; "
+                f"move them away or run again with --remove-unmanaged to delete them"
+            )
+
+        for key, image_path, label_path in adoptions:
+            entry = current[key]
+            image_path.replace(self._image_path(entry))
+            if label_path.exists():
+                label_path.replace(self._label_path(entry))
+            else:
+                self._write_placeholder_label(entry)
+        for path in leftover:
+            path.unlink()
+        return {key for key, _, _ in adoptions}, len(leftover)
+
+    def _image_path(self, entry):
+        return (self.val_dir if entry["split"] == "val" else self.train_dir) / "images" / entry["name"]
+
+    def _label_path(self, entry):
+        target_dir = self.val_dir if entry["split"] == "val" else self.train_dir
+        return target_dir / "labels" / f"{Path(entry['name']).stem}.txt"
+
+    def _remove(self, entry):
+        for path in (self._image_path(entry), self._label_path(entry)):
+            if path.exists():
+                path.unlink()
+
+    def _move(self, old, entry):
+        """Move an image whose split changed, keeping its label (possibly already annotated)."""
+        for source, target in ((self._image_path(old), self._image_path(entry)),
+                               (self._label_path(old), self._label_path(entry))):
+            if source.exists():
+                source.replace(target)
+        if not self._image_path(entry).exists():
+            self._process_image(entry)
+
+    def _place_all(self, entries):
+        """Place images and create their labels in parallel; return the placement methods used."""
+        if not entries:
+            return []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(tqdm(executor.map(self._process_image, entries), total=len(entries),
+                             desc="Placing images"))
+
+    def _process_image(self, entry):
+        """Place one image and create its YOLO format label."""
+        method = place_file(self.raw_dir / entry["source"], self._image_path(entry), self.link_mode)
+        self._write_placeholder_label(entry)
+        return method
+
+    def _write_placeholder_label(self, entry):
+        # Create YOLO format label
+        # For now, we'll create a simple bounding box that covers the whole image
+        # In a real scenario, you would need to annotate the actual bounding boxes
+        with open(self._label_path(entry), "w") as f:
+            # Format: class_id x_center y_center width height
+            # All values normalized to [0,1]
+            f.write(f"{self.class_to_id[entry['character']]} 0.5 0.5 1.0 1.0\n")
+
     def create_dataset_yaml(self):
         """Create dataset.yaml file for YOLO training."""
         yaml_data = {
@@ -86,10 +421,10 @@ class DatasetPreparator:
             'val': str(self.val_dir / "images"),
             'names': self.classes
         }
-        
+
         with open(self.output_dir / "dataset.yaml", "w") as f:
             yaml.dump(yaml_data, f, default_flow_style=False)
-    
+
     def run(self):
         """Run the dataset preparation process."""
         print("Starting dataset preparation...")
@@ -102,6 +437,32 @@ class DatasetPreparator:
         print(f"Validation images: {len(list((self.val_dir / 'images').glob('*.jpg')))}")
         print(f"Classes: {', '.join(self.classes)}")
 
+
+def main():
+    parser = argparse.ArgumentParser(description="Prepare the YOLO dataset from dataset_raw")
+    parser.add_argument("--raw-dir", default="dataset_raw", help="Images collected by 1_web_scraper.py")
+    parser.add_argument("--output-dir", default="dataset", help="Dataset to create or update")
+    parser.add_argument("--val-split", type=float, default=0.2, help="Fraction of images for validation")
+    parser.add_argument("--link", choices=LINK_MODES, default="auto",
+                        help="How to place images: auto tries hardlink, then reflink, then copy")
+    parser.add_argument("--workers", type=int, help="Threads for hashing and placing files")
+    parser.add_argument("--near-duplicates", choices=NEAR_DUPLICATE_MODES, default="group",
+                        help="group: same split as the earlier image; drop: leave them out; off: ignore")
+    parser.add_argument("--max-distance", type=int, default=DEFAULT_MAX_DISTANCE,
+                        help="Perceptual hash distance (bits out of 64) of a near duplicate")
+    parser.add_argument("--remove-unmanaged", action="store_true",
+                        help="Delete images and labels in train/ and val/ that match no raw image")
+    args = parser.parse_args()
+
+    preparator = DatasetPreparator(
+        args.raw_dir, args.output_dir, args.val_split, args.link, args.workers,
+        args.near_duplicates, args.max_distance, args.remove_unmanaged
+    )
+    try:
+        preparator.run()
+    except ValueError as e:
+        sys.exit(f"Error: {e}")
+
+
 if __name__ == "__main__":
-    preparator = DatasetPreparator()
-    preparator.run() 
\ No newline at end of file
+    main()
@@ -1,20 +1,140 @@
+"""
+Automatically annotate dataset/train and dataset/val with bounding boxes.
+
+Two labelers:
+
+- hog: OpenCV's HOG person detector, spread over a process pool (one
+  detector and one OpenCV thread per process)
+- model: pseudo-labels from a trained StarWarsDetector, with batched
+  inference while a thread pool decodes the next batch and writes labels
+
+Images whose label file is newer than the image are skipped, so an
+interrupted run resumes where it stopped and reruns only label new or
+changed images (--force relabels everything). The whole-image placeholder
+labels written by 3_prepare_dataset.py do not count as annotations. Labels
+are written atomically, so an interruption never leaves a truncated file.
+
+With --shards, images are read from the pre-decoded shards built by
+`python -m ml_model.shards build dataset` instead of decoding the JPEGs;
+images missing from the shards or changed since they were built are decoded
+as before.
+
+Usage:
+    python data_preparation/4_auto_annotate.py --labeler hog --workers 8
+    python data_preparation/4_auto_annotate.py --labeler model --model ml_model/best.pt --batch-size 16
+    python data_preparation/4_auto_annotate.py --labeler hog --shards dataset/.shards
+"""
+import argparse
 import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 from pathlib import Path
+
 import cv2
 import numpy as np
 from tqdm import tqdm
 import shutil
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from ml_model.shards import ShardReader, load_image
+
+LABELERS = ("hog", "model")
+MAX_DIMENSION = 1000
+# Etiqueta provisional de 3_prepare_dataset.py: una caja que cubre toda la imagen
+PLACEHOLDER_BOX = ["0.5", "0.5", "1.0", "1.0"]
+
+_hog = None
+_shards = None
+
+
+def label_is_current(img_path, label_path):
+    """Whether label_path is a real annotation newer than img_path."""
+    try:
+        if label_path.stat().st_mtime_ns < img_path.stat().st_mtime_ns:
+            return False
+        text = label_path.read_text()
+    except FileNotFoundError:
+        return False
+    lines = text.splitlines()
+    return not (len(lines) == 1 and lines[0].split()[1:] == PLACEHOLDER_BOX)
+
+
+def write_label(label_path, lines):
+    """Write a label file atomically (temporary file + rename)."""
+    tmp_path = label_path.with_name(f".{label_path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text("".join(f"{line}\n" for line in lines))
+    tmp_path.replace(label_path)
+
+
+def yolo_lines(boxes_xyxy, class_ids, width, height):
+    """YOLO label lines (class x_center y_center width height, normalized) for pixel boxes."""
+    boxes = np.asarray(boxes_xyxy, dtype=np.float64).reshape(-1, 4)
+    x_center = (boxes[:, 0] + boxes[:, 2]) / 2 / width
+    y_center = (boxes[:, 1] + boxes[:, 3]) / 2 / height
+    box_width = (boxes[:, 2] - boxes[:, 0]) / width
+    box_height = (boxes[:, 3] - boxes[:, 1]) / height
+    return [
+        f"{class_id} {x:.6f} {y:.6f} {w:.6f} {h:.6f}"
+        for class_id, x, y, w, h in zip(class_ids, x_center, y_center, box_width, box_height)
+    ]
+
+
+def _init_hog_worker(shards_dir=None):
+    """Process pool initializer: the processes already run in parallel, one OpenCV thread each."""
+    global _shards
+    cv2.setNumThreads(1)
+    # Cada proceso mapea los mismos ficheros: las páginas se comparten en la caché
+    _shards = ShardReader(shards_dir) if shards_dir else None
+
+
+def hog_annotate(task):
+    """Annotate one image with the HOG person detector (runs in a pool process)."""
+    global _hog
+    img_path, label_path, class_id, conf_threshold = task
+    if _hog is None:
+        # Uno por proceso; creado aquí y no en el initializer para que un
+        # fallo llegue al proceso principal en lugar de reiniciar el pool
+        _hog = cv2.HOGDescriptor()
+        _hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+    img = load_image(img_path, _shards)
+    if img is None:
+        return img_path, False
+
+    # Resize image if too large
+    height, width = img.shape[:2]
+    if max(height, width) > MAX_DIMENSION:
+        scale = MAX_DIMENSION / max(height, width)
+        img = cv2.resize(img, None, fx=scale, fy=scale)
+
+    # Detect people
+    boxes, weights = _hog.detectMultiScale(
+        img,
+        winStride=(8, 8),
+        padding=(4, 4),
+        scale=1.05,
+        hitThreshold=0
+    )
+    keep = np.asarray(weights).reshape(-1) >= conf_threshold
+    boxes = np.asarray(boxes).reshape(-1, 4)[keep]
+    # De (x, y, w, h) a esquinas
+    boxes[:, 2:] += boxes[:, :2]
+    img_height, img_width = img.shape[:2]
+    write_label(label_path, yolo_lines(boxes, [class_id] * len(boxes), img_width, img_height))
+    return img_path, True
+
+
 class AutoAnnotator:
-    def __init__(self, dataset_dir="dataset"):
+    def __init__(self, dataset_dir="dataset", workers=None, force=False, shards_dir=None):
         self.dataset_dir = Path(dataset_dir)
         self.train_dir = self.dataset_dir / "train"
         self.val_dir = self.dataset_dir / "val"
-        
-        # Initialize HOG person detector
-        self.hog = cv2.HOGDescriptor()
-        self.hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
-        
+        self.workers = workers or os.cpu_count() or 1
+        self.force = force
+        self.shards_dir = shards_dir
+
         # Character classes
         self.classes = [
             "Darth Vader",
@@ -26,10 +146,12 @@ class AutoAnnotator:
             "Han Solo",
             "Leia Organa"
         ]
-        
+        # Prefijo que 3_prepare_dataset.py pone a cada imagen (carpeta del personaje)
+        self.class_prefixes = [(f"{name.replace(' ', '_')}_", idx) for idx, name in enumerate(self.classes)]
+
         # Create backup of original labels
         self._backup_labels()
-        
+
     def _backup_labels(self):
         """Create backup of original labels."""
         backup_dir = self.dataset_dir / "labels_backup"
@@ -37,85 +159,112 @@ class AutoAnnotator:
             shutil.copytree(self.train_dir / "labels", backup_dir / "train")
             shutil.copytree(self.val_dir / "labels", backup_dir / "val")
             print("Created backup of original labels")
-    
-    def annotate_images(self, conf_threshold=0.5):
-        """Annotate images using HOG person detector."""
-        print("Starting automatic annotation...")
-        
-        # Process training set
-        print("\nProcessing training set...")
-        self._process_directory(self.train_dir, conf_threshold)
-        
-        # Process validation set
-        print("\nProcessing validation set...")
-        self._process_directory(self.val_dir, conf_threshold)
-        
-        print("\nAnnotation complete!")
-    
-    def _process_directory(self, directory, conf_threshold):
-        """Process all images in a directory."""
+
+    def class_for(self, img_path):
+        """Class of the character an image was collected for (0 when unknown)."""
+        for prefix, class_id in self.class_prefixes:
+            if img_path.name.startswith(prefix):
+                return class_id
+        return 0
+
+    def pending_images(self, directory):
+        """(image, label) pairs of a split that need (re)annotation."""
         images_dir = directory / "images"
         labels_dir = directory / "labels"
-        
-        # Get all images
-        image_files = list(images_dir.glob("*.jpg"))
-        
-        for img_path in tqdm(image_files, desc="Annotating images"):
-            # Read image
-            img = cv2.imread(str(img_path))
-            if img is None:
-                print(f"Could not read image: {img_path}")
-                continue
-            
-            # Resize image if too large
-            max_dimension = 1000
-            height, width = img.shape[:2]
-            if max(height, width) > max_dimension:
-                scale = max_dimension / max(height, width)
-                img = cv2.resize(img, None, fx=scale, fy=scale)
-            
-            # Detect people
-            boxes, weights = self.hog.detectMultiScale(
-                img,
-                winStride=(8, 8),
-                padding=(4, 4),
-                scale=1.05,
-                hitThreshold=0
-            )
-            
-            # Create label file
-            label_path = labels_dir / f"{img_path.stem}.txt"
-            with open(label_path, "w") as f:
-                # Process each detection
-                for box, weight in zip(boxes, weights):
-                    if weight >= conf_threshold:
-                        # Get box coordinates
-                        x, y, w, h = box
-                        img_height, img_width = img.shape[:2]
-                        
-                        # Convert to YOLO format (x_center, y_center, width, height)
-                        x_center = (x + w/2) / img_width
-                        y_center = (y + h/2) / img_height
-                        width = w / img_width
-                        height = h / img_height
-                        
-                        # Write to file (using class 0 for person)
-                        f.write(f"0 {x_center:.6f} {y_center:.6f} {width:.6f} {height:.6f}\n")
-    
+        pairs = [(img_path, labels_dir / f"{img_path.stem}.txt") for img_path in sorted(images_dir.glob("*.jpg"))]
+        if self.force:
+            return pairs, 0
+        pending = [(img_path, label_path) for img_path, label_path in pairs
+                   if not label_is_current(img_path, label_path)]
+        return pending, len(pairs) - len(pending)
+
+    def annotate_images(self, conf_threshold=0.5, labeler="hog", model_path=None, batch_size=16):
+        """Annotate images using HOG person detector or a trained model."""
+        print(f"Starting automatic annotation ({labeler})...")
+
+        if labeler == "model":
+            # Se importa aquí: el etiquetador HOG no necesita el modelo
+            from ml_model.detect import StarWarsDetector
+
+            detector = StarWarsDetector(model_path, warmup_runs=1)
+            shards = ShardReader(self.shards_dir) if self.shards_dir else None
+
+        for name, directory in (("training", self.train_dir), ("validation", self.val_dir)):
+            print(f"\nProcessing {name} set...")
+            pending, skipped = self.pending_images(directory)
+            start = time.perf_counter()
+            if labeler == "model":
+                annotated = self._process_directory_model(pending, detector, conf_threshold, batch_size, shards)
+            else:
+                annotated = self._process_directory(pending, conf_threshold)
+            elapsed = time.perf_counter() - start
+            rate = annotated / elapsed if elapsed > 0 else 0.0
+            print(f"Annotated {annotated} images in {elapsed:.1f}s ({rate:.1f} images/s), "
+                  f"{skipped} already up to date")
+
+        print("\nAnnotation complete!")
+
+    def _process_directory(self, pending, conf_threshold):
+        """Annotate images with HOG in a process pool."""
+        if not pending:
+            return 0
+        tasks = [(img_path, label_path, self.class_for(img_path), conf_threshold) for img_path, label_path in pending]
+        annotated = 0
+        with Pool(self.workers, initializer=_init_hog_worker, initargs=(self.shards_dir,)) as pool:
+            results = pool.imap_unordered(hog_annotate, tasks, chunksize=4)
+            for img_path, ok in tqdm(results, total=len(tasks), desc="Annotating images"):
+                if ok:
+                    annotated += 1
+                else:
+                    print(f"Could not read image: {img_path}")
+        return annotated
+
+    def _process_directory_model(self, pending, detector, conf_threshold, batch_size, shards=None):
+        """Pseudo-label images with batched detector inference."""
+        def read(pair):
+            return load_image(pair[0], shards)
+
+        def write(pair, image, detections):
+            height, width = image.shape[:2]
+            write_label(pair[1], yolo_lines(detections.xyxy, detections.class_id.tolist(), width, height))
+
+        batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+        annotated = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor, \
+                tqdm(total=len(pending), desc="Annotating images") as progress:
+            # Decodifica el siguiente lote mientras el modelo procesa el actual
+            next_images = executor.map(read, batches[0]) if batches else None
+            for i, batch in enumerate(batches):
+                images = list(next_images)
+                if i + 1 < len(batches):
+                    next_images = executor.map(read, batches[i + 1])
+                readable = [(pair, image) for pair, image in zip(batch, images) if image is not None]
+                for pair, image in zip(batch, images):
+                    if image is None:
+                        print(f"Could not read image: {pair[0]}")
+                results = detector.detect_batch([image for _, image in readable], conf_threshold, return_image=False)
+                writes = [executor.submit(write, pair, image, detections)
+                          for (pair, image), detections in zip(readable, results)]
+                for future in writes:
+                    future.result()
+                annotated += len(readable)
+                progress.update(len(batch))
+        return annotated
+
     def verify_annotations(self):
         """Verify that all images have corresponding label files."""
         print("\nVerifying annotations...")
-        
+
         # Check training set
         train_images = set(f.stem for f in (self.train_dir / "images").glob("*.jpg"))
         train_labels = set(f.stem for f in (self.train_dir / "labels").glob("*.txt"))
         missing_train = train_images - train_labels
-        
+
         # Check validation set
         val_images = set(f.stem for f in (self.val_dir / "images").glob("*.jpg"))
         val_labels = set(f.stem for f in (self.val_dir / "labels").glob("*.txt"))
         missing_val = val_images - val_labels
-        
+
         if missing_train or missing_val:
             print("\nWarning: Some images are missing annotations:")
             if missing_train:
@@ -124,7 +273,7 @@ class AutoAnnotator:
                 print(f"Validation set: {len(missing_val)} images missing annotations")
         else:
             print("All images have corresponding annotations!")
-        
+
         # Print statistics
         print(f"\nTotal training images: {len(train_images)}")
         print(f"Total validation images: {len(val_images)}")
@@ -132,14 +281,26 @@ class AutoAnnotator:
         print(f"Total validation annotations: {len(val_labels)}")
 
 def main():
+    parser = argparse.ArgumentParser(description="Automatically annotate the prepared dataset")
+    parser.add_argument("--dataset-dir", default="dataset", help="Dataset created by 3_prepare_dataset.py")
+    parser.add_argument("--labeler", choices=LABELERS, default="hog", help="HOG person detector or trained model")
+    parser.add_argument("--model", default="runs/detect/star_wars_detector/weights/best.pt",
+                        help="Model for --labeler model")
+    parser.add_argument("--conf", type=float, default=0.5, help="Confidence threshold")
+    parser.add_argument("--workers", type=int, help="HOG processes, or decode/write threads for the model")
+    parser.add_argument("--batch-size", type=int, default=16, help="Images per forward pass (--labeler model)")
+    parser.add_argument("--force", action="store_true", help="Relabel images whose labels are up to date")
+    parser.add_argument("--shards", help="Read images from these pre-decoded shards (python -m ml_model.shards)")
+    args = parser.parse_args()
+
     # Create annotator
-    annotator = AutoAnnotator()
-    
+    annotator = AutoAnnotator(args.dataset_dir, workers=args.workers, force=args.force, shards_dir=args.shards)
+
     # Run annotation
-    annotator.annotate_images(conf_threshold=0.5)
-    
+    annotator.annotate_images(args.conf, args.labeler, args.model, args.batch_size)
+
     # Verify results
     annotator.verify_annotations()
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
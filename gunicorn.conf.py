@@ -0,0 +1,70 @@
+"""
+Gunicorn configuration for the web app.
+
+With PRELOAD_MODEL=1 (the default) the app, and with it the model, is loaded
+once in the master process and shared by the forked workers. Each worker then
+limits its inference threads so the workers do not oversubscribe the cores.
+
+Worker count, request threads and inference threads come from the file
+written by benchmarks/autotune.py (runtime_config.json) when there is one;
+WEB_CONCURRENCY, TORCH_THREADS_PER_WORKER and command line flags override it.
+
+Prometheus metrics run in multiprocess mode: every worker writes its values
+to files in PROMETHEUS_MULTIPROC_DIR and /metrics aggregates them, whichever
+worker serves the scrape.
+"""
+import gc
+import os
+import sys
+import tempfile
+
+# gunicorn reads this file before putting the project on sys.path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from ml_model.runtime_config import load_runtime_config
+
+preload_app = os.environ.get('PRELOAD_MODEL', '1') == '1'
+
+runtime_config = load_runtime_config()
+workers = int(os.environ.get('WEB_CONCURRENCY', runtime_config.get('workers', 1)))
+threads = runtime_config.get('threads', 8)
+
+# Must be set before prometheus_client is imported (by the app, in the master
+# with preload or in each worker otherwise)
+metrics_dir = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), f'star-wars-detector-metrics-{os.getpid()}')
+)
+os.makedirs(metrics_dir, exist_ok=True)
+
+
+def on_starting(server):
+    # Values left over from an earlier run would be added to the new ones. With
+    # preload the app is already loaded here, so the master's own files stay
+    for name in os.listdir(metrics_dir):
+        if not name.endswith(f'_{os.getpid()}.db'):
+            os.remove(os.path.join(metrics_dir, name))
+
+
+def when_ready(server):
+    if preload_app:
+        # Keep the GC from writing to (and so un-sharing) objects created in the master
+        gc.freeze()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    # Drop the live gauges of a dead worker (its counters keep counting)
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def post_worker_init(worker):
+    from app.app import init_worker
+
+    num_threads = int(os.environ.get('TORCH_THREADS_PER_WORKER', 0))
+    if not num_threads:
+        if runtime_config.get('torch_threads') and worker.cfg.workers == runtime_config.get('workers'):
+            num_threads = runtime_config['torch_threads']
+        else:
+            # The tuned thread count only fits the tuned number of workers
+            num_threads = max(1, (os.cpu_count() or 1) // worker.cfg.workers)
+    init_worker(num_threads, runtime_config.get('interop_threads'), runtime_config.get('opencv_threads'))
@@ -0,0 +1,547 @@
+"""
+Inference backends for StarWarsDetector.
+
+Every backend takes a list of BGR images and returns, per image, the raw
+detections as numpy arrays (xyxy boxes in source pixels, scores, class ids).
+Heavy dependencies are only imported by the backend that needs them, so a
+web worker serving the ONNX model never imports torch.
+"""
+import hashlib
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+import cv2
+import numpy as np
+
+# (boxes [N, 4] xyxy float32, scores [N] float32, class ids [N] int64)
+RawDetections = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+BACKENDS = ("pytorch", "onnx")
+
+
+def file_digest(path: Union[str, Path]) -> str:
+    """SHA-256 of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fused_artifact_path(model_path: Union[str, Path], digest: str) -> Path:
+    """Location of the cached inference-ready copy of a checkpoint."""
+    model_path = Path(model_path)
+    return model_path.with_name(f"{model_path.stem}.{digest[:12]}.fused.pt")
+
+
+class PhaseTimer:
+    """Record the wall time spent in consecutive startup phases."""
+
+    def __init__(self):
+        self.timings = {}
+        self._last = time.perf_counter()
+
+    def lap(self, phase: str):
+        """Close the current phase and charge its time to `phase`."""
+        now = time.perf_counter()
+        self.timings[phase] = self.timings.get(phase, 0.0) + now - self._last
+        self._last = now
+
+
+def register_safe_globals():
+    """Allow torch.load to unpickle the ultralytics modules in our checkpoints."""
+    from torch.serialization import add_safe_globals
+    from torch.nn.modules.container import Sequential, ModuleList
+    from torch.nn.modules.conv import Conv2d
+    from torch.nn.modules.batchnorm import BatchNorm2d
+    from torch.nn.modules.activation import SiLU
+    from torch.nn.modules.pooling import MaxPool2d
+    from torch.nn.modules.upsampling import Upsample
+    from ultralytics.nn.tasks import DetectionModel
+    from ultralytics.nn.modules.conv import Conv, Concat
+    from ultralytics.nn.modules.block import C2f, SPPF, Bottleneck, DFL
+    from ultralytics.nn.modules.head import Detect
+
+    add_safe_globals([
+        Upsample,
+        MaxPool2d,
+        Bottleneck,
+        ModuleList,
+        DetectionModel,
+        Sequential,
+        Conv,
+        C2f,
+        SPPF,
+        Detect,
+        Conv2d,
+        BatchNorm2d,
+        SiLU,
+        Concat,
+        DFL
+    ])
+
+
+def load_yolo(model_path: Union[str, Path]):
+    """
+    Load a checkpoint with ultralytics, including the fused artifacts written here.
+
+    Fusing rebinds each Conv's forward to its forward_fuse method, so a fused
+    model pickles bound methods, which torch.load with weights_only=True (the
+    default since torch 2.6) only accepts when builtins.getattr is allowed.
+    Only our own artifacts and checkpoints are loaded this way.
+    """
+    import torch
+    from ultralytics import YOLO
+
+    with torch.serialization.safe_globals([getattr]):
+        return YOLO(str(model_path), task='detect')
+
+
+def letterbox(
+    images: List[np.ndarray],
+    size: int = 640,
+    pad_value: int = 114
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Resize and pad BGR images into one normalized NCHW RGB batch.
+
+    Matches the ultralytics letterbox with square padding: aspect ratio is
+    kept and the padding is split evenly between both sides. Both backends
+    use it, so the input of an image never depends on the rest of the batch.
+
+    Args:
+        images: BGR images as numpy arrays
+        size: Square network input size
+        pad_value: Gray level used for the padding
+
+    Returns:
+        Tuple containing:
+        - Batch as float32 array of shape (N, 3, size, size), values in [0, 1]
+        - Scale ratio applied to each image, shape (N,)
+        - (left, top) padding of each image, shape (N, 2)
+    """
+    batch = np.full((len(images), size, size, 3), pad_value, dtype=np.uint8)
+    ratios = np.empty(len(images), dtype=np.float32)
+    pads = np.empty((len(images), 2), dtype=np.float32)
+    for i, image in enumerate(images):
+        height, width = image.shape[:2]
+        ratio = min(size / height, size / width)
+        new_w, new_h = int(round(width * ratio)), int(round(height * ratio))
+        left = int(round((size - new_w) / 2 - 0.1))
+        top = int(round((size - new_h) / 2 - 0.1))
+        if (new_w, new_h) != (width, height):
+            image = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+        batch[i, top:top + new_h, left:left + new_w] = image
+        ratios[i] = ratio
+        pads[i] = (left, top)
+    # BGR HWC uint8 -> RGB CHW float32 for the whole batch at once
+    batch = np.ascontiguousarray(batch[..., ::-1].transpose(0, 3, 1, 2), dtype=np.float32)
+    batch *= 1.0 / 255.0
+    return batch, ratios, pads
+
+
+def unletterbox(boxes: np.ndarray, ratio: float, pad: np.ndarray, shape: Tuple[int, int]) -> np.ndarray:
+    """Map xyxy boxes from the letterboxed input back to the source image, clipped to it."""
+    boxes = (boxes - np.tile(pad, 2)) / ratio
+    height, width = shape
+    boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, width)
+    boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, height)
+    return boxes.astype(np.float32)
+
+
+def non_max_suppression(
+    boxes: np.ndarray,
+    scores: np.ndarray,
+    iou_threshold: float = 0.7,
+    max_det: int = 300
+) -> np.ndarray:
+    """
+    Greedy NMS on xyxy boxes.
+
+    Each iteration keeps the best remaining box and drops every box that
+    overlaps it, computing all IoUs against it in one vectorized step.
+
+    Returns:
+        Indices of the kept boxes, best score first
+    """
+    x1, y1, x2, y2 = boxes.T
+    areas = (x2 - x1).clip(0) * (y2 - y1).clip(0)
+    order = scores.argsort()[::-1]
+    keep = []
+    while order.size and len(keep) < max_det:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        inter_w = (np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest])).clip(0)
+        inter_h = (np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest])).clip(0)
+        inter = inter_w * inter_h
+        iou = inter / (areas[i] + areas[rest] - inter + 1e-7)
+        order = rest[iou <= iou_threshold]
+    return np.asarray(keep, dtype=np.int64)
+
+
+class InferenceBackend:
+    """Common interface of the inference backends."""
+
+    name = None
+    # SHA-256 of the model file the backend was built from
+    model_digest = None
+    # Seconds spent in each loading phase
+    load_timings: Dict[str, float] = {}
+
+    # Whether predict() honours imgsz; exports with fixed input shapes do not
+    supports_imgsz = True
+
+    def predict(self, images: List[np.ndarray], conf: float, imgsz: int = None) -> List[RawDetections]:
+        """
+        Run the model on a batch of BGR images.
+
+        Args:
+            images: BGR images as numpy arrays
+            conf: Minimum confidence of the returned detections
+            imgsz: Network input size (multiple of 32), None for the default
+
+        Returns:
+            One (boxes, scores, class_ids) tuple per image, boxes in the
+            coordinates of the source image
+        """
+        raise NotImplementedError
+
+    def set_num_threads(self, num_threads: int):
+        """Limit the intra-op threads this process uses for inference."""
+
+    def set_num_interop_threads(self, num_threads: int):
+        """Limit the threads that run independent operators in parallel."""
+
+    def freeze(self):
+        """Prepare the loaded model to be shared by forked worker processes."""
+
+
+class PyTorchBackend(InferenceBackend):
+    name = "pytorch"
+
+    def __init__(
+        self,
+        model_path: Union[str, Path],
+        cache_fused: bool = True,
+        channels_last: bool = False
+    ):
+        """
+        Serve the checkpoint with the ultralytics/PyTorch stack.
+
+        The checkpoint is deserialized once. Its Conv+BN layers are fused for
+        inference and, with cache_fused, that fused model is saved next to the
+        weights (named after the checkpoint hash) so later starts load it
+        directly and skip fusing.
+
+        Args:
+            model_path (str or Path): Path to the trained .pt checkpoint
+            cache_fused (bool): Reuse or write the fused artifact
+            channels_last (bool): Store the weights in NHWC order, which the
+                CPU convolution kernels often run faster
+        """
+        timer = PhaseTimer()
+        import torch
+        import ultralytics  # noqa: F401 (cuenta en la fase de importación)
+
+        register_safe_globals()
+        timer.lap("import")
+
+        self.model_digest = file_digest(model_path)
+        timer.lap("hash")
+
+        fused_path = fused_artifact_path(model_path, self.model_digest)
+        self.model = None
+        if cache_fused and fused_path.exists():
+            try:
+                self.model = load_yolo(fused_path)
+            except Exception as e:
+                # Artefacto ilegible (p.ej. de otra versión de torch): se reconstruye
+                print(f"Could not load fused model {fused_path}, rebuilding it: {e}")
+            timer.lap("load")
+        if self.model is None:
+            self.model = load_yolo(model_path)
+            timer.lap("load")
+            self.model.model.fuse(verbose=False)
+            timer.lap("fuse")
+            if cache_fused:
+                self._save_fused(torch, model_path, fused_path)
+                timer.lap("save_fused")
+        self.model.model.eval()
+        imgsz = self.model.overrides.get('imgsz') or 640
+        self.img_size = imgsz if isinstance(imgsz, int) else max(imgsz)
+        if channels_last:
+            self.model.model.to(memory_format=torch.channels_last)
+            timer.lap("channels_last")
+        self.load_timings = timer.timings
+
+    def _save_fused(self, torch, model_path: Path, fused_path: Path):
+        """Write the fused model atomically, replacing artifacts of older weights."""
+        checkpoint = {
+            'model': self.model.model,
+            'train_args': self.model.ckpt.get('train_args', {}) if self.model.ckpt else {},
+            'source_sha256': self.model_digest,
+        }
+        tmp_path = fused_path.with_name(f".{fused_path.name}.{os.getpid()}.tmp")
+        try:
+            torch.save(checkpoint, tmp_path)
+            os.replace(tmp_path, fused_path)
+        except OSError as e:
+            # Read-only deploys just pay the fuse cost on every start
+            print(f"Could not cache fused model at {fused_path}: {e}")
+            tmp_path.unlink(missing_ok=True)
+            return
+        for stale in fused_path.parent.glob(f"{Path(model_path).stem}.*.fused.pt"):
+            if stale != fused_path:
+                stale.unlink(missing_ok=True)
+
+    def set_num_threads(self, num_threads: int):
+        import torch
+
+        torch.set_num_threads(num_threads)
+
+    def set_num_interop_threads(self, num_threads: int):
+        import torch
+
+        if torch.get_num_interop_threads() == num_threads:
+            return
+        try:
+            torch.set_num_interop_threads(num_threads)
+        except RuntimeError as e:
+            # Only possible once per process, before any inter-op work started
+            print(f"Could not set {num_threads} inter-op threads: {e}")
+
+    def freeze(self):
+        """
+        Make the weights read-only and move them to shared memory.
+
+        Forked workers then map the very same pages instead of relying on
+        copy-on-write, which any stray write (or refcount touching a page)
+        would break.
+        """
+        model = self.model.model
+        model.eval()
+        model.requires_grad_(False)
+        model.share_memory()
+
+    def predict(self, images: List[np.ndarray], conf: float, imgsz: int = None) -> List[RawDetections]:
+        import torch
+
+        # Letterbox propio a un cuadrado fijo, como OnnxBackend: ultralytics solo
+        # rellena en rectángulo si todo el lote tiene la misma forma, y entonces
+        # las detecciones de una imagen dependerían de las demás del lote
+        batch, ratios, pads = letterbox(images, imgsz or self.img_size)
+        outputs = []
+        results = self.model(torch.from_numpy(batch), conf=conf, verbose=False)
+        for result, ratio, pad, image in zip(results, ratios, pads, images):
+            # One device-to-host copy per image: columns are xyxy, conf, cls
+            data = result.boxes.data.cpu().numpy()
+            boxes = unletterbox(data[:, :4], ratio, pad, image.shape[:2])
+            outputs.append((boxes, data[:, 4], data[:, 5].astype(np.int64)))
+        return outputs
+
+
+class OnnxBackend(InferenceBackend):
+    name = "onnx"
+
+    def __init__(
+        self,
+        model_path: Union[str, Path],
+        img_size: int = 640,
+        iou_threshold: float = 0.7,
+        max_det: int = 300,
+        num_threads: int = 0
+    ):
+        """
+        Serve the ONNX export with ONNX Runtime on CPU.
+
+        Args:
+            model_path (str or Path): Path to the .onnx file exported by train.py
+            img_size (int): Network input size, used when the export has
+                dynamic spatial dimensions
+            iou_threshold (float): IoU threshold of the class-aware NMS
+            max_det (int): Maximum detections kept per image
+            num_threads (int): ONNX Runtime intra-op threads, 0 lets it decide
+        """
+        timer = PhaseTimer()
+        self.model_digest = file_digest(model_path)
+        timer.lap("hash")
+
+        self.model_path = Path(model_path)
+        self.num_threads = num_threads
+        self._inherited_sessions = []
+        self._create_session()
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        batch_dim, _, height, _ = model_input.shape
+        # Exports without dynamic=True only take one image per run
+        self.max_batch = batch_dim if isinstance(batch_dim, int) else None
+        self.img_size = height if isinstance(height, int) else img_size
+        self.supports_imgsz = not isinstance(height, int)
+        self.iou_threshold = iou_threshold
+        self.max_det = max_det
+        timer.lap("load")
+        self.load_timings = timer.timings
+
+    def _create_session(self):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if self.num_threads:
+            options.intra_op_num_threads = self.num_threads
+        self.session = ort.InferenceSession(
+            str(self.model_path), sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        self._pid = os.getpid()
+
+    def _ensure_session(self):
+        """ONNX Runtime sessions are not fork-safe: rebuild one per process."""
+        if self._pid != os.getpid():
+            # Never destroy the parent's session here: its thread pool does not
+            # exist in this process and tearing it down could hang
+            self._inherited_sessions.append(self.session)
+            self._create_session()
+
+    def set_num_threads(self, num_threads: int):
+        if num_threads != self.num_threads or self._pid != os.getpid():
+            self.num_threads = num_threads
+            if self._pid == os.getpid():
+                self.session = None
+            else:
+                self._inherited_sessions.append(self.session)
+            self._create_session()
+
+    def predict(self, images: List[np.ndarray], conf: float, imgsz: int = None) -> List[RawDetections]:
+        self._ensure_session()
+        size = imgsz if imgsz and self.supports_imgsz else self.img_size
+        batch, ratios, pads = letterbox(images, size)
+        step = self.max_batch or len(images)
+        preds = np.concatenate([
+            self.session.run(None, {self.input_name: batch[i:i + step]})[0]
+            for i in range(0, len(images), step)
+        ])
+        # (N, 4 + classes, anchors) -> (N, anchors, 4 + classes)
+        preds = preds.transpose(0, 2, 1)
+        return [
+            self._postprocess(pred, ratio, pad, image.shape[:2], conf)
+            for pred, ratio, pad, image in zip(preds, ratios, pads, images)
+        ]
+
+    def _postprocess(
+        self,
+        pred: np.ndarray,
+        ratio: float,
+        pad: np.ndarray,
+        shape: Tuple[int, int],
+        conf: float
+    ) -> RawDetections:
+        class_scores = pred[:, 4:]
+        class_ids = class_scores.argmax(1)
+        scores = class_scores[np.arange(len(class_ids)), class_ids]
+        mask = scores > conf
+        xywh, scores, class_ids = pred[mask, :4], scores[mask], class_ids[mask]
+
+        boxes = np.empty_like(xywh)
+        boxes[:, :2] = xywh[:, :2] - xywh[:, 2:] / 2
+        boxes[:, 2:] = xywh[:, :2] + xywh[:, 2:] / 2
+
+        # Class-aware NMS in one pass: offset each class into its own region
+        offsets = class_ids[:, None].astype(np.float32) * 7680.0
+        keep = non_max_suppression(boxes + offsets, scores, self.iou_threshold, self.max_det)
+        boxes, scores, class_ids = boxes[keep], scores[keep], class_ids[keep]
+        return unletterbox(boxes, ratio, pad, shape), scores.astype(np.float32), class_ids.astype(np.int64)
+
+
+def resolve_backend(model_path: Union[str, Path], backend: str = None) -> Tuple[str, Path]:
+    """
+    Pick the backend and model file to load.
+
+    Without an explicit backend it follows the file suffix. Asking for the
+    ONNX backend with a .pt path loads the .onnx export next to it.
+    """
+    model_path = Path(model_path)
+    if backend is None:
+        backend = "onnx" if model_path.suffix == ".onnx" else "pytorch"
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}', expected one of {', '.join(BACKENDS)}")
+    if backend == "onnx" and model_path.suffix != ".onnx":
+        model_path = model_path.with_suffix(".onnx")
+    return backend, model_path
+
+
+def create_backend(model_path: Union[str, Path], backend: str = None, **kwargs) -> InferenceBackend:
+    """Instantiate the backend selected by resolve_backend."""
+    backend, model_path = resolve_backend(model_path, backend)
+    if backend == "onnx":
+        return OnnxBackend(model_path, **kwargs)
+    return PyTorchBackend(model_path, **kwargs)
+
+
+def compare_backends(
+    model_path: Union[str, Path],
+    images: List[np.ndarray],
+    conf: float = 0.25,
+    atol: float = 2.0,
+    score_atol: float = 0.02
+) -> List[str]:
+    """
+    Check that the PyTorch and ONNX backends agree on a set of images.
+
+    Detections are matched after sorting by score; boxes must match within
+    atol pixels and scores within score_atol.
+
+    Returns:
+        List of mismatch descriptions, empty when both backends agree
+    """
+    reference = create_backend(model_path, "pytorch").predict(images, conf)
+    candidate = create_backend(model_path, "onnx").predict(images, conf)
+    problems = []
+    for i, ((ref_boxes, ref_scores, ref_cls), (boxes, scores, cls)) in enumerate(zip(reference, candidate)):
+        if len(ref_boxes) != len(boxes):
+            problems.append(f"image {i}: {len(ref_boxes)} detections with pytorch, {len(boxes)} with onnx")
+            continue
+        ref_order, order = ref_scores.argsort()[::-1], scores.argsort()[::-1]
+        if not np.array_equal(ref_cls[ref_order], cls[order]):
+            problems.append(f"image {i}: class ids differ")
+        if not np.allclose(ref_boxes[ref_order], boxes[order], atol=atol):
+            diff = np.abs(ref_boxes[ref_order] - boxes[order]).max()
+            problems.append(f"image {i}: boxes differ by up to {diff:.2f}px")
+        if not np.allclose(ref_scores[ref_order], scores[order], atol=score_atol):
+            diff = np.abs(ref_scores[ref_order] - scores[order]).max()
+            problems.append(f"image {i}: scores differ by up to {diff:.3f}")
+    return problems
+
+
+def main():
+    """Backend parity check: run both backends over some images and compare."""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Check that the PyTorch and ONNX backends agree")
+    parser.add_argument("images", nargs="+", help="Images to compare on")
+    parser.add_argument("--model", default="runs/detect/star_wars_detector/weights/best.pt",
+                      help="Path to the .pt model; the .onnx export must sit next to it")
+    parser.add_argument("--conf", type=float, default=0.25,
+                      help="Confidence threshold")
+    parser.add_argument("--atol", type=float, default=2.0,
+                      help="Allowed box difference in pixels")
+    args = parser.parse_args()
+
+    images = []
+    for path in args.images:
+        image = cv2.imread(path)
+        if image is None:
+            raise ValueError(f"Could not read image from {path}")
+        images.append(image)
+
+    problems = compare_backends(args.model, images, args.conf, args.atol)
+    for problem in problems:
+        print(problem)
+    print("Backends match" if not problems else f"\n{len(problems)} mismatches")
+    raise SystemExit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
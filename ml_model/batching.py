@@ -0,0 +1,380 @@
+"""
+Dynamic micro-batching in front of StarWarsDetector.
+
+Requests that arrive within a short window are grouped and run through the
+model in a single forward pass, then each caller gets its own detections back.
+
+The queue also does admission control: it is bounded (new work is rejected
+with QueueFullError instead of waiting behind work that will time out),
+interactive requests are served before bulk ones, and requests whose deadline
+passes while they wait are dropped before inference.
+"""
+import itertools
+import math
+import os
+import queue
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+
+from ml_model import metrics
+from ml_model.results import Detections
+
+# Priority classes, served in this order
+PRIORITIES = ("interactive", "bulk")
+
+
+class QueueFullError(RuntimeError):
+    """The queue has no room for the request's priority class."""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Detector is overloaded, retry later")
+        self.retry_after = retry_after
+
+
+class DeadlineExceededError(RuntimeError):
+    """The request's deadline passed before it reached the model."""
+
+    def __init__(self):
+        super().__init__("Deadline exceeded before inference")
+
+
+class _PendingRequest:
+    __slots__ = (
+        "image", "conf_threshold", "return_image", "imgsz", "priority", "expires_at", "future", "enqueued_at"
+    )
+
+    def __init__(
+        self,
+        image: np.ndarray,
+        conf_threshold: float,
+        return_image: bool,
+        imgsz: int = None,
+        priority: str = "interactive",
+        expires_at: float = None
+    ):
+        self.image = image
+        self.conf_threshold = conf_threshold
+        self.return_image = return_image
+        self.imgsz = imgsz
+        self.priority = priority
+        # perf_counter() time after which the result is no longer wanted
+        self.expires_at = expires_at
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class BatchingScheduler:
+    def __init__(
+        self,
+        detector,
+        max_batch_size: int = 8,
+        batch_window_ms: float = 5.0,
+        stats_window: int = 1000,
+        max_queue_size: int = 0,
+        bulk_queue_size: int = None
+    ):
+        """
+        Initialize the batching scheduler.
+
+        Args:
+            detector: StarWarsDetector used to run the batched forward passes
+            max_batch_size (int): Maximum number of images per forward pass
+            batch_window_ms (float): How long to wait for more requests after
+                the first one of a batch arrives
+            stats_window (int): Number of recent requests kept for the
+                queueing delay percentiles
+            max_queue_size (int): Requests that may wait for the model
+                (0 = unbounded)
+            bulk_queue_size (int): Queue depth above which bulk requests are
+                rejected, keeping the rest for interactive ones (default
+                half of max_queue_size)
+        """
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        if max_queue_size < 0:
+            raise ValueError("max_queue_size must not be negative")
+        self.detector = detector
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window_ms / 1000.0
+        self.max_queue_size = max_queue_size
+        if bulk_queue_size is None:
+            bulk_queue_size = max_queue_size // 2
+        self.queue_limits = {"interactive": max_queue_size, "bulk": min(bulk_queue_size, max_queue_size)}
+
+        self.stats_window = stats_window
+        self._closed = False
+        self._start_lock = threading.Lock()
+        self._start()
+
+    def _start(self):
+        """Create the queue and worker thread for the current process."""
+        self._pid = os.getpid()
+        # Entries are (priority rank, sequence, request): interactive first, FIFO within a class
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._space = threading.Condition()
+        self._depth = 0
+        self._stats_lock = threading.Lock()
+        self._batch_sizes = Counter()
+        self._queue_delays = deque(maxlen=self.stats_window)
+        self._priority_delays = {priority: deque(maxlen=self.stats_window) for priority in PRIORITIES}
+        self._shed = defaultdict(Counter)
+        self._batch_seconds = None
+        self._total_requests = 0
+        self._total_batches = 0
+        self._total_errors = 0
+        self._worker = threading.Thread(target=self._run, name="detector-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(
+        self,
+        image: Union[str, Path, np.ndarray],
+        conf_threshold: float = 0.25,
+        return_image: bool = True,
+        latency_budget_ms: float = None,
+        priority: str = "interactive",
+        deadline: float = None,
+        block: bool = False
+    ) -> Future:
+        """
+        Queue an image for detection.
+
+        The image is decoded in the caller's thread so that a bad upload only
+        fails its own request. Its input size is chosen there too, from the
+        detector's resolution policy and the optional latency budget. A slot
+        in the queue is reserved before decoding, so rejected requests cost
+        no decode.
+
+        Args:
+            priority (str): One of PRIORITIES
+            deadline (float): Unix time after which the result is no longer
+                wanted; the request is dropped if it is still waiting then
+            block (bool): Wait for room in the queue (until the deadline, if
+                any) instead of raising QueueFullError
+
+        Returns:
+            Future resolving to the image's Detections
+
+        Raises:
+            QueueFullError: The queue is full for this priority
+            DeadlineExceededError: The deadline has already passed
+        """
+        if self._closed:
+            raise RuntimeError("BatchingScheduler is closed")
+        if priority not in PRIORITIES:
+            raise ValueError(f"priority must be one of: {', '.join(PRIORITIES)}")
+        if self._pid != os.getpid():
+            # Threads do not survive fork (e.g. gunicorn --preload): restart in this worker
+            with self._start_lock:
+                if self._pid != os.getpid():
+                    self._start()
+        expires_at = None
+        if deadline is not None:
+            # Wall-clock deadline -> monotonic clock
+            expires_at = time.perf_counter() + (deadline - time.time())
+            if expires_at <= time.perf_counter():
+                self._record_shed("expired", priority)
+                raise DeadlineExceededError()
+
+        self._reserve(priority, expires_at, block)
+        try:
+            with metrics.stage_timer('decode'):
+                image = self.detector.load_image(image)
+            imgsz = self.detector.choose_input_size(image, latency_budget_ms)
+        except BaseException:
+            self._release(priority)
+            raise
+        request = _PendingRequest(image, float(conf_threshold), return_image, imgsz, priority, expires_at)
+        self._queue.put((PRIORITIES.index(priority), next(self._sequence), request))
+        return request.future
+
+    def detect_characters(
+        self,
+        image: Union[str, Path, np.ndarray],
+        conf_threshold: float = 0.25,
+        return_image: bool = True,
+        timeout: float = None,
+        latency_budget_ms: float = None,
+        **admission
+    ) -> Tuple[List[Dict], np.ndarray]:
+        """Blocking equivalent of StarWarsDetector.detect_characters."""
+        detections = self.submit(image, conf_threshold, return_image, latency_budget_ms, **admission).result(timeout)
+        return detections.to_dicts(), detections.image
+
+    def detect(
+        self,
+        image: Union[str, Path, np.ndarray],
+        conf_threshold: float = 0.25,
+        return_image: bool = True,
+        timeout: float = None,
+        latency_budget_ms: float = None,
+        **admission
+    ) -> Detections:
+        """Blocking equivalent of StarWarsDetector.detect."""
+        return self.submit(image, conf_threshold, return_image, latency_budget_ms, **admission).result(timeout)
+
+    def retry_after(self) -> int:
+        """Seconds a rejected client should wait: the time to drain the current queue."""
+        with self._stats_lock:
+            batch_seconds = self._batch_seconds or 0.0
+        batches = math.ceil(self._depth / self.max_batch_size)
+        return max(1, math.ceil(batches * batch_seconds))
+
+    def stats(self) -> Dict:
+        """Return batch size, queueing delay and load shedding metrics."""
+        with self._stats_lock:
+            delays = np.array(self._queue_delays) * 1000.0
+            priority_delays = {
+                priority: np.array(values) * 1000.0 for priority, values in self._priority_delays.items()
+            }
+            batch_sizes = dict(sorted(self._batch_sizes.items()))
+            shed = {reason: dict(counts) for reason, counts in self._shed.items()}
+            total_requests = self._total_requests
+            total_batches = self._total_batches
+            total_errors = self._total_errors
+
+        stats = {
+            'requests': total_requests,
+            'batches': total_batches,
+            'errors': total_errors,
+            'queue_depth': self._depth,
+            'queue_limits': self.queue_limits if self.max_queue_size else None,
+            'shed': shed,
+            'mean_batch_size': total_requests / total_batches if total_batches else 0.0,
+            'batch_size_histogram': batch_sizes,
+        }
+        if delays.size:
+            p50, p95, p99 = np.percentile(delays, [50, 95, 99])
+            stats['queue_delay_ms'] = {
+                'mean': float(delays.mean()),
+                'p50': float(p50),
+                'p95': float(p95),
+                'p99': float(p99),
+                'max': float(delays.max()),
+            }
+            stats['queue_delay_ms_by_priority'] = {
+                priority: {'p50': float(np.percentile(values, 50)), 'p99': float(np.percentile(values, 99))}
+                for priority, values in priority_delays.items() if values.size
+            }
+        return stats
+
+    def close(self):
+        """Stop the worker thread after the queued requests are served."""
+        if not self._closed:
+            self._closed = True
+            # Ranked after every priority class, so queued requests go first
+            self._queue.put((len(PRIORITIES), next(self._sequence), None))
+            self._worker.join()
+
+    def _record_shed(self, reason: str, priority: str):
+        metrics.SHED.labels(reason, priority).inc()
+        with self._stats_lock:
+            self._shed[reason][priority] += 1
+
+    def _reserve(self, priority: str, expires_at: float, block: bool):
+        """Take a queue slot for a request of this priority, or raise."""
+        with self._space:
+            if self.max_queue_size:
+                limit = self.queue_limits[priority]
+                while self._depth >= limit:
+                    remaining = None if expires_at is None else expires_at - time.perf_counter()
+                    if not block:
+                        self._record_shed("queue_full", priority)
+                        raise QueueFullError(self.retry_after())
+                    if remaining is not None and remaining <= 0:
+                        self._record_shed("expired", priority)
+                        raise DeadlineExceededError()
+                    self._space.wait(remaining)
+            self._depth += 1
+        metrics.QUEUE_DEPTH.labels(priority).inc()
+
+    def _release(self, priority: str):
+        with self._space:
+            self._depth -= 1
+            self._space.notify_all()
+        metrics.QUEUE_DEPTH.labels(priority).dec()
+
+    def _take(self, request: _PendingRequest) -> bool:
+        """Free the slot of a dequeued request; False if it expired and was dropped."""
+        self._release(request.priority)
+        if request.expires_at is not None and request.expires_at <= time.perf_counter():
+            self._record_shed("expired", request.priority)
+            request.future.set_exception(DeadlineExceededError())
+            return False
+        return True
+
+    def _collect_batch(self, first: _PendingRequest) -> Tuple[List[_PendingRequest], bool]:
+        """Gather requests until the window closes or the batch is full."""
+        batch = [first]
+        deadline = first.enqueued_at + self.batch_window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining > 0:
+                    _, _, request = self._queue.get(timeout=remaining)
+                else:
+                    # Window is over, but still take whatever already queued up
+                    _, _, request = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                return batch, True
+            if self._take(request):
+                batch.append(request)
+        return batch, False
+
+    def _run(self):
+        while True:
+            _, _, first = self._queue.get()
+            if first is None:
+                return
+            if not self._take(first):
+                continue
+            batch, stop = self._collect_batch(first)
+            self._dispatch(batch)
+            if stop:
+                return
+
+    def _dispatch(self, batch: List[_PendingRequest]):
+        started = time.perf_counter()
+        try:
+            outputs = self.detector.detect_batch(
+                [request.image for request in batch],
+                [request.conf_threshold for request in batch],
+                return_image=any(request.return_image for request in batch),
+                imgsz=[request.imgsz for request in batch]
+            )
+        except Exception as e:
+            metrics.ERRORS.labels('model').inc(len(batch))
+            with self._stats_lock:
+                self._total_errors += len(batch)
+            for request in batch:
+                request.future.set_exception(e)
+            return
+
+        elapsed = time.perf_counter() - started
+        metrics.record_batch(len(batch), elapsed)
+        for request in batch:
+            metrics.observe_stage('queue_wait', started - request.enqueued_at)
+            metrics.QUEUE_WAIT.labels(request.priority).observe(started - request.enqueued_at)
+
+        with self._stats_lock:
+            self._total_batches += 1
+            self._total_requests += len(batch)
+            self._batch_sizes[len(batch)] += 1
+            self._queue_delays.extend(started - request.enqueued_at for request in batch)
+            for request in batch:
+                self._priority_delays[request.priority].append(started - request.enqueued_at)
+            # Moving average of the forward pass time, for Retry-After
+            self._batch_seconds = elapsed if self._batch_seconds is None else 0.8 * self._batch_seconds + 0.2 * elapsed
+
+        for request, detections in zip(batch, outputs):
+            if not request.return_image:
+                detections.image = None
+            request.future.set_result(detections)
@@ -0,0 +1,247 @@
+"""
+Content-addressed cache for detection results.
+
+Entries are keyed by a hash of the encoded image bytes, the confidence
+threshold and the model version. A bounded in-process LRU sits in front of an
+optional sqlite file that every gunicorn worker on the host can share.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple, Union
+
+
+def content_digest(data: Union[bytes, bytearray, memoryview]) -> str:
+    """Hash encoded image bytes for use in cache keys."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def make_key(digest: str, conf_threshold: float, model_version: str, kind: str = "detections") -> str:
+    """
+    Build a cache key.
+
+    Args:
+        digest: content_digest of the encoded image
+        conf_threshold: Confidence threshold used for the detections
+        model_version: Version string of the model that produced them
+        kind: What is cached, e.g. 'detections' or 'annotated'
+    """
+    return f"{kind}:{model_version}:{conf_threshold:.4f}:{digest}"
+
+
+def _serialize(value: Any) -> Tuple[str, bytes]:
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return "bytes", bytes(value)
+    return "json", json.dumps(value, separators=(",", ":")).encode()
+
+
+def _deserialize(kind: str, payload: bytes) -> Any:
+    if kind == "bytes":
+        return bytes(payload)
+    return json.loads(payload)
+
+
+class LRUCache:
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 64 * 1024 * 1024, ttl: float = None):
+        """
+        Bounded in-process LRU cache.
+
+        Args:
+            max_entries (int): Maximum number of entries
+            max_bytes (int): Maximum total size of the serialized values
+            ttl (float): Seconds an entry stays valid, None for no expiry
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (value, size, created_at)
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, size, created_at = entry
+            if self.ttl is not None and time.monotonic() - created_at > self.ttl:
+                del self._entries[key]
+                self._size -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: Any, size: int):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= previous[1]
+            self._entries[key] = (value, size, time.monotonic())
+            self._size += size
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+class SqliteCache:
+    def __init__(self, path: Union[str, Path], max_entries: int = 100000, ttl: float = None):
+        """
+        Shared file-backed cache tier.
+
+        A single sqlite file in WAL mode that several processes can read and
+        write concurrently. Connections are opened per thread and reopened
+        after a fork.
+
+        Args:
+            path (str or Path): Location of the sqlite file
+            max_entries (int): Entries kept before the oldest are evicted
+            ttl (float): Seconds an entry stays valid, None for no expiry
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes_since_trim = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, kind TEXT NOT NULL, value BLOB NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._connect().execute("CREATE INDEX IF NOT EXISTS cache_created_at ON cache (created_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(str(self.path), timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key: str) -> Optional[Any]:
+        row = self._connect().execute(
+            "SELECT kind, value, created_at FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is not None and self.ttl is not None and time.time() - row[2] > self.ttl:
+            row = None
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return _deserialize(row[0], row[1])
+
+    def set(self, key: str, kind: str, payload: bytes):
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, kind, value, created_at) VALUES (?, ?, ?, ?)",
+            (key, kind, payload, time.time())
+        )
+        with self._lock:
+            self._writes_since_trim += 1
+            trim = self._writes_since_trim >= 64
+            if trim:
+                self._writes_since_trim = 0
+        if trim:
+            self._trim(conn)
+
+    def _trim(self, conn: sqlite3.Connection):
+        """Drop expired entries and the oldest ones beyond max_entries."""
+        evicted = 0
+        if self.ttl is not None:
+            evicted += conn.execute(
+                "DELETE FROM cache WHERE created_at < ?", (time.time() - self.ttl,)
+            ).rowcount
+        evicted += conn.execute(
+            "DELETE FROM cache WHERE key IN ("
+            "SELECT key FROM cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        ).rowcount
+        with self._lock:
+            self.evictions += max(evicted, 0)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'path': str(self.path),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class DetectionCache:
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl: float = None,
+        shared_path: Union[str, Path] = None,
+        shared_max_entries: int = 100000
+    ):
+        """
+        Two-tier detection result cache.
+
+        Args:
+            max_entries (int): Entries kept in the in-process LRU
+            max_bytes (int): Size budget of the in-process LRU
+            ttl (float): Seconds an entry stays valid, None for no expiry
+            shared_path (str or Path): Optional sqlite file shared by all workers
+            shared_max_entries (int): Entries kept in the shared tier
+        """
+        self.local = LRUCache(max_entries, max_bytes, ttl)
+        self.shared = SqliteCache(shared_path, shared_max_entries, ttl) if shared_path else None
+
+    def get(self, key: str) -> Optional[Any]:
+        """Look up a key, promoting shared-tier hits into the local LRU."""
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value, len(_serialize(value)[1]))
+        return value
+
+    def set(self, key: str, value: Any):
+        """Store a JSON-serializable value or raw bytes (e.g. an encoded image)."""
+        kind, payload = _serialize(value)
+        self.local.set(key, value, len(payload))
+        if self.shared is not None:
+            self.shared.set(key, kind, payload)
+
+    def stats(self) -> Dict:
+        stats = {'local': self.local.stats()}
+        if self.shared is not None:
+            stats['shared'] = self.shared.stats()
+        return stats
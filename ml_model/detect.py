@@ -1,57 +1,67 @@
 import os
-import torch
+import sys
+import time
 import cv2
 import numpy as np
 from pathlib import Path
-from ultralytics import YOLO
-from typing import List, Dict, Union, Tuple
-import ultralytics
-from ultralytics.nn.modules.block import Bottleneck
-from ultralytics.nn.modules.conv import Conv
-from ultralytics.nn.modules.block import C2f, SPPF
-from ultralytics.nn.modules.head import Detect
-from ultralytics.nn.tasks import DetectionModel
-from torch.nn import Sequential
-from torch.nn.modules.batchnorm import BatchNorm2d
-from torch.nn.modules.activation import SiLU
-from torch.nn.modules.container import ModuleList
-from torch.nn.modules.pooling import MaxPool2d
-from torch.serialization import add_safe_globals
-from torch.nn.modules.conv import Conv2d
-from torch.nn.modules.upsampling import Upsample
-from ultralytics.nn.modules.conv import Concat
-from ultralytics.nn.modules.block import DFL
+from io import BytesIO
+from typing import BinaryIO, Callable, Iterator, List, Dict, Union, Tuple
 
-# Add safe globals for model loading
-add_safe_globals([
-    Upsample,
-    MaxPool2d,
-    Bottleneck,
-    ModuleList,
-    DetectionModel,
-    Sequential,
-    Conv,
-    C2f,
-    SPPF,
-    Detect,
-    Conv2d,
-    BatchNorm2d,
-    SiLU,
-    Concat,
-    DFL
-])
+try:
+    from ml_model.backends import create_backend, resolve_backend
+    from ml_model.optimize import resolve_variant
+    from ml_model.resolution import ResolutionPolicy
+    from ml_model.results import Detections, render_detections
+    from ml_model.tiling import crop_tiles, merge_detections, tile_grid
+    from ml_model.video import VIDEO_EXTENSIONS, VideoPipeline
+except ImportError:  # run as a script: python ml_model/detect.py
+    from backends import create_backend, resolve_backend
+    from optimize import resolve_variant
+    from resolution import ResolutionPolicy
+    from results import Detections, render_detections
+    from tiling import crop_tiles, merge_detections, tile_grid
+    from video import VIDEO_EXTENSIONS, VideoPipeline
 
 class StarWarsDetector:
-    def __init__(self, model_path: Union[str, Path] = "runs/detect/star_wars_detector/weights/best.pt"):
+    def __init__(
+        self,
+        model_path: Union[str, Path] = "runs/detect/star_wars_detector/weights/best.pt",
+        backend: str = None,
+        warmup_runs: int = 0,
+        warmup_size: int = 640,
+        resolution_policy: ResolutionPolicy = None,
+        variant: str = None,
+        **backend_options
+    ):
         """
         Initialize the Star Wars character detector.
         
         Args:
             model_path (str or Path): Path to the trained YOLOv8 model
+            backend (str): Inference backend, 'pytorch' or 'onnx'. By default
+                it follows the model file suffix; 'onnx' with a .pt path loads
+                the .onnx export next to it
+            warmup_runs (int): Dummy forward passes run before returning, so
+                the first real request does not pay for lazy initialization
+            warmup_size (int): Side of the square dummy image used to warm up
+            resolution_policy (ResolutionPolicy): Picks the input size of each
+                image; None always uses the model's default size
+            variant (str): Serve a published variant of model_path built by
+                ml_model/optimize.py (e.g. 'int8-static') instead of the
+                checkpoint itself; it decides the backend
+            **backend_options: Extra options for the backend (e.g. num_threads
+                for ONNX Runtime, cache_fused for PyTorch)
         """
-        # Cargar el modelo con weights_only=False para compatibilidad
-        self.model = YOLO(model_path, task='detect')
-        self.model.model.load_state_dict(torch.load(model_path, weights_only=False)['model'].state_dict())
+        if variant is not None:
+            variant_backend, model_path, variant_options = resolve_variant(model_path, variant)
+            if backend is not None and backend != variant_backend:
+                raise ValueError(f"Variant '{variant}' runs on the {variant_backend} backend, not {backend}")
+            backend = variant_backend
+            backend_options = {**variant_options, **backend_options}
+        backend, model_path = resolve_backend(model_path, backend)
+        self.backend = create_backend(model_path, backend, **backend_options)
+        # Segundos empleados en cada fase del arranque
+        self.startup_timings = dict(self.backend.load_timings)
         self.class_names = [
             "Darth Vader",
             "Luke Skywalker",
@@ -62,10 +72,109 @@ class StarWarsDetector:
             "Han Solo",
             "Leia Organa"
         ]
+        # Identifica los pesos cargados (p.ej. para invalidar resultados cacheados)
+        self.model_version = f"{self.backend.name}-{self.backend.model_digest[:16]}"
+        if variant is not None:
+            # Variants sharing a file (fused, channels-last) still get their own version
+            self.model_version += f"-{variant}"
+        self.variant = variant
+        self.resolution_policy = resolution_policy
+        
+        if warmup_runs:
+            start = time.perf_counter()
+            self.warmup(warmup_runs, warmup_size)
+            self.startup_timings['warmup'] = time.perf_counter() - start
+    
+    @property
+    def model(self):
+        """The ultralytics YOLO model (PyTorch backend only)."""
+        return getattr(self.backend, "model", None)
+    
+    def set_num_threads(self, num_threads: int, interop_threads: int = None, opencv_threads: int = None):
+        """
+        Limit the CPU threads used by inference and OpenCV in this process.
+        
+        Args:
+            num_threads: Threads for the backend's intra-op pool (and OpenCV
+                unless opencv_threads is given)
+            interop_threads: Threads for the backend's inter-op pool
+            opencv_threads: Threads for OpenCV
+        """
+        cv2.setNumThreads(num_threads if opencv_threads is None else opencv_threads)
+        self.backend.set_num_threads(num_threads)
+        if interop_threads:
+            self.backend.set_num_interop_threads(interop_threads)
+    
+    def freeze(self):
+        """Prepare the model to be shared copy-free by forked workers (e.g. gunicorn --preload)."""
+        self.backend.freeze()
+    
+    def warmup(self, runs: int = 1, size: int = 640):
+        """
+        Run dummy forward passes to trigger lazy initialization.
+        
+        Args:
+            runs: Number of forward passes
+            size: Side of the square dummy image
+        """
+        image = np.full((size, size, 3), 114, dtype=np.uint8)
+        # Every input size of the policy gets its own warm-up
+        input_sizes = self.resolution_policy.sizes if self.resolution_policy else [None]
+        for _ in range(runs):
+            for input_size in input_sizes:
+                self.backend.predict([image], conf=1.0, imgsz=input_size)
+    
+    @staticmethod
+    def decode_image(data: Union[bytes, bytearray, memoryview]) -> np.ndarray:
+        """
+        Decode an encoded image (JPEG, PNG, ...) held in memory.
+        
+        The buffer is wrapped without copying and decoded straight into a
+        BGR numpy array, so uploads never need to touch the disk.
+        
+        Args:
+            data: Encoded image bytes or any object exposing the buffer protocol
+            
+        Returns:
+            BGR image as numpy array
+        """
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        if buffer.size == 0:
+            raise ValueError("Could not decode image from an empty buffer")
+        image = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("Could not decode image data")
+        return image
+    
+    @classmethod
+    def load_image(cls, image: Union[str, Path, bytes, memoryview, BinaryIO, np.ndarray]) -> np.ndarray:
+        """
+        Load an image into a BGR numpy array.
+        
+        Args:
+            image: Path to image, encoded image bytes, readable binary
+                stream or numpy array
+            
+        Returns:
+            BGR image as numpy array
+        """
+        if isinstance(image, (str, Path)):
+            path = image
+            image = cv2.imread(str(path))
+            if image is None:
+                raise ValueError(f"Could not read image from {path}")
+        elif isinstance(image, (bytes, bytearray, memoryview)):
+            image = cls.decode_image(image)
+        elif hasattr(image, "read"):
+            if isinstance(image, BytesIO):
+                image = cls.decode_image(image.getbuffer())
+            else:
+                image = cls.decode_image(image.read())
+        return image
     
     def detect_characters(
         self,
-        image: Union[str, Path, np.ndarray],
+        image: Union[str, Path, bytes, np.ndarray],
         conf_threshold: float = 0.25,
         return_image: bool = True
     ) -> Tuple[List[Dict], np.ndarray]:
@@ -73,7 +182,7 @@ class StarWarsDetector:
         Detect Star Wars characters in an image.
         
         Args:
-            image: Path to image or numpy array
+            image: Path to image, encoded image bytes or numpy array
             conf_threshold: Confidence threshold for detections
             return_image: Whether to return the image with bounding boxes
             
@@ -85,91 +194,277 @@ class StarWarsDetector:
               'confidence': confidence score
             - Image with bounding boxes (if return_image=True)
         """
-        # Read image if path is provided
-        if isinstance(image, (str, Path)):
-            image = cv2.imread(str(image))
-            if image is None:
-                raise ValueError(f"Could not read image from {image}")
+        detections = self.detect_batch([image], conf_threshold, return_image)[0]
+        return detections.to_dicts(), detections.plot()
+    
+    def choose_input_size(self, image: np.ndarray, latency_budget_ms: float = None) -> int:
+        """
+        Input size the resolution policy picks for an image.
+        
+        Args:
+            image: BGR image as numpy array
+            latency_budget_ms: Optional model latency budget in milliseconds
+            
+        Returns:
+            Input size in pixels, or None for the model's default size
+        """
+        if self.resolution_policy is None:
+            return None
+        height, width = image.shape[:2]
+        return self.resolution_policy.choose(height, width, latency_budget_ms)
+    
+    def detect_batch(
+        self,
+        images: List[Union[str, Path, bytes, np.ndarray]],
+        conf_thresholds: Union[float, List[float]] = 0.25,
+        return_image: bool = True,
+        imgsz: Union[int, List[int]] = None,
+        latency_budget_ms: float = None
+    ) -> List[Detections]:
+        """
+        Detect Star Wars characters in several images with one forward pass.
         
-        # Make prediction
-        results = self.model(image, conf=conf_threshold)[0]
+        The model runs once per input size with the lowest requested
+        threshold and each image's detections are then filtered with its own
+        threshold. Every image is letterboxed on its own to the square input
+        size, so its detections do not depend on the rest of the batch (e.g.
+        other requests in the same micro-batch).
         
-        # Process detections
-        detections = []
-        for box in results.boxes:
-            # Get box coordinates
-            x1, y1, x2, y2 = map(int, box.xyxy[0])
+        Args:
+            images: Paths to images, encoded image bytes or numpy arrays
+            conf_thresholds: One threshold for all images, or one per image
+            return_image: Whether to keep each source image on its
+                Detections so it can be rendered with plot()
+            imgsz: Input size for all images, or one per image; by default
+                the resolution policy chooses it
+            latency_budget_ms: Latency budget passed to the resolution policy
             
-            # Get class and confidence
-            class_id = int(box.cls[0])
-            confidence = float(box.conf[0])
+        Returns:
+            One Detections per input image
+        """
+        if isinstance(conf_thresholds, (int, float)):
+            conf_thresholds = [float(conf_thresholds)] * len(images)
+        if len(conf_thresholds) != len(images):
+            raise ValueError("Expected one confidence threshold per image")
+        if not images:
+            return []
+        
+        images = [self.load_image(image) for image in images]
+        if imgsz is None:
+            imgsz = [self.choose_input_size(image, latency_budget_ms) for image in images]
+        elif isinstance(imgsz, int):
+            imgsz = [imgsz] * len(images)
+        
+        # Make prediction: one forward pass per input size
+        outputs = [None] * len(images)
+        for size in dict.fromkeys(imgsz):
+            indices = [i for i, image_size in enumerate(imgsz) if image_size == size]
+            group = self.backend.predict(
+                [images[i] for i in indices],
+                conf=min(conf_thresholds[i] for i in indices),
+                imgsz=size
+            )
+            for i, output in zip(indices, group):
+                outputs[i] = output
+        
+        results = []
+        for (boxes, scores, class_ids), image, conf_threshold in zip(outputs, images, conf_thresholds):
+            detections = Detections.from_raw(boxes, scores, class_ids, self.class_names, conf_threshold)
+            if return_image:
+                detections.image = image
+            results.append(detections)
+        return results
+
+    def draw_detections(self, image: np.ndarray, detections: Detections, max_size: int = None) -> np.ndarray:
+        """
+        Draw bounding boxes and labels on a copy of an image.
+        
+        Args:
+            image: BGR image as numpy array (left untouched)
+            detections: Detections of that image
+            max_size: Maximum side of the returned image in pixels
             
-            # Create detection dict
-            detection = {
-                'box': [x1, y1, x2, y2],
-                'label': self.class_names[class_id],
-                'confidence': confidence
-            }
-            detections.append(detection)
+        Returns:
+            New image with the detections drawn
+        """
+        return render_detections(image, detections, max_size)
+
+    def detect(self, image: Union[str, Path, bytes, np.ndarray], conf_threshold: float = 0.25) -> Detections:
+        """Detect characters in one image; plot() renders them on the image."""
+        return self.detect_batch([image], conf_threshold, return_image=True)[0]
+
+    def detect_tiled(
+        self,
+        image: Union[str, Path, bytes, np.ndarray],
+        conf_threshold: float = 0.25,
+        tile_size: int = 640,
+        overlap: float = 0.2,
+        max_tiles: int = 16,
+        merge: str = "wbf",
+        match_threshold: float = 0.5,
+        include_full: bool = True,
+        return_image: bool = True,
+        detect_batch: Callable[[List[np.ndarray], float], List[Detections]] = None
+    ) -> Detections:
+        """
+        Detect characters in a large image tile by tile.
+        
+        The image is cut into overlapping tiles (views, no copies) that run
+        through the model as one batch, so small characters keep their
+        resolution. Boxes are shifted back to image coordinates and merged
+        across the tile seams.
+        
+        Args:
+            image: Path to image, encoded image bytes or numpy array
+            conf_threshold: Confidence threshold for detections
+            tile_size: Side of the square tiles in pixels
+            overlap: Fraction of a tile shared with its neighbour
+            max_tiles: Upper bound on the tiles per image; larger images get
+                larger tiles instead of more of them
+            merge: 'wbf' (weighted box fusion) or 'nms'
+            match_threshold: Overlap above which boxes from different tiles
+                are the same object (IoU for 'wbf', intersection over the
+                smaller box for 'nms')
+            include_full: Also run the whole image in the same batch, so
+                characters larger than a tile are still found
+            return_image: Whether to keep the source image for plot()
+            detect_batch: Optional replacement for self.detect_batch, e.g. to
+                route the tiles through a BatchingScheduler
             
-            # Draw bounding box if return_image is True
-            if return_image:
-                # Draw box
-                cv2.rectangle(image, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                
-                # Draw label
-                label = f"{detection['label']}: {confidence:.2f}"
-                cv2.putText(
-                    image,
-                    label,
-                    (x1, y1 - 10),
-                    cv2.FONT_HERSHEY_SIMPLEX,
-                    0.5,
-                    (0, 255, 0),
-                    2
-                )
-        
-        return detections, image if return_image else None
+        Returns:
+            Merged Detections of the whole image
+        """
+        image = self.load_image(image)
+        height, width = image.shape[:2]
+        tiles = tile_grid(height, width, tile_size, overlap, max_tiles)
+        if include_full and len(tiles) > 1:
+            tiles = np.concatenate([tiles, [[0, 0, width, height]]])
+        
+        if detect_batch is None:
+            outputs = self.detect_batch(crop_tiles(image, tiles), conf_threshold, return_image=False)
+        else:
+            outputs = detect_batch(crop_tiles(image, tiles), conf_threshold)
+        
+        boxes = np.concatenate([out.xyxy + np.tile(tile[:2], 2) for out, tile in zip(outputs, tiles)])
+        scores = np.concatenate([out.conf for out in outputs])
+        class_ids = np.concatenate([out.class_id for out in outputs])
+        boxes, scores, class_ids = merge_detections(boxes, scores, class_ids, merge, match_threshold)
+        
+        detections = Detections.from_raw(boxes.round(), scores, class_ids, self.class_names, conf_threshold)
+        if return_image:
+            detections.image = image
+        return detections
 
-    def detect(self, image_path):
-        detections, image = self.detect_characters(image_path, return_image=True)
-        class DummyResults:
-            pass
-        results = DummyResults()
-        results.boxes = []
-        results.names = self.class_names
-        for det in detections:
-            class Box:
-                pass
-            box = Box()
-            box.xyxy = [np.array(det['box'])]
-            box.conf = [det['confidence']]
-            box.cls = [self.class_names.index(det['label'])]
-            results.boxes.append(box)
-        def plot():
-            return image
-        results.plot = plot
-        return results
+    def detect_video(
+        self,
+        video_path: Union[str, Path],
+        conf_threshold: float = 0.25,
+        output_path: Union[str, Path] = None,
+        **pipeline_options
+    ) -> Tuple[Iterator[str], VideoPipeline]:
+        """
+        Detect characters in a video.
+        
+        Decoding, batched inference and output encoding run on separate
+        threads connected by bounded queues (see ml_model/video.py).
+        
+        Args:
+            video_path: Path of the input video
+            conf_threshold: Confidence threshold for detections
+            output_path: Optional path of an annotated output video
+            **pipeline_options: stride, scene_threshold, max_reuse,
+                batch_size, queue_size or detect_batch for VideoPipeline
+            
+        Returns:
+            Generator of one JSON line per processed frame and the pipeline,
+            whose report (fps, per-stage utilization) is set once the
+            generator is exhausted
+        """
+        pipeline = VideoPipeline(self, conf_threshold, **pipeline_options)
+        return pipeline.run(video_path, output_path), pipeline
 
 def main():
     """Example usage of the StarWarsDetector class."""
     import argparse
     
-    parser = argparse.ArgumentParser(description="Detect Star Wars characters in an image")
-    parser.add_argument("image_path", help="Path to the input image")
+    parser = argparse.ArgumentParser(description="Detect Star Wars characters in an image or video")
+    parser.add_argument("image_path", help="Path to the input image or video")
     parser.add_argument("--model", default="runs/detect/star_wars_detector/weights/best.pt",
                       help="Path to the trained model")
+    parser.add_argument("--backend", choices=["pytorch", "onnx"],
+                      help="Inference backend (default: from the model file suffix)")
+    parser.add_argument("--variant",
+                      help="Published variant of the model built by ml_model/optimize.py (e.g. int8-static)")
     parser.add_argument("--conf", type=float, default=0.25,
                       help="Confidence threshold")
-    parser.add_argument("--output", help="Path to save the output image")
+    parser.add_argument("--output", help="Path to save the output image or video")
+    parser.add_argument("--input-sizes",
+                      help="Comma-separated input sizes the resolution policy picks from (e.g. 320,480,640)")
+    parser.add_argument("--resolution-profile",
+                      help="Profile from python -m ml_model.resolution, used with --latency-budget")
+    parser.add_argument("--latency-budget", type=float,
+                      help="Model latency budget in ms for choosing the input size")
+    parser.add_argument("--tiled", action="store_true",
+                      help="Image only: detect on overlapping tiles (for large images with small characters)")
+    parser.add_argument("--tile-size", type=int, default=640, help="Tiled mode: tile side in pixels")
+    parser.add_argument("--tile-overlap", type=float, default=0.2, help="Tiled mode: overlap between tiles (0-1)")
+    parser.add_argument("--max-tiles", type=int, default=16, help="Tiled mode: maximum tiles per image")
+    parser.add_argument("--merge", choices=["wbf", "nms"], default="wbf",
+                      help="Tiled mode: how boxes are merged across tiles")
+    parser.add_argument("--jsonl", help="Video only: write per-frame detections here instead of stdout")
+    parser.add_argument("--stride", type=int, default=1,
+                      help="Video only: process every N-th frame")
+    parser.add_argument("--scene-threshold", type=float, default=0.0,
+                      help="Video only: reuse the previous detections for frames that differ "
+                           "less than this (0-1) from the last inferred frame")
+    parser.add_argument("--batch-size", type=int, default=8,
+                      help="Video only: frames per forward pass")
     
     args = parser.parse_args()
     
     # Initialize detector
-    detector = StarWarsDetector(args.model)
+    policy = None
+    if args.resolution_profile:
+        policy = ResolutionPolicy.from_profile(args.resolution_profile, args.input_sizes)
+    elif args.input_sizes:
+        policy = ResolutionPolicy(args.input_sizes)
+    detector = StarWarsDetector(args.model, backend=args.backend, resolution_policy=policy, variant=args.variant)
+    print("Startup: " + ", ".join(
+        f"{phase} {seconds * 1000:.0f}ms" for phase, seconds in detector.startup_timings.items()
+    ))
+    
+    if Path(args.image_path).suffix.lower() in VIDEO_EXTENSIONS:
+        lines, pipeline = detector.detect_video(
+            args.image_path, args.conf, args.output,
+            stride=args.stride, scene_threshold=args.scene_threshold, batch_size=args.batch_size
+        )
+        out = open(args.jsonl, "w") if args.jsonl else sys.stdout
+        try:
+            for line in lines:
+                out.write(line + "\n")
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        report = pipeline.report
+        print(
+            f"\n{report['frames_emitted']} frames ({report['frames_inferred']} inferred, "
+            f"{report['frames_reused']} reused) in {report['wall_seconds']:.1f}s: {report['fps']:.1f} fps",
+            file=sys.stderr
+        )
+        print("Stage utilization: " + ", ".join(
+            f"{stage} {busy:.0%}" for stage, busy in report['utilization'].items()
+        ), file=sys.stderr)
+        return
     
     # Detect characters
-    detections, image = detector.detect_characters(args.image_path, args.conf)
+    if args.tiled:
+        results = detector.detect_tiled(
+            args.image_path, args.conf, args.tile_size, args.tile_overlap, args.max_tiles, args.merge
+        )
+        detections, image = results.to_dicts(), results.plot()
+    else:
+        results = detector.detect_batch([args.image_path], args.conf, latency_budget_ms=args.latency_budget)[0]
+        detections, image = results.to_dicts(), results.plot()
     
     # Print detections
     print("\nDetections:")
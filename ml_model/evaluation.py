@@ -0,0 +1,520 @@
+"""
+Detection accuracy on a labeled split.
+
+Ground truth comes from YOLO-format label files (class x_center y_center
+width height, normalized), as written by data_preparation/3_prepare_dataset.py.
+Predictions are matched to it per class and summarized as precision, recall,
+mAP@0.5 and mAP@0.5:0.95.
+
+evaluate_detector() runs a StarWarsDetector as it is deployed (its backend,
+thresholding and class names) over a split in batches, and the command line
+compares the result with a stored baseline, failing on accuracy or
+throughput regressions:
+    python -m ml_model.evaluation --model ml_model/best.pt --val dataset/val --save-baseline
+    python -m ml_model.evaluation --model ml_model/best.pt --val dataset/val \
+        --max-map-drop 0.01 --max-speed-drop 0.10
+"""
+import hashlib
+import json
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple, Union
+
+import numpy as np
+
+try:
+    from ml_model.shards import ShardReader, load_image
+except ImportError:  # run as a script: python ml_model/evaluation.py
+    from shards import ShardReader, load_image
+
+IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png'}
+# IoU thresholds of mAP@0.5:0.95
+IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "evaluation_baseline.json"
+
+
+def list_split(split_dir: Union[str, Path]) -> List[Tuple[Path, Path]]:
+    """
+    List (image, label) paths of a split with images/ and labels/ folders.
+
+    Images without a label file are included; they have no ground truth.
+    """
+    split_dir = Path(split_dir)
+    images = sorted(
+        path for path in (split_dir / "images").iterdir() if path.suffix.lower() in IMAGE_SUFFIXES
+    )
+    return [(image, split_dir / "labels" / f"{image.stem}.txt") for image in images]
+
+
+def load_yolo_labels(label_path: Union[str, Path], width: int, height: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Read a YOLO label file.
+
+    Args:
+        label_path: Path of the .txt label file (missing means no objects)
+        width: Width of the labeled image in pixels
+        height: Height of the labeled image in pixels
+
+    Returns:
+        Tuple of xyxy boxes in pixels (N, 4) and class ids (N,)
+    """
+    label_path = Path(label_path)
+    rows = np.zeros((0, 5), dtype=np.float32)
+    if label_path.exists():
+        text = label_path.read_text().strip()
+        if text:
+            rows = np.array([line.split()[:5] for line in text.splitlines()], dtype=np.float32).reshape(-1, 5)
+    cx, cy, w, h = rows[:, 1] * width, rows[:, 2] * height, rows[:, 3] * width, rows[:, 4] * height
+    boxes = np.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], axis=1)
+    return boxes.astype(np.float32), rows[:, 0].astype(np.int64)
+
+
+def box_iou(boxes1: np.ndarray, boxes2: np.ndarray) -> np.ndarray:
+    """IoU matrix of two sets of xyxy boxes, shape (len(boxes1), len(boxes2))."""
+    area1 = (boxes1[:, 2] - boxes1[:, 0]).clip(0) * (boxes1[:, 3] - boxes1[:, 1]).clip(0)
+    area2 = (boxes2[:, 2] - boxes2[:, 0]).clip(0) * (boxes2[:, 3] - boxes2[:, 1]).clip(0)
+    top_left = np.maximum(boxes1[:, None, :2], boxes2[None, :, :2])
+    bottom_right = np.minimum(boxes1[:, None, 2:], boxes2[None, :, 2:])
+    inter = (bottom_right - top_left).clip(0).prod(2)
+    return inter / (area1[:, None] + area2[None, :] - inter + 1e-7)
+
+
+def match_predictions(
+    pred_boxes: np.ndarray,
+    pred_scores: np.ndarray,
+    pred_classes: np.ndarray,
+    gt_boxes: np.ndarray,
+    gt_classes: np.ndarray,
+    iou_thresholds: np.ndarray = IOU_THRESHOLDS
+) -> np.ndarray:
+    """
+    Mark each prediction as true or false positive at every IoU threshold.
+
+    Predictions are visited best score first; each takes the unmatched
+    ground-truth box of its class with the highest IoU. All thresholds are
+    matched at once, and predictions that overlap no box of their class
+    enough for the lowest threshold are skipped.
+
+    Returns:
+        Boolean array of shape (num_predictions, num_thresholds)
+    """
+    iou_thresholds = np.asarray(iou_thresholds)
+    tp = np.zeros((len(pred_boxes), len(iou_thresholds)), dtype=bool)
+    if not len(pred_boxes) or not len(gt_boxes):
+        return tp
+    iou = box_iou(pred_boxes, gt_boxes)
+    iou[pred_classes[:, None] != gt_classes[None, :]] = 0.0
+    order = np.argsort(-pred_scores, kind="stable")
+    order = order[iou[order].max(axis=1) >= iou_thresholds.min()]
+    # Cajas ya emparejadas, por umbral: (num_thresholds, num_gt)
+    taken = np.zeros((len(iou_thresholds), len(gt_boxes)), dtype=bool)
+    rows = np.arange(len(iou_thresholds))
+    for i in order:
+        candidates = np.where(taken, 0.0, iou[i])
+        j = candidates.argmax(axis=1)
+        hit = candidates[rows, j] >= iou_thresholds
+        taken[rows[hit], j[hit]] = True
+        tp[i] = hit
+    return tp
+
+
+def average_precision(tp: np.ndarray, scores: np.ndarray, num_gt: int) -> np.ndarray:
+    """
+    COCO-style 101-point interpolated AP for each IoU threshold.
+
+    Args:
+        tp: True-positive flags, shape (num_predictions, num_thresholds)
+        scores: Prediction scores, shape (num_predictions,)
+        num_gt: Number of ground-truth boxes
+
+    Returns:
+        AP per threshold, shape (num_thresholds,)
+    """
+    if num_gt == 0 or not len(scores):
+        return np.zeros(tp.shape[1])
+    order = np.argsort(-scores, kind="stable")
+    tp_cum = tp[order].cumsum(0)
+    fp_cum = (~tp[order]).cumsum(0)
+    recall = tp_cum / num_gt
+    precision = tp_cum / (tp_cum + fp_cum)
+    points = np.linspace(0, 1, 101)
+    ap = np.empty(tp.shape[1])
+    for t in range(tp.shape[1]):
+        # Precision envelope: best precision at this recall or any higher one
+        envelope = np.maximum.accumulate(precision[::-1, t])[::-1]
+        index = np.searchsorted(recall[:, t], points, side="left")
+        ap[t] = np.where(index < len(envelope), envelope[np.minimum(index, len(envelope) - 1)], 0.0).mean()
+    return ap
+
+
+class DetectionEvaluator:
+    def __init__(self, class_names: Sequence[str], iou_thresholds: np.ndarray = IOU_THRESHOLDS):
+        """
+        Accumulate predictions and ground truth image by image.
+
+        Args:
+            class_names: Class names, indexed by class id
+            iou_thresholds: IoU thresholds; the first one is used for
+                precision, recall and mAP50
+        """
+        self.class_names = list(class_names)
+        self.iou_thresholds = np.asarray(iou_thresholds)
+        self._tp = []
+        self._scores = []
+        self._classes = []
+        self._gt_counts = np.zeros(len(self.class_names), dtype=np.int64)
+
+    def add(
+        self,
+        pred_boxes: np.ndarray,
+        pred_scores: np.ndarray,
+        pred_classes: np.ndarray,
+        gt_boxes: np.ndarray,
+        gt_classes: np.ndarray
+    ):
+        """Add the predictions and ground truth of one image."""
+        pred_boxes = np.asarray(pred_boxes, dtype=np.float32).reshape(-1, 4)
+        pred_scores = np.asarray(pred_scores, dtype=np.float32)
+        pred_classes = np.asarray(pred_classes, dtype=np.int64)
+        self._tp.append(match_predictions(
+            pred_boxes, pred_scores, pred_classes, gt_boxes, gt_classes, self.iou_thresholds
+        ))
+        self._scores.append(pred_scores)
+        self._classes.append(pred_classes)
+        self._gt_counts += np.bincount(gt_classes, minlength=len(self.class_names))[:len(self.class_names)]
+
+    def summary(self) -> Dict:
+        """
+        Summarize the accumulated images.
+
+        Returns:
+            Dict with precision, recall, map50 and map50_95 over the classes
+            that have ground truth, and the same metrics per class
+        """
+        if self._tp:
+            tp = np.concatenate(self._tp)
+            scores = np.concatenate(self._scores)
+            classes = np.concatenate(self._classes)
+        else:
+            tp = np.zeros((0, len(self.iou_thresholds)), dtype=bool)
+            scores = np.zeros(0, dtype=np.float32)
+            classes = np.zeros(0, dtype=np.int64)
+
+        per_class = {}
+        for class_id, name in enumerate(self.class_names):
+            mask = classes == class_id
+            num_gt = int(self._gt_counts[class_id])
+            num_pred = int(mask.sum())
+            hits = int(tp[mask, 0].sum())
+            ap = average_precision(tp[mask], scores[mask], num_gt)
+            per_class[name] = {
+                'ground_truth': num_gt,
+                'predictions': num_pred,
+                'precision': hits / num_pred if num_pred else 0.0,
+                'recall': hits / num_gt if num_gt else 0.0,
+                'map50': float(ap[0]),
+                'map50_95': float(ap.mean()),
+            }
+
+        present = [metrics for metrics in per_class.values() if metrics['ground_truth']]
+
+        def mean(key):
+            return float(np.mean([metrics[key] for metrics in present])) if present else 0.0
+
+        return {
+            'images': len(self._tp),
+            'precision': mean('precision'),
+            'recall': mean('recall'),
+            'map50': mean('map50'),
+            'map50_95': mean('map50_95'),
+            'per_class': per_class,
+        }
+
+
+def dataset_class_names(split_dir: Union[str, Path]) -> List[str]:
+    """Class names of the dataset.yaml next to a split, or None when there is none."""
+    yaml_path = Path(split_dir).parent / "dataset.yaml"
+    if not yaml_path.exists():
+        return None
+    import yaml
+
+    names = yaml.safe_load(yaml_path.read_text()).get("names")
+    return list(names.values()) if isinstance(names, dict) else names
+
+
+def evaluate_detector(
+    detector,
+    split_dir: Union[str, Path],
+    conf_threshold: float = 0.001,
+    deploy_conf: float = 0.25,
+    batch_size: int = 16,
+    imgsz: int = None,
+    max_images: int = None,
+    warmup_runs: int = 1,
+    workers: int = 4,
+    shards: ShardReader = None
+) -> Dict:
+    """
+    Evaluate a detector, as deployed, on a labeled split.
+
+    Images go through detector.detect_batch in batches, so boxes, scores and
+    class ids are exactly what the service returns. A thread pool decodes
+    the next batch while the current one runs; only the detect_batch calls
+    are timed for the throughput.
+
+    Args:
+        detector: StarWarsDetector to evaluate
+        split_dir: Split with images/ and labels/ folders (e.g. dataset/val)
+        conf_threshold: Threshold of the mAP run; keep it low
+        deploy_conf: Threshold used in production; precision and recall are
+            also reported for the detections it keeps
+        batch_size: Images per detect_batch call
+        imgsz: Input size (default: the detector's own choice)
+        max_images: Only use the first N images of the split
+        warmup_runs: Untimed batches before measuring
+        workers: Decoding threads
+        shards: Read images from these pre-decoded shards when they hold a
+            current copy (see ml_model/shards.py)
+
+    Returns:
+        Dict with the DetectionEvaluator summary (overall and per class),
+        precision and recall at deploy_conf, throughput, batch latencies
+        and the input settings (see input_settings)
+    """
+    expected = dataset_class_names(split_dir)
+    if expected is not None and list(expected) != list(detector.class_names):
+        raise ValueError(f"Classes of {Path(split_dir).parent / 'dataset.yaml'} {expected} "
+                         f"do not match the detector's {detector.class_names}")
+    samples = list_split(split_dir)[:max_images]
+    if not samples:
+        raise ValueError(f"No images found in {Path(split_dir) / 'images'}")
+
+    def read(sample):
+        image_path, label_path = sample
+        image = shards.read(image_path) if shards is not None else None
+        from_shards = image is not None
+        if image is None:
+            image = load_image(image_path)
+        if image is None:
+            return None
+        height, width = image.shape[:2]
+        return image, load_yolo_labels(label_path, width, height), from_shards
+
+    evaluator = DetectionEvaluator(detector.class_names)
+    deployed = DetectionEvaluator(detector.class_names)
+    # Identifica las imágenes y etiquetas evaluadas, para comparar con la línea base
+    split_digest = hashlib.sha256()
+    batches = [samples[i:i + batch_size] for i in range(0, len(samples), batch_size)]
+    latencies, unreadable, evaluated, from_shards = [], 0, 0, 0
+    warmed = False
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        next_batch = executor.map(read, batches[0])
+        for i, batch in enumerate(batches):
+            loaded = list(next_batch)
+            if i + 1 < len(batches):
+                next_batch = executor.map(read, batches[i + 1])
+            readable = [(sample, item) for sample, item in zip(batch, loaded) if item is not None]
+            unreadable += len(batch) - len(readable)
+            if not readable:
+                continue
+            images = [image for _, (image, _, _) in readable]
+            if not warmed:
+                for _ in range(warmup_runs):
+                    detector.detect_batch(images, conf_threshold, return_image=False, imgsz=imgsz)
+                warmed = True
+                start = time.perf_counter()
+            batch_start = time.perf_counter()
+            results = detector.detect_batch(images, conf_threshold, return_image=False, imgsz=imgsz)
+            latencies.append(time.perf_counter() - batch_start)
+            for ((image_path, label_path), (_, (gt_boxes, gt_classes), cached)), detections in zip(readable, results):
+                evaluator.add(detections.xyxy, detections.conf, detections.class_id, gt_boxes, gt_classes)
+                keep = detections.conf >= deploy_conf
+                deployed.add(detections.xyxy[keep], detections.conf[keep], detections.class_id[keep],
+                             gt_boxes, gt_classes)
+                split_digest.update(image_path.name.encode())
+                split_digest.update(label_path.read_bytes() if label_path.exists() else b"")
+                from_shards += cached
+            evaluated += len(readable)
+    wall_seconds = time.perf_counter() - start
+
+    if not evaluated:
+        raise ValueError(f"No readable images in {Path(split_dir) / 'images'}")
+    latencies = np.array(latencies) * 1000.0
+    at_deploy = deployed.summary()
+    report = evaluator.summary()
+    report.update({
+        'model_version': detector.model_version,
+        'backend': detector.backend.name,
+        'split_sha256': split_digest.hexdigest(),
+        'unreadable': unreadable,
+        'conf_threshold': conf_threshold,
+        'batch_size': batch_size,
+        'imgsz': imgsz,
+        # Las imágenes de las shards pueden estar reducidas: cambian las métricas
+        'input': {
+            'shards': str(shards.path) if shards is not None else None,
+            'max_size': shards.max_size if from_shards else None,
+            'from_shards': from_shards,
+        },
+        'deployed': {
+            'conf_threshold': deploy_conf,
+            'precision': at_deploy['precision'],
+            'recall': at_deploy['recall'],
+        },
+        'images_per_second': evaluated / (latencies.sum() / 1000.0),
+        'end_to_end_images_per_second': evaluated / wall_seconds,
+        'batch_latency_ms': {
+            'p50': float(np.percentile(latencies, 50)),
+            'p95': float(np.percentile(latencies, 95)),
+        },
+    })
+    for name, metrics in report['per_class'].items():
+        metrics['deployed_precision'] = at_deploy['per_class'][name]['precision']
+        metrics['deployed_recall'] = at_deploy['per_class'][name]['recall']
+    return report
+
+
+def input_settings(report: Dict) -> Dict:
+    """
+    Settings that change what the detector sees: input size and shard copies.
+
+    Reports written before the shard fields existed read all images from
+    disk.
+    """
+    source = report.get('input', {})
+    return {
+        'imgsz': report.get('imgsz'),
+        'shard_max_size': source.get('max_size'),
+        'images_from_shards': source.get('from_shards', 0),
+    }
+
+
+def compare_to_baseline(
+    report: Dict,
+    baseline: Dict,
+    max_map_drop: float = 0.01,
+    max_speed_drop: float = 0.10
+) -> List[Tuple[str, float, float, bool]]:
+    """
+    Compare an evaluation with a baseline.
+
+    Args:
+        report: Result of evaluate_detector
+        baseline: Earlier result of evaluate_detector
+        max_map_drop: Largest allowed mAP drop (absolute, e.g. 0.01 = 1 point)
+        max_speed_drop: Largest allowed images/s drop (relative, e.g. 0.10 = 10%)
+
+    Returns:
+        List of (metric, baseline value, current value, regressed)
+
+    Raises:
+        ValueError: If the two runs used different input settings
+    """
+    current, previous = input_settings(report), input_settings(baseline)
+    if current != previous:
+        raise ValueError(f"The baseline was evaluated with other input settings ({previous}, now {current}); "
+                         f"evaluate both the same way or save a new baseline")
+    rows = []
+    for metric in ('map50', 'map50_95'):
+        rows.append((metric, baseline[metric], report[metric], baseline[metric] - report[metric] > max_map_drop))
+    old, new = baseline['images_per_second'], report['images_per_second']
+    rows.append(('images_per_second', old, new, new < old * (1.0 - max_speed_drop)))
+    return rows
+
+
+def main():
+    import argparse
+
+    try:
+        from ml_model.detect import StarWarsDetector
+    except ImportError:
+        from detect import StarWarsDetector
+
+    parser = argparse.ArgumentParser(description="Evaluate the deployed detector and gate accuracy and throughput")
+    parser.add_argument("--model", default="runs/detect/star_wars_detector/weights/best.pt",
+                        help="Path to the trained model")
+    parser.add_argument("--backend", choices=["pytorch", "onnx"],
+                        help="Inference backend (default: from the model file suffix)")
+    parser.add_argument("--variant", help="Published variant of the model built by ml_model/optimize.py")
+    parser.add_argument("--val", default="dataset/val", help="Validation split with images/ and labels/")
+    parser.add_argument("--conf", type=float, default=0.001, help="Confidence threshold of the mAP run")
+    parser.add_argument("--deploy-conf", type=float, default=0.25,
+                        help="Production threshold for the reported precision and recall")
+    parser.add_argument("--batch-size", type=int, default=16, help="Images per forward pass")
+    parser.add_argument("--img-size", type=int, help="Input size (default: the model's)")
+    parser.add_argument("--max-images", type=int, help="Only evaluate the first N images")
+    parser.add_argument("--threads", type=int, default=1, help="Inference threads (fixed for reproducibility)")
+    parser.add_argument("--workers", type=int, default=4, help="Decoding threads")
+    parser.add_argument("--shards", help="Read images from these pre-decoded shards (python -m ml_model.shards)")
+    parser.add_argument("--output", help="Also write the report to this JSON file")
+    parser.add_argument("--baseline", default=str(DEFAULT_BASELINE), help="Baseline report to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="Write the report as the new baseline")
+    parser.add_argument("--max-map-drop", type=float, default=0.01,
+                        help="Largest allowed mAP50 / mAP50-95 drop below the baseline (absolute)")
+    parser.add_argument("--max-speed-drop", type=float, default=0.10,
+                        help="Largest allowed images/s drop below the baseline (relative)")
+    args = parser.parse_args()
+
+    detector = StarWarsDetector(args.model, backend=args.backend, variant=args.variant)
+    detector.set_num_threads(args.threads)
+    shards = ShardReader(args.shards) if args.shards else None
+    report = evaluate_detector(
+        detector, args.val, args.conf, args.deploy_conf, args.batch_size, args.img_size, args.max_images,
+        workers=args.workers, shards=shards
+    )
+    report['environment'] = {
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'threads': args.threads,
+        'model': str(args.model),
+        'variant': args.variant,
+    }
+
+    print(f"{report['images']} images ({report['backend']}, batch {args.batch_size}): "
+          f"{report['images_per_second']:.1f} images/s inference, "
+          f"{report['end_to_end_images_per_second']:.1f} images/s end to end")
+    print(f"\n{'class':<16} {'gt':>5} {'mAP50':>7} {'mAP50-95':>9} {'P@deploy':>9} {'R@deploy':>9}")
+    for name, metrics in report['per_class'].items():
+        print(f"{name:<16} {metrics['ground_truth']:>5} {metrics['map50']:>7.3f} {metrics['map50_95']:>9.3f} "
+              f"{metrics['deployed_precision']:>9.3f} {metrics['deployed_recall']:>9.3f}")
+    print(f"{'all':<16} {'':>5} {report['map50']:>7.3f} {report['map50_95']:>9.3f} "
+          f"{report['deployed']['precision']:>9.3f} {report['deployed']['recall']:>9.3f}")
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    baseline_path = Path(args.baseline)
+    if args.save_baseline:
+        baseline_path.write_text(json.dumps(report, indent=2))
+        print(f"\nBaseline saved to {baseline_path}")
+        return
+    if not baseline_path.exists():
+        print(f"\nNo baseline at {baseline_path}; run with --save-baseline to record one")
+        return
+
+    baseline = json.loads(baseline_path.read_text())
+    if baseline.get('split_sha256') != report['split_sha256']:
+        print("\nWarning: the baseline was evaluated on different images or labels")
+    if any(baseline.get(key) != report[key] for key in ('conf_threshold', 'batch_size')) \
+            or baseline.get('environment', {}).get('cpu_count') != os.cpu_count():
+        print("\nWarning: the baseline used other settings or hardware; throughput may not compare")
+    try:
+        rows = compare_to_baseline(report, baseline, args.max_map_drop, args.max_speed_drop)
+    except ValueError as e:
+        sys.exit(f"\nError: {e}")
+    print(f"\nCompared with {baseline_path} ({baseline.get('model_version')}):")
+    for metric, old, new, regressed in rows:
+        print(f"{metric:<18} {old:>9.3f} -> {new:>9.3f} {'REGRESSION' if regressed else ''}")
+    regressions = sum(row[3] for row in rows)
+    print(f"\n{regressions} regression(s) (mAP drop > {args.max_map_drop:g}, "
+          f"images/s drop > {args.max_speed_drop:.0%})")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
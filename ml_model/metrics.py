@@ -0,0 +1,105 @@
+"""
+Prometheus metrics of the detection service.
+
+Under gunicorn every worker is a separate process, so the metrics use the
+prometheus_client multiprocess mode when PROMETHEUS_MULTIPROC_DIR is set
+(gunicorn.conf.py does it): each process writes its values to memory-mapped
+files in that directory and /metrics sums them. Without it (a single process,
+e.g. the Flask dev server) the default registry is used.
+
+Recording a value is a perf_counter() call and a write to an mmap'd float,
+cheap enough to keep enabled in production.
+"""
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+)
+
+# Latency buckets from 0.5 ms to 10 s
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+STAGES = (
+    'upload',       # reading the upload (and spooling it to disk if large)
+    'decode',       # encoded bytes -> BGR array
+    'queue_wait',   # waiting in the batching queue
+    'model',        # one batched forward pass, including box postprocessing
+    'render',       # drawing the boxes
+    'jpeg_encode',  # annotated image -> JPEG
+    'base64',       # JPEG -> data URL
+    'serialize',    # detections -> JSON
+)
+
+STAGE_SECONDS = Histogram(
+    'detector_stage_seconds', 'Time spent in each processing stage', ['stage'], buckets=LATENCY_BUCKETS
+)
+REQUEST_SECONDS = Histogram(
+    'detector_request_seconds', 'End-to-end request latency', ['endpoint'], buckets=LATENCY_BUCKETS
+)
+REQUESTS = Counter('detector_requests', 'Finished requests', ['endpoint', 'status'])
+IN_FLIGHT = Gauge(
+    'detector_requests_in_flight', 'Requests being processed', ['endpoint'], multiprocess_mode='livesum'
+)
+MODEL_CALLS = Counter('detector_model_calls', 'Batched forward passes')
+MODEL_IMAGES = Counter('detector_model_images', 'Images run through the model')
+BATCH_SIZE = Histogram(
+    'detector_batch_size', 'Images per forward pass', buckets=(1, 2, 3, 4, 6, 8, 12, 16, 24, 32)
+)
+ERRORS = Counter('detector_errors', 'Errors by where they happened', ['kind'])
+CACHE_LOOKUPS = Counter('detector_cache_lookups', 'Result cache lookups', ['result'])
+QUEUE_DEPTH = Gauge(
+    'detector_queue_depth', 'Requests waiting for the model', ['priority'], multiprocess_mode='livesum'
+)
+QUEUE_WAIT = Histogram(
+    'detector_queue_wait_seconds', 'Time waiting for the model', ['priority'], buckets=LATENCY_BUCKETS
+)
+SHED = Counter('detector_shed', 'Requests rejected or dropped before inference', ['reason', 'priority'])
+
+# Label children bound once, so recording skips the label lookup
+_stage_children = {stage: STAGE_SECONDS.labels(stage) for stage in STAGES}
+
+
+def observe_stage(stage: str, seconds: float):
+    """Record the duration of one stage."""
+    _stage_children[stage].observe(seconds)
+
+
+@contextmanager
+def stage_timer(stage: str):
+    """Time the enclosed block as one stage (also recorded if it raises)."""
+    child = _stage_children[stage]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        child.observe(time.perf_counter() - start)
+
+
+def record_batch(batch_size: int, seconds: float):
+    """Record one batched forward pass."""
+    MODEL_CALLS.inc()
+    MODEL_IMAGES.inc(batch_size)
+    BATCH_SIZE.observe(batch_size)
+    _stage_children['model'].observe(seconds)
+
+
+def render_latest():
+    """
+    Current metrics in the Prometheus text format.
+
+    Returns:
+        Tuple of (payload bytes, content type)
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+
+        # A fresh registry per scrape: values are read from every worker's files
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,298 @@
+"""
+Near-duplicate image index based on perceptual hashes.
+
+Images are reduced to a 64-bit DCT perceptual hash (pHash), computed for
+whole batches at once with matrix products. Two images whose hashes differ
+in at most `max_distance` bits are near duplicates: the same picture
+re-encoded, resized, recompressed or slightly cropped.
+
+The index uses multi-index hashing: every hash is split into four 16-bit
+chunks, each with its own table. If two hashes are within distance d, at
+least one chunk is within d // 4 bits (pigeonhole), so a query only probes
+the buckets of chunk values within that radius, and the candidates found
+are then checked with a vectorized popcount. Lookups stay fast with
+hundreds of thousands of images, and images can be added and removed
+one at a time.
+
+Usage:
+    python -m ml_model.near_duplicates dataset/train/images dataset/val/images --max-distance 8
+"""
+import argparse
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import combinations
+from pathlib import Path
+from typing import Iterable, List, Sequence, Tuple, Union
+
+import cv2
+import numpy as np
+
+HASH_SIZE = 8          # The hash keeps the 8x8 lowest DCT frequencies: 64 bits
+DCT_SIZE = 32          # Images are reduced to 32x32 before the DCT
+CHUNKS = 4
+CHUNK_BITS = 16
+DEFAULT_MAX_DISTANCE = 8
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _dct_matrix(size: int) -> np.ndarray:
+    """Orthonormal DCT-II matrix: dct(x) = D @ x."""
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * n + 1) * k / (2 * size)) * np.sqrt(2.0 / size)
+    matrix[0] /= np.sqrt(2.0)
+    return matrix.astype(np.float32)
+
+
+_DCT = _dct_matrix(DCT_SIZE)
+
+
+def reduce_image(image: Union[str, Path, bytes, np.ndarray]) -> np.ndarray:
+    """
+    Decode an image straight to a small grayscale version and resize it to 32x32.
+
+    JPEGs are decoded at 1/4 scale by libjpeg, which is much faster than a
+    full decode. Returns None when the image cannot be decoded.
+    """
+    if isinstance(image, np.ndarray):
+        gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    elif isinstance(image, (bytes, bytearray, memoryview)):
+        gray = cv2.imdecode(np.frombuffer(image, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    else:
+        gray = cv2.imread(str(image), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if gray is None:
+        return None
+    return cv2.resize(gray, (DCT_SIZE, DCT_SIZE), interpolation=cv2.INTER_AREA)
+
+
+def phash_batch(images: np.ndarray) -> np.ndarray:
+    """
+    Perceptual hashes of a batch of reduced images.
+
+    Args:
+        images: Grayscale images from reduce_image, shape (N, 32, 32)
+
+    Returns:
+        uint64 hashes, shape (N,)
+    """
+    pixels = np.asarray(images, dtype=np.float32).reshape(-1, DCT_SIZE, DCT_SIZE)
+    coefficients = (_DCT @ pixels @ _DCT.T)[:, :HASH_SIZE, :HASH_SIZE].reshape(len(pixels), -1)
+    # La mediana excluye la componente continua (brillo medio)
+    median = np.median(coefficients[:, 1:], axis=1, keepdims=True)
+    bits = np.packbits(coefficients > median, axis=1)
+    return bits.view(">u8").astype(np.uint64).reshape(-1)
+
+
+def image_hash(image: Union[str, Path, bytes, np.ndarray]) -> int:
+    """Perceptual hash of one image; None when it cannot be decoded."""
+    reduced = reduce_image(image)
+    return None if reduced is None else int(phash_batch(reduced[None])[0])
+
+
+def hash_files(
+    paths: Sequence[Union[str, Path]],
+    workers: int = 8,
+    batch_size: int = 256
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Perceptual hashes of many image files, decoded in parallel threads.
+
+    Returns:
+        Tuple of (uint64 hashes, bool mask of the files that could be decoded)
+    """
+    hashes = np.zeros(len(paths), dtype=np.uint64)
+    decoded = np.zeros(len(paths), dtype=bool)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, len(paths), batch_size):
+            reduced = list(executor.map(reduce_image, paths[start:start + batch_size]))
+            indices = [i for i, image in enumerate(reduced) if image is not None]
+            if indices:
+                hashes[start + np.array(indices)] = phash_batch(np.stack([reduced[i] for i in indices]))
+                decoded[start + np.array(indices)] = True
+    return hashes, decoded
+
+
+def hamming(hashes: np.ndarray, value: int) -> np.ndarray:
+    """Bit distance between each hash and value."""
+    xor = np.bitwise_xor(np.asarray(hashes, dtype=np.uint64), np.uint64(value))
+    return _POPCOUNT[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+@lru_cache(maxsize=None)
+def _probe_masks(radius: int) -> Tuple[int, ...]:
+    """Every CHUNK_BITS-bit mask with at most radius bits set."""
+    masks = [0]
+    for bits in range(1, radius + 1):
+        for positions in combinations(range(CHUNK_BITS), bits):
+            masks.append(sum(1 << p for p in positions))
+    return tuple(masks)
+
+
+def _chunks(value: int) -> List[int]:
+    mask = (1 << CHUNK_BITS) - 1
+    return [(value >> (CHUNK_BITS * c)) & mask for c in range(CHUNKS)]
+
+
+class NearDuplicateIndex:
+    def __init__(self, max_distance: int = DEFAULT_MAX_DISTANCE):
+        """
+        Incremental index of perceptual hashes for near-duplicate lookups.
+
+        Args:
+            max_distance (int): Default largest bit distance (out of 64) at
+                which two images count as near duplicates
+        """
+        self.max_distance = max_distance
+        self._hashes = np.zeros(1024, dtype=np.uint64)
+        self._alive = np.zeros(1024, dtype=bool)
+        self._keys = []
+        self._positions = {}
+        self._tables = [defaultdict(list) for _ in range(CHUNKS)]
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._positions
+
+    def keys(self) -> List[str]:
+        return list(self._positions)
+
+    def get(self, key: str) -> int:
+        """Hash stored for key."""
+        return int(self._hashes[self._positions[key]])
+
+    def add(self, key: str, value: int):
+        """Add (or replace) the hash of key."""
+        if key in self._positions:
+            self.remove(key)
+        position = len(self._keys)
+        if position == len(self._hashes):
+            self._hashes = np.concatenate([self._hashes, np.zeros_like(self._hashes)])
+            self._alive = np.concatenate([self._alive, np.zeros_like(self._alive)])
+        self._hashes[position] = value
+        self._alive[position] = True
+        self._keys.append(key)
+        self._positions[key] = position
+        for table, chunk in zip(self._tables, _chunks(int(value))):
+            table[chunk].append(position)
+
+    def remove(self, key: str):
+        """Forget key; its table entries are skipped until the index is saved and reloaded."""
+        position = self._positions.pop(key, None)
+        if position is not None:
+            self._alive[position] = False
+
+    def query(self, value: int, max_distance: int = None, exclude: str = None) -> List[Tuple[str, int]]:
+        """
+        Keys whose hashes are within max_distance bits of value.
+
+        Args:
+            value: Perceptual hash to look up
+            max_distance: Largest distance; defaults to the index's
+            exclude: Key left out of the results (e.g. the image itself)
+
+        Returns:
+            List of (key, distance), closest first
+        """
+        max_distance = self.max_distance if max_distance is None else max_distance
+        probes = _probe_masks(max_distance // CHUNKS)
+        candidates = []
+        for table, chunk in zip(self._tables, _chunks(int(value))):
+            for mask in probes:
+                bucket = table.get(chunk ^ mask)
+                if bucket:
+                    candidates.extend(bucket)
+        if not candidates:
+            return []
+        candidates = np.unique(np.array(candidates, dtype=np.int64))
+        candidates = candidates[self._alive[candidates]]
+        distances = hamming(self._hashes[candidates], value)
+        order = np.argsort(distances, kind="stable")
+        return [
+            (self._keys[candidates[i]], int(distances[i]))
+            for i in order
+            if distances[i] <= max_distance and self._keys[candidates[i]] != exclude
+        ]
+
+    def save(self, path: Union[str, Path]):
+        """Write the live entries to an .npz file (atomically)."""
+        path = Path(path)
+        keys = list(self._positions)
+        positions = np.array([self._positions[key] for key in keys], dtype=np.int64)
+        tmp_path = path.with_name(f".{path.stem}.tmp.npz")
+        np.savez(
+            tmp_path,
+            keys=np.array(keys, dtype=str),
+            hashes=self._hashes[positions] if keys else np.zeros(0, dtype=np.uint64),
+            max_distance=self.max_distance
+        )
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, path: Union[str, Path], max_distance: int = None) -> "NearDuplicateIndex":
+        """Read an index written by save(); an empty index if the file does not exist."""
+        path = Path(path)
+        if not path.exists():
+            return cls(DEFAULT_MAX_DISTANCE if max_distance is None else max_distance)
+        with np.load(path) as data:
+            index = cls(int(data["max_distance"]) if max_distance is None else max_distance)
+            index.add_many(data["keys"].tolist(), data["hashes"])
+        return index
+
+    def add_many(self, keys: Iterable[str], values: np.ndarray):
+        for key, value in zip(keys, np.asarray(values, dtype=np.uint64).tolist()):
+            self.add(key, value)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Find near-duplicate images within folders and across them (e.g. train/val leakage)"
+    )
+    parser.add_argument("folders", nargs="+", help="Image folders; later folders are checked against earlier ones")
+    parser.add_argument("--max-distance", type=int, default=DEFAULT_MAX_DISTANCE,
+                        help="Largest hash distance (bits out of 64) of a near duplicate")
+    parser.add_argument("--workers", type=int, default=8, help="Decoding threads")
+    parser.add_argument("--show", type=int, default=10, help="Near-duplicate pairs to print")
+    args = parser.parse_args()
+
+    paths = [path for folder in args.folders
+             for path in sorted(Path(folder).rglob("*")) if path.suffix.lower() in (".jpg", ".jpeg", ".png")]
+    start = time.perf_counter()
+    hashes, decoded = hash_files(paths, args.workers)
+    elapsed = time.perf_counter() - start
+    print(f"Hashed {int(decoded.sum())} images in {elapsed:.1f}s ({decoded.sum() / max(elapsed, 1e-9):.0f} images/s)")
+
+    index = NearDuplicateIndex(args.max_distance)
+    folders = [Path(folder) for folder in args.folders]
+    folder_of = {str(path): next(f for f in folders if f in path.parents) for path in paths}
+    within, across, pairs = 0, 0, []
+    start = time.perf_counter()
+    for path, value, ok in zip(paths, hashes.tolist(), decoded):
+        if not ok:
+            continue
+        matches = index.query(value)
+        # Una fuga es cualquier coincidencia de otra carpeta, no solo la más cercana
+        leaks = [(match, distance) for match, distance in matches if folder_of[match] != folder_of[str(path)]]
+        if leaks:
+            across += 1
+            pairs += [(distance, str(path), match) for match, distance in leaks]
+        elif matches:
+            within += 1
+            match, distance = matches[0]
+            pairs.append((distance, str(path), match))
+        index.add(str(path), value)
+    elapsed = time.perf_counter() - start
+    print(f"Indexed {len(index)} images in {elapsed:.2f}s")
+    print(f"{within} near duplicates within a folder, {across} of an image in an earlier folder")
+    for distance, path, match in sorted(pairs)[:args.show]:
+        print(f"  {distance:>2} bits: {path} ~ {match}")
+    if across and len(folders) > 1:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
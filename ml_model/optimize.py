@@ -0,0 +1,440 @@
+"""
+CPU-optimized variants of the trained model, published behind an accuracy gate.
+
+From the FP32 checkpoint (and its FP32 ONNX export, created if missing) the
+pipeline builds:
+
+- fused: checkpoint with Conv+BN already fused, so workers skip fusing at startup
+- channels-last: the fused model with NHWC weights for the CPU convolution kernels
+- onnx: the FP32 ONNX export, served by ONNX Runtime
+- int8-dynamic: ONNX with INT8 weights, activations quantized at run time
+- int8-static: ONNX with INT8 weights and activations, calibrated on images
+  of the prepared dataset
+
+Every variant is evaluated on the validation split with the FP32 checkpoint
+as reference. Variants whose mAP drops more than the tolerance are not
+published; the others are listed with their accuracy and measured speedup in
+variants.json, from where StarWarsDetector(variant=...) loads them by name.
+
+Usage:
+    python -m ml_model.optimize --model runs/detect/star_wars_detector/weights/best.pt \\
+        --val dataset/val --calibration dataset/train --tolerance 0.01
+"""
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+try:
+    from ml_model.backends import PyTorchBackend, file_digest, letterbox, register_safe_globals
+    from ml_model.evaluation import list_split
+    from ml_model.resolution import profile_sizes
+    from ml_model.shards import ShardReader, load_image
+except ImportError:  # run as a script: python ml_model/optimize.py
+    from backends import PyTorchBackend, file_digest, letterbox, register_safe_globals
+    from evaluation import list_split
+    from resolution import profile_sizes
+    from shards import ShardReader, load_image
+
+VARIANTS = ("fused", "channels-last", "onnx", "int8-dynamic", "int8-static")
+MANIFEST_NAME = "variants.json"
+# Accuracy metrics the gate can use
+GATE_METRICS = ("map50", "map50_95")
+
+
+def default_variants_dir(model_path: Union[str, Path]) -> Path:
+    """Where the variants of a checkpoint are written and looked up."""
+    return Path(model_path).parent / "variants"
+
+
+def resolve_variant(
+    model_path: Union[str, Path],
+    name: str,
+    variants_dir: Union[str, Path] = None
+) -> Tuple[str, Path, Dict]:
+    """
+    Find a published variant in the manifest next to the model.
+
+    Args:
+        model_path: Path of the FP32 checkpoint the variants were built from
+        name: Variant name, one of VARIANTS
+        variants_dir: Directory with variants.json (default: variants/ next to the model)
+
+    Returns:
+        Tuple of (backend name, model file, backend options)
+
+    Raises:
+        ValueError: If the variants were built from other weights than
+            model_path (e.g. the model was retrained since)
+    """
+    variants_dir = Path(variants_dir) if variants_dir else default_variants_dir(model_path)
+    manifest_path = variants_dir / MANIFEST_NAME
+    if not manifest_path.exists():
+        raise FileNotFoundError(f"No variants manifest at {manifest_path}; run python -m ml_model.optimize")
+    manifest = json.loads(manifest_path.read_text())
+    if manifest.get("source_sha256") != file_digest(model_path):
+        raise ValueError(
+            f"The variants in {variants_dir} were built from other weights than {model_path}; "
+            f"run python -m ml_model.optimize again"
+        )
+    entry = manifest["variants"].get(name)
+    if entry is None:
+        raise ValueError(f"Unknown variant '{name}', available: {', '.join(manifest['variants'])}")
+    if not entry["published"]:
+        raise ValueError(f"Variant '{name}' was not published: {entry['reason']}")
+    return entry["backend"], variants_dir / entry["file"], dict(entry.get("options", {}))
+
+
+def artifact_source_digest(path: Path) -> str:
+    """Digest of the checkpoint a fused .pt or ONNX export was built from; None if unknown."""
+    if not path.exists():
+        return None
+    try:
+        if path.suffix == ".onnx":
+            import onnx
+
+            metadata = onnx.load(str(path), load_external_data=False).metadata_props
+            return {prop.key: prop.value for prop in metadata}.get("source_sha256")
+        import torch
+
+        register_safe_globals()
+        # getattr: el modelo fusionado guarda métodos ligados (ver backends.load_yolo)
+        with torch.serialization.safe_globals([getattr]):
+            return torch.load(path, map_location="cpu").get("source_sha256")
+    except Exception:
+        return None
+
+
+def ensure_onnx_export(model_path: Path, digest: str = None) -> Path:
+    """
+    The FP32 ONNX export next to the checkpoint, exported like train.py does.
+
+    An existing export is reused only if it records the digest of the
+    checkpoint; otherwise (missing, stale after retraining, or exported
+    without the record) it is exported again and stamped.
+    """
+    digest = digest or file_digest(model_path)
+    onnx_path = model_path.with_suffix(".onnx")
+    if artifact_source_digest(onnx_path) == digest:
+        return onnx_path
+    import onnx
+    from ultralytics import YOLO
+
+    onnx_path = Path(YOLO(str(model_path), task="detect").export(format="onnx", dynamic=True))
+    model = onnx.load(str(onnx_path))
+    prop = model.metadata_props.add()
+    prop.key, prop.value = "source_sha256", digest
+    tmp_path = onnx_path.with_name(f".{onnx_path.name}.tmp")
+    onnx.save(model, str(tmp_path))
+    os.replace(tmp_path, onnx_path)
+    return onnx_path
+
+
+def save_fused(model_path: Path, output_path: Path):
+    """Write the checkpoint with Conv+BN fused (same format as the backend's fused cache)."""
+    import torch
+
+    backend = PyTorchBackend(model_path, cache_fused=False)
+    checkpoint = {
+        "model": backend.model.model,
+        "train_args": backend.model.ckpt.get("train_args", {}) if backend.model.ckpt else {},
+        "source_sha256": backend.model_digest,
+    }
+    tmp_path = output_path.with_name(f".{output_path.name}.tmp")
+    torch.save(checkpoint, tmp_path)
+    os.replace(tmp_path, output_path)
+
+
+def load_calibration_images(split_dir: Union[str, Path], max_images: int, shards: ShardReader = None) -> List:
+    """Evenly spaced images of a dataset split, decoded as BGR arrays."""
+    paths = [image for image, _ in list_split(split_dir)]
+    if not paths:
+        raise ValueError(f"No calibration images found in {Path(split_dir) / 'images'}")
+    step = max(1, len(paths) // max_images)
+    images = []
+    for path in paths[::step][:max_images]:
+        image = load_image(path, shards)
+        if image is not None:
+            images.append(image)
+    return images
+
+
+def head_nodes_to_exclude(onnx_path: Path) -> List[str]:
+    """
+    Nodes of the detection head left in FP32 by static quantization.
+
+    The head concatenates box coordinates (pixels) and class scores (0-1)
+    into one tensor; a single INT8 scale for both ranges wipes out the
+    scores. Its convolutions are still quantized.
+    """
+    import onnx
+
+    graph = onnx.load(str(onnx_path)).graph
+    modules = [node.name.split("/")[1] for node in graph.node if node.name.startswith("/model.")]
+    head = max(set(modules), key=lambda module: int(module.split(".")[1]))
+    prefix = f"/{head}/"
+    return [
+        node.name for node in graph.node
+        if node.name.startswith(prefix) and (node.op_type != "Conv" or "/dfl/" in node.name)
+    ]
+
+
+def quantize_onnx(
+    onnx_path: Path,
+    output_path: Path,
+    mode: str,
+    calibration_images: List = None,
+    img_size: int = 640
+):
+    """
+    Quantize the FP32 ONNX export to INT8 with ONNX Runtime.
+
+    Args:
+        onnx_path: FP32 ONNX model
+        output_path: Where to write the quantized model
+        mode: 'dynamic' (weights only, activations at run time) or 'static'
+            (activations calibrated on calibration_images, QDQ format)
+        calibration_images: BGR images for static calibration
+        img_size: Calibration input size
+    """
+    from onnxruntime.quantization import (
+        CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, quantize_static
+    )
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    # Shape inference and graph cleanup recommended before quantizing
+    prepared_path = output_path.with_name(f".{output_path.stem}.prepared.onnx")
+    try:
+        quant_pre_process(str(onnx_path), str(prepared_path), skip_symbolic_shape=True)
+        if mode == "dynamic":
+            # ConvInteger only has uint8 weight kernels on CPU
+            quantize_dynamic(str(prepared_path), str(output_path), weight_type=QuantType.QUInt8)
+            return
+
+        class Reader(CalibrationDataReader):
+            def __init__(self, input_name):
+                self.batches = iter(
+                    {input_name: letterbox([image], img_size)[0]} for image in calibration_images
+                )
+
+            def get_next(self):
+                return next(self.batches, None)
+
+        import onnx
+
+        input_name = onnx.load(str(prepared_path)).graph.input[0].name
+        quantize_static(
+            str(prepared_path), str(output_path), Reader(input_name),
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            per_channel=True,
+            nodes_to_exclude=head_nodes_to_exclude(prepared_path)
+        )
+    finally:
+        prepared_path.unlink(missing_ok=True)
+
+
+def build_variant(
+    name: str,
+    model_path: Path,
+    output_dir: Path,
+    calibration_images: List = None,
+    img_size: int = 640,
+    digest: str = None
+) -> Tuple[str, str, Dict]:
+    """
+    Build one variant in output_dir.
+
+    Artifacts left by earlier runs are reused only when they were built from
+    the same checkpoint (digest, computed if not given).
+
+    Returns:
+        Tuple of (backend name, file name inside output_dir, backend options)
+    """
+    digest = digest or file_digest(model_path)
+    if name in ("fused", "channels-last"):
+        # Both serve the same fused weights; channels-last only changes their layout at load
+        fused_path = output_dir / "fused.pt"
+        if artifact_source_digest(fused_path) != digest:
+            save_fused(model_path, fused_path)
+        options = {"cache_fused": False}
+        if name == "channels-last":
+            options["channels_last"] = True
+        return "pytorch", fused_path.name, options
+
+    onnx_path = ensure_onnx_export(model_path, digest)
+    if name == "onnx":
+        shutil.copyfile(onnx_path, output_dir / "fp32.onnx")
+        return "onnx", "fp32.onnx", {}
+    if name == "int8-dynamic":
+        quantize_onnx(onnx_path, output_dir / "int8-dynamic.onnx", "dynamic")
+        return "onnx", "int8-dynamic.onnx", {}
+    if name == "int8-static":
+        if not calibration_images:
+            raise ValueError("int8-static needs calibration images")
+        quantize_onnx(onnx_path, output_dir / "int8-static.onnx", "static", calibration_images, img_size)
+        return "onnx", "int8-static.onnx", {}
+    raise ValueError(f"Unknown variant '{name}', expected one of {', '.join(VARIANTS)}")
+
+
+def measure(detector, val_dir, conf_threshold, max_images, img_size, shards=None) -> Dict:
+    """Accuracy and per-image latency of a detector on the validation split."""
+    report = profile_sizes(detector, val_dir, [img_size], conf_threshold, max_images, shards=shards)
+    stats = report["sizes"][str(img_size)]
+    stats["images"] = report["images"]
+    return stats
+
+
+def optimize(
+    model_path: Union[str, Path],
+    val_dir: Union[str, Path],
+    calibration_dir: Union[str, Path] = None,
+    variants: List[str] = VARIANTS,
+    output_dir: Union[str, Path] = None,
+    tolerance: float = 0.01,
+    metric: str = "map50_95",
+    conf_threshold: float = 0.001,
+    max_images: int = None,
+    calibration_images: int = 100,
+    img_size: int = 640,
+    num_threads: int = None,
+    shards: ShardReader = None
+) -> Dict:
+    """
+    Build, evaluate and publish the variants of a checkpoint.
+
+    Args:
+        model_path: FP32 checkpoint produced by train.py
+        val_dir: Validation split used for the accuracy gate and timings
+        calibration_dir: Split whose images calibrate int8-static
+        variants: Names of the variants to build
+        output_dir: Where variants and variants.json go (default: variants/ next to the model)
+        tolerance: Largest allowed drop of `metric` below FP32 (absolute, e.g. 0.01 = 1 point)
+        metric: Accuracy metric of the gate, 'map50' or 'map50_95'
+        conf_threshold: Confidence threshold of the evaluation; keep it low for mAP
+        max_images: Only evaluate on the first N validation images
+        calibration_images: Images used to calibrate int8-static
+        img_size: Input size of evaluation and calibration
+        num_threads: Inference threads of every run, fixed so timings compare
+        shards: Pre-decoded shards to read evaluation and calibration images from
+
+    Returns:
+        The manifest written to variants.json
+    """
+    try:
+        from ml_model.detect import StarWarsDetector
+    except ImportError:
+        from detect import StarWarsDetector
+
+    if metric not in GATE_METRICS:
+        raise ValueError(f"metric must be one of: {', '.join(GATE_METRICS)}")
+    model_path = Path(model_path)
+    output_dir = Path(output_dir) if output_dir else default_variants_dir(model_path)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    threads = num_threads or os.cpu_count() or 1
+    digest = file_digest(model_path)
+
+    def evaluate(backend, path, options):
+        start = time.perf_counter()
+        detector = StarWarsDetector(path, backend=backend, **options)
+        load_seconds = time.perf_counter() - start
+        detector.set_num_threads(threads)
+        stats = measure(detector, val_dir, conf_threshold, max_images, img_size, shards)
+        stats["load_seconds"] = load_seconds
+        return stats
+
+    print(f"Evaluating the FP32 reference {model_path}")
+    reference = evaluate("pytorch", model_path, {"cache_fused": False})
+    calibration = None
+    if "int8-static" in variants:
+        calibration = load_calibration_images(calibration_dir or val_dir, calibration_images, shards)
+
+    manifest = {
+        "source": str(model_path),
+        "source_sha256": digest,
+        "metric": metric,
+        "tolerance": tolerance,
+        "threads": threads,
+        "reference": reference,
+        "variants": {},
+    }
+    for name in variants:
+        print(f"Building {name}")
+        backend, file_name, options = build_variant(name, model_path, output_dir, calibration, img_size, digest)
+        stats = evaluate(backend, output_dir / file_name, options)
+        drop = reference[metric] - stats[metric]
+        published = drop <= tolerance
+        manifest["variants"][name] = {
+            "backend": backend,
+            "file": file_name,
+            "options": options,
+            "published": published,
+            "reason": None if published else f"{metric} dropped {drop:.4f} (tolerance {tolerance:g})",
+            "accuracy_drop": drop,
+            "speedup": reference["latency_ms"]["mean"] / stats["latency_ms"]["mean"],
+            **stats,
+        }
+
+    # Files of refused variants are removed unless a published variant shares them
+    kept = {entry["file"] for entry in manifest["variants"].values() if entry["published"]}
+    for entry in manifest["variants"].values():
+        if not entry["published"] and entry["file"] not in kept:
+            (output_dir / entry["file"]).unlink(missing_ok=True)
+
+    manifest_path = output_dir / MANIFEST_NAME
+    tmp_path = manifest_path.with_name(f".{MANIFEST_NAME}.tmp")
+    tmp_path.write_text(json.dumps(manifest, indent=2))
+    os.replace(tmp_path, manifest_path)
+    return manifest
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build CPU-optimized model variants behind an accuracy gate")
+    parser.add_argument("--model", default="runs/detect/star_wars_detector/weights/best.pt",
+                        help="FP32 checkpoint produced by train.py")
+    parser.add_argument("--val", default="dataset/val", help="Validation split with images/ and labels/")
+    parser.add_argument("--calibration", default="dataset/train",
+                        help="Split whose images calibrate the int8-static variant")
+    parser.add_argument("--variants", default=",".join(VARIANTS), help="Comma-separated variants to build")
+    parser.add_argument("--output-dir", help="Where to write the variants (default: variants/ next to the model)")
+    parser.add_argument("--tolerance", type=float, default=0.01,
+                        help="Largest allowed mAP drop below FP32 (absolute)")
+    parser.add_argument("--metric", choices=GATE_METRICS, default="map50_95", help="Accuracy metric of the gate")
+    parser.add_argument("--conf", type=float, default=0.001, help="Confidence threshold of the evaluation")
+    parser.add_argument("--max-images", type=int, help="Only evaluate on the first N validation images")
+    parser.add_argument("--calibration-images", type=int, default=100, help="Images used for calibration")
+    parser.add_argument("--img-size", type=int, default=640, help="Input size")
+    parser.add_argument("--threads", type=int, help="Inference threads (default: all cores)")
+    parser.add_argument("--shards", help="Read images from these pre-decoded shards (python -m ml_model.shards)")
+    args = parser.parse_args()
+
+    variants = [name for name in args.variants.split(",") if name]
+    unknown = set(variants) - set(VARIANTS)
+    if unknown:
+        parser.error(f"unknown variants: {', '.join(sorted(unknown))}")
+
+    manifest = optimize(
+        args.model, args.val, args.calibration, variants, args.output_dir, args.tolerance, args.metric,
+        args.conf, args.max_images, args.calibration_images, args.img_size, args.threads,
+        ShardReader(args.shards) if args.shards else None
+    )
+    reference = manifest["reference"]
+    metric = manifest["metric"]
+    print(f"\n{'variant':<14} {metric:>9} {'drop':>8} {'p50 ms':>8} {'speedup':>8} {'load s':>7}  status")
+    print(f"{'fp32':<14} {reference[metric]:>9.4f} {'':>8} {reference['latency_ms']['p50']:>8.1f} "
+          f"{1.0:>7.2f}x {reference['load_seconds']:>7.2f}  reference")
+    for name, entry in manifest["variants"].items():
+        status = "published" if entry["published"] else f"REFUSED: {entry['reason']}"
+        print(f"{name:<14} {entry[metric]:>9.4f} {entry['accuracy_drop']:>+8.4f} {entry['latency_ms']['p50']:>8.1f} "
+              f"{entry['speedup']:>7.2f}x {entry['load_seconds']:>7.2f}  {status}")
+    published = [name for name, entry in manifest["variants"].items() if entry["published"]]
+    print(f"\n{len(published)} variant(s) published to {Path(args.output_dir or default_variants_dir(args.model))}")
+
+
+if __name__ == "__main__":
+    main()
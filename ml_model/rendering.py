@@ -0,0 +1,92 @@
+"""
+Annotated image output: JPEG encoding and deferred rendering.
+
+RenderStore keeps what is needed to draw an annotated image (the encoded
+upload and its detections) in a directory every worker can read, so an image
+URL handed to a client is only rendered if and when it is fetched.
+"""
+import json
+import os
+import secrets
+import shutil
+import time
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+
+
+def encode_jpeg(image: np.ndarray, quality: int = 75) -> bytes:
+    """Encode a BGR image as JPEG bytes."""
+    ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+    if not ok:
+        raise ValueError("Could not encode image as JPEG")
+    return encoded.tobytes()
+
+
+class RenderStore:
+    def __init__(self, directory: Union[str, Path], ttl: float = 300.0):
+        """
+        Short-lived store of pending renders.
+
+        Args:
+            directory (str or Path): Directory shared by all workers
+            ttl (float): Seconds a render token stays valid
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self._last_purge = 0.0
+
+    def put(self, source: Union[str, Path, bytes, memoryview], metadata: Dict) -> str:
+        """
+        Save an encoded upload and its metadata.
+
+        Args:
+            source: Encoded image bytes, or the path of a spooled upload
+            metadata: JSON-serializable data needed to render it later
+
+        Returns:
+            Token to fetch the render with
+        """
+        self._purge_expired()
+        token = secrets.token_urlsafe(16)
+        source_path = self.directory / f"{token}.src"
+        if isinstance(source, (str, Path)):
+            shutil.copyfile(source, source_path)
+        else:
+            with open(source_path, "wb") as f:
+                f.write(source)
+        # The metadata file is written last and atomically: it marks the token as ready
+        tmp_path = self.directory / f".{token}.json.tmp"
+        tmp_path.write_text(json.dumps(metadata))
+        os.replace(tmp_path, self.directory / f"{token}.json")
+        return token
+
+    def get(self, token: str) -> Optional[Tuple[bytes, Dict]]:
+        """Return (encoded upload, metadata) for a live token, or None."""
+        if not token.replace("-", "").replace("_", "").isalnum():
+            return None
+        meta_path = self.directory / f"{token}.json"
+        try:
+            if time.time() - meta_path.stat().st_mtime > self.ttl:
+                return None
+            metadata = json.loads(meta_path.read_text())
+            source = (self.directory / f"{token}.src").read_bytes()
+        except (OSError, ValueError):
+            return None
+        return source, metadata
+
+    def _purge_expired(self):
+        """Remove expired entries, at most once per ttl/10 seconds."""
+        now = time.time()
+        if now - self._last_purge < self.ttl / 10:
+            return
+        self._last_purge = now
+        for path in self.directory.iterdir():
+            try:
+                if now - path.stat().st_mtime > self.ttl:
+                    path.unlink()
+            except OSError:
+                pass
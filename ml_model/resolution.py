@@ -0,0 +1,202 @@
+"""
+Per-request choice of the network input size.
+
+A small thumbnail gains nothing from being upscaled to the training size, and
+a request with a tight latency budget may prefer a smaller size over a late
+answer. ResolutionPolicy picks the size from the source dimensions and an
+optional budget, using latencies measured by profile_sizes() when available.
+
+Record a profile on the validation split:
+    python -m ml_model.resolution --model ml_model/best.pt --val dataset/val \
+        --sizes 320,480,640 --output ml_model/resolution_profile.json
+"""
+import json
+import time
+from pathlib import Path
+from typing import Dict, Sequence, Union
+
+import numpy as np
+
+try:
+    from ml_model.evaluation import DetectionEvaluator, list_split, load_yolo_labels
+    from ml_model.shards import ShardReader, load_image
+except ImportError:  # run as a script: python ml_model/resolution.py
+    from evaluation import DetectionEvaluator, list_split, load_yolo_labels
+    from shards import ShardReader, load_image
+
+
+def parse_sizes(value: Union[str, Sequence[int]]) -> tuple:
+    """Parse '320,480,640' (or a sequence) into sorted sizes, multiples of 32."""
+    if isinstance(value, str):
+        value = [part for part in value.replace(" ", "").split(",") if part]
+    sizes = sorted({int(size) for size in value})
+    if not sizes:
+        raise ValueError("At least one input size is required")
+    for size in sizes:
+        if size <= 0 or size % 32:
+            raise ValueError(f"Input size {size} must be a positive multiple of 32")
+    return tuple(sizes)
+
+
+class ResolutionPolicy:
+    def __init__(self, sizes: Union[str, Sequence[int]] = (640,), profile: Dict = None):
+        """
+        Initialize the resolution policy.
+
+        Args:
+            sizes: Allowed input sizes, e.g. (320, 480, 640)
+            profile: Output of profile_sizes(); its p95 latency per size is
+                used to honour latency budgets
+        """
+        self.sizes = parse_sizes(sizes)
+        self.latency_ms = {}
+        for size, stats in ((profile or {}).get('sizes') or {}).items():
+            if int(size) in self.sizes:
+                self.latency_ms[int(size)] = stats['latency_ms']['p95']
+
+    @classmethod
+    def from_profile(cls, path: Union[str, Path], sizes: Union[str, Sequence[int]] = None) -> "ResolutionPolicy":
+        """Build a policy from a saved profile, by default allowing every profiled size."""
+        profile = json.loads(Path(path).read_text())
+        return cls(sizes or [int(size) for size in profile['sizes']], profile)
+
+    @property
+    def tag(self) -> str:
+        """Short description of the policy, e.g. for cache keys."""
+        return "s" + "-".join(str(size) for size in self.sizes)
+
+    def choose(self, height: int, width: int, latency_budget_ms: float = None) -> int:
+        """
+        Pick the input size for one image.
+
+        The natural size is the smallest allowed one that covers the long
+        side of the image (so nothing is upscaled past it), or the largest
+        allowed size for big images. With a latency budget and a profile, the
+        largest size up to that one whose p95 latency fits is used instead,
+        falling back to the smallest size.
+
+        Args:
+            height: Source image height in pixels
+            width: Source image width in pixels
+            latency_budget_ms: Optional model latency budget in milliseconds
+
+        Returns:
+            Input size in pixels
+        """
+        long_side = max(height, width)
+        natural = next((size for size in self.sizes if size >= long_side), self.sizes[-1])
+        if latency_budget_ms is None or not self.latency_ms:
+            return natural
+        fitting = [
+            size for size in self.sizes
+            if size <= natural and self.latency_ms.get(size, float("inf")) <= latency_budget_ms
+        ]
+        return fitting[-1] if fitting else self.sizes[0]
+
+
+def profile_sizes(
+    detector,
+    val_dir: Union[str, Path],
+    sizes: Sequence[int] = (320, 480, 640),
+    conf_threshold: float = 0.001,
+    max_images: int = None,
+    warmup_runs: int = 2,
+    shards: ShardReader = None
+) -> Dict:
+    """
+    Measure latency and accuracy of each input size on a labeled split.
+
+    Every image runs alone (batch of one), so latencies are per image.
+    Images are decoded once, outside the timed region.
+
+    Args:
+        detector: StarWarsDetector to profile
+        val_dir: Split with images/ and labels/ folders (e.g. dataset/val)
+        sizes: Input sizes to measure
+        conf_threshold: Confidence threshold; keep it low for mAP
+        max_images: Only use the first N images of the split
+        warmup_runs: Untimed passes per size before measuring
+        shards: Read images from these pre-decoded shards when they hold a
+            current copy (see ml_model/shards.py)
+
+    Returns:
+        Dict with per-size latency percentiles (ms) and accuracy metrics
+    """
+    samples = list_split(val_dir)[:max_images]
+    if not samples:
+        raise ValueError(f"No images found in {Path(val_dir) / 'images'}")
+    images = []
+    for image_path, label_path in samples:
+        image = load_image(image_path, shards)
+        if image is None:
+            continue
+        height, width = image.shape[:2]
+        images.append((image, load_yolo_labels(label_path, width, height)))
+
+    report = {
+        'backend': detector.backend.name,
+        'model_version': detector.model_version,
+        'images': len(images),
+        'conf_threshold': conf_threshold,
+        'sizes': {},
+    }
+    for size in parse_sizes(sizes):
+        for _ in range(warmup_runs):
+            detector.detect_batch([images[0][0]], conf_threshold, return_image=False, imgsz=size)
+        evaluator = DetectionEvaluator(detector.class_names)
+        latencies = []
+        for image, (gt_boxes, gt_classes) in images:
+            start = time.perf_counter()
+            detections = detector.detect_batch([image], conf_threshold, return_image=False, imgsz=size)[0]
+            latencies.append(time.perf_counter() - start)
+            evaluator.add(detections.xyxy, detections.conf, detections.class_id, gt_boxes, gt_classes)
+        latencies = np.array(latencies) * 1000.0
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        accuracy = evaluator.summary()
+        report['sizes'][str(size)] = {
+            'latency_ms': {'mean': float(latencies.mean()), 'p50': float(p50), 'p95': float(p95), 'p99': float(p99)},
+            'images_per_second': float(1000.0 / latencies.mean()),
+            'map50': accuracy['map50'],
+            'map50_95': accuracy['map50_95'],
+            'precision': accuracy['precision'],
+            'recall': accuracy['recall'],
+        }
+    return report
+
+
+def main():
+    import argparse
+
+    try:
+        from ml_model.detect import StarWarsDetector
+    except ImportError:
+        from detect import StarWarsDetector
+
+    parser = argparse.ArgumentParser(description="Record latency and accuracy per input size")
+    parser.add_argument("--model", default="runs/detect/star_wars_detector/weights/best.pt",
+                        help="Path to the trained model")
+    parser.add_argument("--backend", choices=["pytorch", "onnx"],
+                        help="Inference backend (default: from the model file suffix)")
+    parser.add_argument("--val", default="dataset/val", help="Validation split with images/ and labels/")
+    parser.add_argument("--sizes", default="320,480,640", help="Comma-separated input sizes")
+    parser.add_argument("--conf", type=float, default=0.001, help="Confidence threshold")
+    parser.add_argument("--max-images", type=int, help="Only profile the first N images")
+    parser.add_argument("--output", default="ml_model/resolution_profile.json", help="Where to save the profile")
+    parser.add_argument("--shards", help="Read images from these pre-decoded shards (python -m ml_model.shards)")
+    args = parser.parse_args()
+
+    detector = StarWarsDetector(args.model, backend=args.backend)
+    shards = ShardReader(args.shards) if args.shards else None
+    report = profile_sizes(detector, args.val, parse_sizes(args.sizes), args.conf, args.max_images, shards=shards)
+    Path(args.output).write_text(json.dumps(report, indent=2))
+
+    print(f"{'size':>6} {'p50 ms':>8} {'p95 ms':>8} {'img/s':>8} {'mAP50':>7} {'mAP50-95':>9}")
+    for size, stats in report['sizes'].items():
+        latency = stats['latency_ms']
+        print(f"{size:>6} {latency['p50']:>8.1f} {latency['p95']:>8.1f} {stats['images_per_second']:>8.1f} "
+              f"{stats['map50']:>7.3f} {stats['map50_95']:>9.3f}")
+    print(f"\nProfile saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Columnar detection results.
+
+Detections of one image are kept as three contiguous numpy arrays instead of
+one Python object per box, and serialized to JSON straight from them.
+"""
+import json
+from typing import Dict, List, Sequence
+
+import cv2
+import numpy as np
+
+
+def render_detections(image: np.ndarray, detections: "Detections", max_size: int = None) -> np.ndarray:
+    """
+    Draw detections on a copy of an image.
+
+    The source image is never modified. When max_size is set and the image
+    is larger, it is downscaled first, so the drawing happens on the small
+    copy that has to be made anyway.
+
+    Args:
+        image: BGR image the detections refer to
+        detections: Detections of that image
+        max_size: Maximum side of the rendered image in pixels
+
+    Returns:
+        New BGR image with boxes and labels drawn
+    """
+    height, width = image.shape[:2]
+    boxes = detections.xyxy
+    if max_size and max(height, width) > max_size:
+        scale = max_size / max(height, width)
+        canvas = cv2.resize(
+            image, (max(1, round(width * scale)), max(1, round(height * scale))),
+            interpolation=cv2.INTER_AREA
+        )
+        boxes = (boxes * scale).astype(np.int32)
+    else:
+        canvas = image.copy()
+
+    for (x1, y1, x2, y2), label, confidence in zip(boxes.tolist(), detections.labels, detections.conf.tolist()):
+        # Draw box
+        cv2.rectangle(canvas, (x1, y1), (x2, y2), (0, 255, 0), 2)
+
+        # Draw label
+        cv2.putText(
+            canvas,
+            f"{label}: {confidence:.2f}",
+            (x1, y1 - 10),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.5,
+            (0, 255, 0),
+            2
+        )
+    return canvas
+
+
+class Detections:
+    __slots__ = ("xyxy", "conf", "class_id", "names", "image")
+
+    def __init__(
+        self,
+        xyxy: np.ndarray,
+        conf: np.ndarray,
+        class_id: np.ndarray,
+        names: Sequence[str],
+        image: np.ndarray = None
+    ):
+        """
+        Detections of one image.
+
+        Args:
+            xyxy: Integer boxes in source pixels, shape (N, 4)
+            conf: Confidence scores, shape (N,)
+            class_id: Class indices into names, shape (N,)
+            names: Class names
+            image: Source image the detections refer to, if requested
+        """
+        self.xyxy = xyxy
+        self.conf = conf
+        self.class_id = class_id
+        self.names = names
+        self.image = image
+
+    @classmethod
+    def from_raw(
+        cls,
+        boxes: np.ndarray,
+        scores: np.ndarray,
+        class_ids: np.ndarray,
+        names: Sequence[str],
+        conf_threshold: float = 0.0
+    ) -> "Detections":
+        """Build from raw backend output, keeping scores >= conf_threshold."""
+        keep = scores >= conf_threshold
+        return cls(
+            np.ascontiguousarray(boxes[keep], dtype=np.int32),
+            np.ascontiguousarray(scores[keep], dtype=np.float32),
+            np.ascontiguousarray(class_ids[keep], dtype=np.int32),
+            names
+        )
+
+    @classmethod
+    def from_columns(cls, columns: Dict, names: Sequence[str]) -> "Detections":
+        """Inverse of to_columns."""
+        return cls(
+            np.asarray(columns['xyxy'], dtype=np.int32).reshape(-1, 4),
+            np.asarray(columns['conf'], dtype=np.float32),
+            np.asarray(columns['class_id'], dtype=np.int32),
+            names
+        )
+
+    def __len__(self) -> int:
+        return len(self.conf)
+
+    @property
+    def labels(self) -> List[str]:
+        return [self.names[class_id] for class_id in self.class_id.tolist()]
+
+    def plot(self, max_size: int = None) -> np.ndarray:
+        """
+        Render the detections on a copy of the source image.
+
+        Args:
+            max_size: Maximum side of the rendered image in pixels
+
+        Returns:
+            Rendered BGR image, or None if no source image was kept
+        """
+        if self.image is None:
+            return None
+        return render_detections(self.image, self, max_size)
+
+    def to_columns(self) -> Dict:
+        """Plain-list form, e.g. for caching as JSON."""
+        return {
+            'xyxy': self.xyxy.tolist(),
+            'conf': self.conf.tolist(),
+            'class_id': self.class_id.tolist(),
+        }
+
+    def to_dicts(self) -> List[Dict]:
+        """Detections in the detect_characters format ('box', 'label', 'confidence')."""
+        return [
+            {'box': box, 'label': label, 'confidence': confidence}
+            for box, label, confidence in zip(self.xyxy.tolist(), self.labels, self.conf.tolist())
+        ]
+
+    def to_json(self, label_key: str = 'label') -> str:
+        """
+        Serialize as a JSON array of {'bbox', label_key, 'confidence'} objects.
+
+        Each column is converted to Python in a single tolist() call and the
+        rows are formatted directly, without building intermediate dicts.
+        """
+        label_json = [json.dumps(name) for name in self.names]
+        key = json.dumps(label_key)
+        rows = [
+            f'{{"bbox":[{x1},{y1},{x2},{y2}],{key}:{label_json[class_id]},"confidence":{confidence!r}}}'
+            for (x1, y1, x2, y2), class_id, confidence
+            in zip(self.xyxy.tolist(), self.class_id.tolist(), self.conf.tolist())
+        ]
+        return '[' + ','.join(rows) + ']'
@@ -0,0 +1,52 @@
+"""
+Runtime settings tuned for this machine by benchmarks/autotune.py.
+
+The file records the gunicorn worker count, the request threads of each
+worker, the inference threads (torch intra-op and inter-op, OpenCV) and the
+batcher settings that gave the best throughput within a p99 target.
+gunicorn.conf.py and app/app.py read it at startup; environment variables
+still override every value.
+"""
+import json
+import os
+import warnings
+from pathlib import Path
+from typing import Dict, Union
+
+DEFAULT_PATH = "runtime_config.json"
+SETTINGS = (
+    "workers",          # gunicorn worker processes
+    "threads",          # gunicorn request threads per worker
+    "torch_threads",    # intra-op inference threads per worker
+    "interop_threads",  # torch inter-op threads per worker
+    "opencv_threads",   # OpenCV threads per worker (decode, resize, drawing)
+    "batch_max_size",   # BatchingScheduler max_batch_size
+    "batch_window_ms",  # BatchingScheduler batch_window_ms
+)
+
+
+def runtime_config_path() -> Path:
+    """Location of the tuned settings (RUNTIME_CONFIG or runtime_config.json)."""
+    return Path(os.environ.get("RUNTIME_CONFIG", DEFAULT_PATH))
+
+
+def load_runtime_config(path: Union[str, Path] = None) -> Dict:
+    """
+    Read the tuned settings.
+
+    Settings tuned on a machine with a different core count are ignored:
+    they would oversubscribe or starve this one.
+
+    Returns:
+        Dict with any of SETTINGS; empty when there is no (usable) file
+    """
+    path = Path(path) if path else runtime_config_path()
+    if not path.exists():
+        return {}
+    config = json.loads(path.read_text())
+    if config.get("cpu_count") != os.cpu_count():
+        warnings.warn(
+            f"Ignoring {path}: tuned for {config.get('cpu_count')} CPUs, this machine has {os.cpu_count()}"
+        )
+        return {}
+    return {key: value for key, value in config.get("settings", {}).items() if key in SETTINGS}
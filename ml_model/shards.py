@@ -0,0 +1,333 @@
+"""
+Memory-mapped shards of pre-decoded images for the dataset tools.
+
+Annotation, evaluation, profiling and calibration all decode the same JPEGs
+again and again. A shard directory stores every image of a dataset once,
+already decoded (BGR, uint8) and downscaled to at most --max-size pixels per
+side, back to back in large raw files. An index keeps the offset and shape of
+each image, and ShardReader maps the files with numpy.memmap, so reading an
+image is a slice of the page cache: a zero-copy, read-only view with no
+decoding, shared by every process that maps the same files.
+
+Layout:
+    index.npz          keys (paths relative to the dataset root), shard, offset,
+                       shape, source shape, and source size and mtime
+    shard-00000.bin    raw pixels of many images
+
+Rebuilding is incremental: images whose source size and mtime did not change
+are kept, the rest are decoded into new shard files, and existing shard files
+are never modified (readers may have them mapped). --rebuild compacts the
+space left by replaced images. Readers check the source size and mtime and
+return None for stale or missing entries, so callers fall back to decoding
+the image file.
+
+Usage:
+    python -m ml_model.shards build dataset --max-size 640
+    python -m ml_model.shards info dataset/.shards --benchmark 200
+"""
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+import cv2
+import numpy as np
+
+INDEX_NAME = "index.npz"
+SHARDS_DIR_NAME = ".shards"
+IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png'}
+DEFAULT_MAX_SIZE = 640
+DEFAULT_SHARD_BYTES = 1 << 30
+INDEX_FIELDS = ("shard", "offset", "shape", "source_shape", "source_size", "source_mtime_ns")
+
+
+def shard_file(path: Path, shard: int) -> Path:
+    return path / f"shard-{shard:05d}.bin"
+
+
+def decode_resized(path: Union[str, Path], max_size: int = DEFAULT_MAX_SIZE) -> Optional[Tuple[np.ndarray, Tuple]]:
+    """
+    Decode an image and downscale it so its longer side is at most max_size.
+
+    Returns:
+        Tuple of (BGR image, (height, width) of the source), or None when the
+        file cannot be decoded
+    """
+    image = cv2.imread(str(path))
+    if image is None:
+        return None
+    height, width = image.shape[:2]
+    if max_size and max(height, width) > max_size:
+        scale = max_size / max(height, width)
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    return np.ascontiguousarray(image), (height, width)
+
+
+class ShardReader:
+    def __init__(self, path: Union[str, Path]):
+        """
+        Read images from a shard directory built by build_shards().
+
+        Args:
+            path (str or Path): Shard directory (with index.npz)
+        """
+        self.path = Path(path)
+        with np.load(self.path / INDEX_NAME) as index:
+            self.root = Path(str(index["root"]))
+            self.max_size = int(index["max_size"])
+            self._keys = index["keys"].tolist()
+            self._fields = {field: index[field] for field in INDEX_FIELDS}
+        self._positions = {key: i for i, key in enumerate(self._keys)}
+        self._maps = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._positions
+
+    def keys(self) -> List[str]:
+        return list(self._keys)
+
+    def _map(self, shard: int) -> np.memmap:
+        shard_map = self._maps.get(shard)
+        if shard_map is None:
+            with self._lock:
+                shard_map = self._maps.get(shard)
+                if shard_map is None:
+                    shard_map = np.memmap(shard_file(self.path, shard), dtype=np.uint8, mode="r")
+                    self._maps[shard] = shard_map
+        return shard_map
+
+    def get(self, key: str) -> np.ndarray:
+        """Stored image of key as a read-only view into the mapped shard (no copy, no decoding)."""
+        i = self._positions[key]
+        shape = tuple(int(v) for v in self._fields["shape"][i])
+        offset = int(self._fields["offset"][i])
+        flat = self._map(int(self._fields["shard"][i]))[offset:offset + int(np.prod(shape))]
+        return flat.reshape(shape)
+
+    def source_shape(self, key: str) -> Tuple[int, int]:
+        """(height, width) of the source image before downscaling."""
+        return tuple(int(v) for v in self._fields["source_shape"][self._positions[key]])
+
+    def key_for(self, path: Union[str, Path]) -> Optional[str]:
+        """Index key of an image path, or None when it is outside the dataset root."""
+        try:
+            return Path(path).resolve().relative_to(self.root).as_posix()
+        except ValueError:
+            return None
+
+    def is_current(self, key: str, path: Union[str, Path]) -> bool:
+        """Whether the stored image still matches the file (same size and mtime)."""
+        i = self._positions.get(key)
+        if i is None:
+            return False
+        try:
+            stat = Path(path).stat()
+        except FileNotFoundError:
+            return False
+        return (stat.st_size == int(self._fields["source_size"][i])
+                and stat.st_mtime_ns == int(self._fields["source_mtime_ns"][i]))
+
+    def read(self, path: Union[str, Path]) -> Optional[np.ndarray]:
+        """Stored image of a file, or None if it is not in the shards or changed since they were built."""
+        key = self.key_for(path)
+        if key is None or not self.is_current(key, path):
+            return None
+        return self.get(key)
+
+    def batches(self, keys: Sequence[str] = None, batch_size: int = 16) -> Iterator[Tuple[List[str], List[np.ndarray]]]:
+        """Yield (keys, images) in batches, in index order by default."""
+        keys = self._keys if keys is None else list(keys)
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            yield batch, [self.get(key) for key in batch]
+
+    def close(self):
+        self._maps.clear()
+
+
+def load_image(path: Union[str, Path], shards: ShardReader = None) -> Optional[np.ndarray]:
+    """
+    Image of a dataset file: from the shards when they hold a current copy, else decoded from disk.
+
+    Arrays from the shards are read-only and may be downscaled (see
+    ShardReader.max_size); labels in normalized coordinates apply unchanged.
+    """
+    if shards is not None:
+        image = shards.read(path)
+        if image is not None:
+            return image
+    return cv2.imread(str(path))
+
+
+def list_images(root: Path, exclude: Path = None) -> List[Path]:
+    return sorted(
+        path for path in root.rglob("*")
+        if path.suffix.lower() in IMAGE_SUFFIXES and (exclude is None or exclude not in path.parents)
+    )
+
+
+def build_shards(
+    root: Union[str, Path],
+    output: Union[str, Path] = None,
+    max_size: int = DEFAULT_MAX_SIZE,
+    shard_bytes: int = DEFAULT_SHARD_BYTES,
+    workers: int = 8,
+    rebuild: bool = False
+) -> Dict:
+    """
+    Build or update the shards of every image under root.
+
+    Args:
+        root: Dataset root (e.g. dataset, with train/images and val/images)
+        output: Shard directory (default: root/.shards)
+        max_size: Longest side of the stored images (0 keeps the source size)
+        shard_bytes: Size at which a new shard file is started
+        workers: Decoding threads
+        rebuild: Decode everything again into fresh shards (reclaims the
+            space of replaced images)
+
+    Returns:
+        Dict with the counts of images reused, decoded and unreadable, the
+        number of shard files and bytes in use, and the time taken
+    """
+    start = time.perf_counter()
+    root = Path(root).resolve()
+    output = Path(output) if output else root / SHARDS_DIR_NAME
+    output.mkdir(parents=True, exist_ok=True)
+    paths = list_images(root, exclude=output.resolve())
+
+    previous = None
+    if not rebuild and (output / INDEX_NAME).exists():
+        previous = ShardReader(output)
+        if previous.max_size != max_size or previous.root != root:
+            previous = None
+
+    entries = {}
+    todo = []
+    for path in paths:
+        key = path.relative_to(root).as_posix()
+        if previous is not None and previous.is_current(key, path):
+            i = previous._positions[key]
+            entries[key] = {field: previous._fields[field][i] for field in INDEX_FIELDS}
+        else:
+            todo.append((key, path))
+    existing = [int(s.stem.split("-")[1]) for s in output.glob("shard-*.bin")]
+    shard = max(existing, default=-1) + 1
+
+    failed = 0
+    out, offset = None, 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for (key, path), decoded in zip(todo, executor.map(lambda item: decode_resized(item[1], max_size), todo)):
+                if decoded is None:
+                    failed += 1
+                    continue
+                image, source_shape = decoded
+                if out is None or offset + image.nbytes > shard_bytes and offset > 0:
+                    if out is not None:
+                        out.close()
+                        shard += 1
+                    out, offset = open(shard_file(output, shard), "wb"), 0
+                out.write(image.tobytes())
+                stat = path.stat()
+                entries[key] = {
+                    "shard": shard,
+                    "offset": offset,
+                    "shape": image.shape,
+                    "source_shape": source_shape,
+                    "source_size": stat.st_size,
+                    "source_mtime_ns": stat.st_mtime_ns,
+                }
+                offset += image.nbytes
+    finally:
+        if out is not None:
+            out.close()
+
+    keys = sorted(entries)
+    tmp_path = output / f".{INDEX_NAME}.tmp.npz"
+    np.savez(
+        tmp_path,
+        root=str(root),
+        max_size=max_size,
+        keys=np.array(keys, dtype=str),
+        shard=np.array([entries[k]["shard"] for k in keys], dtype=np.int32),
+        offset=np.array([entries[k]["offset"] for k in keys], dtype=np.int64),
+        shape=np.array([entries[k]["shape"] for k in keys], dtype=np.int32).reshape(-1, 3),
+        source_shape=np.array([entries[k]["source_shape"] for k in keys], dtype=np.int32).reshape(-1, 2),
+        source_size=np.array([entries[k]["source_size"] for k in keys], dtype=np.int64),
+        source_mtime_ns=np.array([entries[k]["source_mtime_ns"] for k in keys], dtype=np.int64),
+    )
+    tmp_path.replace(output / INDEX_NAME)
+
+    # Shards without live images are removed (open maps of them stay valid)
+    used = {int(entry["shard"]) for entry in entries.values()}
+    for path in output.glob("shard-*.bin"):
+        if int(path.stem.split("-")[1]) not in used:
+            path.unlink()
+    shard_files = sorted(output.glob("shard-*.bin"))
+    total_bytes = sum(path.stat().st_size for path in shard_files)
+    live_bytes = sum(int(np.prod(entry["shape"])) for entry in entries.values())
+    return {
+        "images": len(entries),
+        "reused": len(entries) - (len(todo) - failed),
+        "decoded": len(todo) - failed,
+        "unreadable": failed,
+        "shards": len(shard_files),
+        "bytes": total_bytes,
+        "unused_bytes": total_bytes - live_bytes,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and inspect memory-mapped image shards")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="Build or update the shards of a dataset")
+    build.add_argument("root", help="Dataset root, e.g. dataset")
+    build.add_argument("--output", help="Shard directory (default: <root>/.shards)")
+    build.add_argument("--max-size", type=int, default=DEFAULT_MAX_SIZE,
+                       help="Longest side of the stored images (0: keep the source size)")
+    build.add_argument("--shard-mb", type=int, default=DEFAULT_SHARD_BYTES >> 20, help="Size of each shard file")
+    build.add_argument("--workers", type=int, default=8, help="Decoding threads")
+    build.add_argument("--rebuild", action="store_true", help="Decode everything again into fresh shards")
+    info = commands.add_parser("info", help="Describe a shard directory")
+    info.add_argument("path", help="Shard directory")
+    info.add_argument("--benchmark", type=int, default=0,
+                      help="Compare reading N images from the shards with decoding the files")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        stats = build_shards(args.root, args.output, args.max_size, args.shard_mb << 20, args.workers, args.rebuild)
+        print(f"{stats['images']} images ({stats['reused']} reused, {stats['decoded']} decoded, "
+              f"{stats['unreadable']} unreadable) in {stats['seconds']:.1f}s")
+        print(f"{stats['shards']} shard files, {stats['bytes'] / 2 ** 20:.1f} MiB "
+              f"({stats['unused_bytes'] / 2 ** 20:.1f} MiB unused; --rebuild reclaims it)")
+        return
+
+    reader = ShardReader(args.path)
+    stale = sum(not reader.is_current(key, reader.root / key) for key in reader.keys())
+    print(f"{len(reader)} images from {reader.root} (max size {reader.max_size or 'source'}), {stale} stale")
+    if args.benchmark:
+        keys = reader.keys()[:args.benchmark]
+        start = time.perf_counter()
+        for key in keys:
+            cv2.imread(str(reader.root / key))
+        decode_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        for key in keys:
+            # Se fuerza la lectura de los píxeles, como haría quien los use
+            int(reader.get(key)[::16, ::16].sum())
+        shard_seconds = time.perf_counter() - start
+        print(f"Decoding files: {len(keys) / decode_seconds:.0f} images/s, "
+              f"shards: {len(keys) / shard_seconds:.0f} images/s")
+
+
+if __name__ == "__main__":
+    main()
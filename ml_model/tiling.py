@@ -0,0 +1,157 @@
+"""
+Tiled (sliced) inference for high-resolution images.
+
+A large image is cut into overlapping tiles that are run through the model
+at full resolution, so small characters are not lost when the whole image is
+downscaled to the network input size. Boxes found in several tiles are then
+merged back across the seams.
+"""
+import math
+from typing import List, Tuple
+
+import numpy as np
+
+MERGE_METHODS = ("nms", "wbf")
+MATCH_METRICS = ("iou", "ios")
+
+
+def tile_grid(
+    height: int,
+    width: int,
+    tile_size: int = 640,
+    overlap: float = 0.2,
+    max_tiles: int = 16
+) -> np.ndarray:
+    """
+    Compute overlapping tiles that cover an image.
+
+    Tiles are spread evenly so the last row and column end exactly on the
+    image border. When more than max_tiles would be needed, the tiles are
+    enlarged (keeping the overlap) until they fit, which bounds the cost of
+    a request regardless of the image size.
+
+    Args:
+        height: Image height in pixels
+        width: Image width in pixels
+        tile_size: Side of the square tiles in pixels
+        overlap: Fraction of a tile shared with its neighbour, in [0, 1)
+        max_tiles: Maximum number of tiles
+
+    Returns:
+        Tiles as int array of shape (N, 4) with x1, y1, x2, y2
+    """
+    if not 0.0 <= overlap < 1.0:
+        raise ValueError("overlap must be in [0, 1)")
+    if max_tiles < 1:
+        raise ValueError("max_tiles must be at least 1")
+
+    def counts(size):
+        step = size * (1.0 - overlap)
+        return (
+            max(1, math.ceil((width - size) / step) + 1),
+            max(1, math.ceil((height - size) / step) + 1),
+        )
+
+    tile_size = max(1, int(tile_size))
+    nx, ny = counts(tile_size)
+    while nx * ny > max_tiles:
+        tile_size = int(math.ceil(tile_size * 1.1))
+        nx, ny = counts(tile_size)
+
+    tile_w, tile_h = min(tile_size, width), min(tile_size, height)
+    xs = np.linspace(0, width - tile_w, nx).round().astype(np.int64)
+    ys = np.linspace(0, height - tile_h, ny).round().astype(np.int64)
+    x1, y1 = (grid.ravel() for grid in np.meshgrid(xs, ys))
+    return np.stack([x1, y1, x1 + tile_w, y1 + tile_h], axis=1)
+
+
+def _overlaps(box: np.ndarray, boxes: np.ndarray, areas: np.ndarray, area: float, metric: str) -> np.ndarray:
+    inter_w = (np.minimum(box[2], boxes[:, 2]) - np.maximum(box[0], boxes[:, 0])).clip(0)
+    inter_h = (np.minimum(box[3], boxes[:, 3]) - np.maximum(box[1], boxes[:, 1])).clip(0)
+    inter = inter_w * inter_h
+    if metric == "ios":
+        # Intersection over the smaller box: a box cut by a tile border still
+        # matches the complete box found in the neighbouring tile
+        return inter / (np.minimum(area, areas) + 1e-7)
+    return inter / (area + areas - inter + 1e-7)
+
+
+def merge_detections(
+    boxes: np.ndarray,
+    scores: np.ndarray,
+    class_ids: np.ndarray,
+    method: str = "wbf",
+    match_threshold: float = 0.5,
+    match_metric: str = None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Merge duplicate detections of the same object coming from several tiles.
+
+    Boxes are clustered greedily per class: the best remaining box takes
+    every box of its class that overlaps it by more than match_threshold,
+    computing all overlaps in one vectorized step. With 'nms' the best box of
+    each cluster is kept as is; with 'wbf' (weighted box fusion) its
+    coordinates become the mean of the cluster weighted by score and area,
+    so a box truncated at a tile seam barely pulls the complete box in.
+
+    By default 'nms' matches on intersection over the smaller box, which
+    also suppresses boxes cut by a tile border, and 'wbf' on IoU: fusing
+    with intersection over the smaller box would average a truncated box
+    into the complete one and merge a small character standing in front of
+    a larger one of the same class.
+
+    Args:
+        boxes: xyxy boxes in image coordinates, shape (N, 4)
+        scores: Confidence scores, shape (N,)
+        class_ids: Class indices, shape (N,)
+        method: 'nms' or 'wbf'
+        match_threshold: Overlap above which two boxes are the same object
+        match_metric: 'iou' or 'ios' (intersection over the smaller box);
+            by default 'ios' for 'nms' and 'iou' for 'wbf'
+
+    Returns:
+        Merged (boxes, scores, class_ids), best score first
+    """
+    if method not in MERGE_METHODS:
+        raise ValueError(f"Unknown merge method {method!r}, expected one of {MERGE_METHODS}")
+    if match_metric is None:
+        match_metric = "ios" if method == "nms" else "iou"
+    if match_metric not in MATCH_METRICS:
+        raise ValueError(f"Unknown match metric {match_metric!r}, expected one of {MATCH_METRICS}")
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float32)
+    class_ids = np.asarray(class_ids, dtype=np.int64)
+
+    areas = (boxes[:, 2] - boxes[:, 0]).clip(0) * (boxes[:, 3] - boxes[:, 1]).clip(0)
+    order = scores.argsort()[::-1]
+    merged_boxes, merged_scores, merged_ids = [], [], []
+    while order.size:
+        i = order[0]
+        rest = order[1:]
+        matched = (class_ids[rest] == class_ids[i]) & (
+            _overlaps(boxes[i], boxes[rest], areas[rest], areas[i], match_metric) > match_threshold
+        )
+        if method == "wbf" and matched.any():
+            members = np.concatenate([[i], rest[matched]])
+            weights = scores[members] * areas[members]
+            if not weights.sum() > 0:
+                weights = scores[members]
+            merged_boxes.append((boxes[members] * weights[:, None]).sum(0) / weights.sum())
+        else:
+            merged_boxes.append(boxes[i])
+        merged_scores.append(scores[i])
+        merged_ids.append(class_ids[i])
+        order = rest[~matched]
+
+    if not merged_boxes:
+        return np.zeros((0, 4), np.float32), np.zeros(0, np.float32), np.zeros(0, np.int64)
+    return (
+        np.stack(merged_boxes).astype(np.float32),
+        np.asarray(merged_scores, dtype=np.float32),
+        np.asarray(merged_ids, dtype=np.int64),
+    )
+
+
+def crop_tiles(image: np.ndarray, tiles: np.ndarray) -> List[np.ndarray]:
+    """Views of the image for each tile (no pixels are copied)."""
+    return [image[y1:y2, x1:x2] for x1, y1, x2, y2 in tiles.tolist()]
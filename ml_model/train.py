@@ -76,5 +76,6 @@ if __name__ == "__main__":
     model = train_model()
     
     # Save the model in ONNX format for deployment
-    model.export(format="onnx")
+    # (dynamic axes so the ONNX backend can run batches of images)
+    model.export(format="onnx", dynamic=True)
     print("\nModel exported to ONNX format for deployment") 
\ No newline at end of file
@@ -0,0 +1,285 @@
+"""
+Video detection with a pipelined decode / infer / encode loop.
+
+Three threads connected by bounded queues: one decodes frames, one runs
+batched inference and one serializes the per-frame detections (and writes
+the annotated video, if requested). Frames can be thinned with a stride, and
+frames that barely differ from the last inferred one reuse its detections.
+"""
+import json
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterator, List, Union
+
+import cv2
+import numpy as np
+
+try:
+    from ml_model.results import Detections, render_detections
+except ImportError:  # imported by a script, e.g. python ml_model/detect.py
+    from results import Detections, render_detections
+
+VIDEO_EXTENSIONS = {'.mp4', '.avi', '.mov', '.mkv', '.webm', '.m4v'}
+
+# Marks the end of the stream in the queues
+_END = object()
+
+
+class _Frame:
+    __slots__ = ("index", "timestamp", "image", "reused", "detections")
+
+    def __init__(self, index: int, timestamp: float, image: np.ndarray, reused: bool):
+        self.index = index
+        self.timestamp = timestamp
+        self.image = image
+        self.reused = reused
+        self.detections = None
+
+
+class _StageClock:
+    """Busy time of one pipeline stage, excluding time spent waiting on queues."""
+
+    def __init__(self):
+        self.busy = 0.0
+        self._started = None
+
+    def start(self):
+        self._started = time.perf_counter()
+
+    def stop(self):
+        self.busy += time.perf_counter() - self._started
+
+
+class VideoPipeline:
+    def __init__(
+        self,
+        detector,
+        conf_threshold: float = 0.25,
+        stride: int = 1,
+        scene_threshold: float = 0.0,
+        max_reuse: int = 30,
+        batch_size: int = 8,
+        queue_size: int = 32,
+        detect_batch: Callable[[List[np.ndarray], float], List[Detections]] = None
+    ):
+        """
+        Initialize the video pipeline.
+
+        Args:
+            detector: StarWarsDetector used for inference
+            conf_threshold (float): Confidence threshold for detections
+            stride (int): Only every stride-th frame is processed
+            scene_threshold (float): Mean absolute difference (0-1) of a small
+                grayscale thumbnail below which a frame reuses the previous
+                detections instead of being inferred; 0 disables skipping
+            max_reuse (int): Frames in a row that may reuse detections before
+                one is inferred again
+            batch_size (int): Maximum frames per forward pass
+            queue_size (int): Capacity of each queue between the stages
+            detect_batch: Optional replacement for detector.detect_batch,
+                e.g. to route frames through a BatchingScheduler
+        """
+        if stride < 1:
+            raise ValueError("stride must be at least 1")
+        self.detector = detector
+        self.conf_threshold = conf_threshold
+        self.stride = stride
+        self.scene_threshold = scene_threshold
+        self.max_reuse = max_reuse
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self._detect_batch = detect_batch or (
+            lambda images, conf: detector.detect_batch(images, conf, return_image=False)
+        )
+        self.report = None
+
+    def run(self, video_path: Union[str, Path], output_path: Union[str, Path] = None) -> Iterator[str]:
+        """
+        Process a video.
+
+        Args:
+            video_path: Path of the input video
+            output_path: Optional path of an annotated output video
+
+        Yields:
+            One JSON line per processed frame, as soon as it is ready. Once
+            the generator is exhausted, self.report holds the fps and the
+            per-stage utilization.
+        """
+        capture = cv2.VideoCapture(str(video_path))
+        if not capture.isOpened():
+            raise ValueError(f"Could not open video {video_path}")
+
+        decoded = queue.Queue(self.queue_size)
+        inferred = queue.Queue(self.queue_size)
+        lines = queue.Queue(self.queue_size)
+        stop = threading.Event()
+        errors = []
+        clocks = {'decode': _StageClock(), 'infer': _StageClock(), 'encode': _StageClock()}
+        counts = {'frames_read': 0, 'frames_inferred': 0, 'frames_reused': 0, 'batches': 0}
+        source_fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+
+        def put(q, item):
+            # Bounded put that gives up when the consumer went away
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def guarded(stage, downstream):
+            def wrapper():
+                try:
+                    stage()
+                except Exception as e:
+                    errors.append(e)
+                    stop.set()
+                finally:
+                    # Always let the next stage finish
+                    put(downstream, _END)
+            return wrapper
+
+        def decode_stage():
+            clock = clocks['decode']
+            last_thumb, reused_in_row, index = None, 0, -1
+            while not stop.is_set():
+                clock.start()
+                ok = capture.grab()
+                index += 1
+                if not ok:
+                    clock.stop()
+                    break
+                counts['frames_read'] += 1
+                if index % self.stride:
+                    clock.stop()
+                    continue
+                ok, image = capture.retrieve()
+                if not ok:
+                    clock.stop()
+                    break
+                reused = False
+                if self.scene_threshold > 0:
+                    thumb = cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), (64, 36),
+                                       interpolation=cv2.INTER_AREA).astype(np.int16)
+                    if (last_thumb is not None and reused_in_row < self.max_reuse
+                            and np.abs(thumb - last_thumb).mean() / 255.0 < self.scene_threshold):
+                        reused = True
+                        reused_in_row += 1
+                    else:
+                        last_thumb, reused_in_row = thumb, 0
+                frame = _Frame(index, index / source_fps, image, reused)
+                clock.stop()
+                if not put(decoded, frame):
+                    break
+
+        def infer_stage():
+            clock = clocks['infer']
+            last_detections = None
+            done = False
+            while not done and not stop.is_set():
+                try:
+                    batch = [decoded.get(timeout=0.1)]
+                except queue.Empty:
+                    continue
+                # Take whatever else is already decoded, up to a full batch of new frames
+                while batch[-1] is not _END and sum(not f.reused for f in batch) < self.batch_size:
+                    try:
+                        batch.append(decoded.get_nowait())
+                    except queue.Empty:
+                        break
+                if batch[-1] is _END:
+                    batch.pop()
+                    done = True
+
+                clock.start()
+                fresh = [frame for frame in batch if not frame.reused]
+                if fresh:
+                    results = self._detect_batch([frame.image for frame in fresh], self.conf_threshold)
+                    for frame, detections in zip(fresh, results):
+                        frame.detections = detections
+                    counts['batches'] += 1
+                    counts['frames_inferred'] += len(fresh)
+                # Frames are in order and the first one is never reused
+                for frame in batch:
+                    if frame.reused:
+                        frame.detections = last_detections
+                        counts['frames_reused'] += 1
+                    last_detections = frame.detections
+                clock.stop()
+                for frame in batch:
+                    if not put(inferred, frame):
+                        return
+
+        def encode_stage():
+            clock = clocks['encode']
+            writer = None
+            while not stop.is_set():
+                try:
+                    frame = inferred.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if frame is _END:
+                    break
+                clock.start()
+                line = (
+                    f'{{"frame":{frame.index},"time":{frame.timestamp:.3f},'
+                    f'"reused":{json.dumps(frame.reused)},'
+                    f'"detections":{frame.detections.to_json("label")}}}'
+                )
+                if output_path is not None:
+                    rendered = render_detections(frame.image, frame.detections)
+                    if writer is None:
+                        height, width = rendered.shape[:2]
+                        writer = cv2.VideoWriter(
+                            str(output_path), cv2.VideoWriter_fourcc(*"mp4v"),
+                            source_fps / self.stride, (width, height)
+                        )
+                    writer.write(rendered)
+                clock.stop()
+                if not put(lines, line):
+                    break
+            if writer is not None:
+                writer.release()
+
+        threads = [
+            threading.Thread(target=guarded(decode_stage, decoded), name="video-decode", daemon=True),
+            threading.Thread(target=guarded(infer_stage, inferred), name="video-infer", daemon=True),
+            threading.Thread(target=guarded(encode_stage, lines), name="video-encode", daemon=True),
+        ]
+        started = time.perf_counter()
+        emitted = 0
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                try:
+                    line = lines.get(timeout=0.1)
+                except queue.Empty:
+                    if stop.is_set():
+                        break
+                    continue
+                if line is _END:
+                    break
+                emitted += 1
+                yield line
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            capture.release()
+
+        if errors:
+            raise errors[0]
+        wall = time.perf_counter() - started
+        self.report = {
+            **counts,
+            'frames_emitted': emitted,
+            'source_fps': source_fps,
+            'wall_seconds': wall,
+            'fps': emitted / wall if wall else 0.0,
+            'utilization': {stage: clock.busy / wall if wall else 0.0 for stage, clock in clocks.items()},
+        }
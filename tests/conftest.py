@@ -0,0 +1,47 @@
+"""Stand-in model and synthetic scenes shared by the tests."""
+import sys
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.suite import make_scene
+
+
+def scene(seed, objects, width=640, height=640):
+    data = make_scene(width, height, objects, seed=seed)
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+@pytest.fixture(scope="session")
+def standin(tmp_path_factory):
+    """
+    Stand-in checkpoint whose detections can be compared one by one.
+
+    With random weights the activations vanish layer after layer and every
+    anchor gets the same score, so detections could only be compared up to
+    ties. Recalibrating the BatchNorm statistics on a few synthetic scenes
+    keeps the activations alive and spreads the scores.
+    """
+    torch = pytest.importorskip("torch")
+    pytest.importorskip("ultralytics")
+    from benchmarks.standin import build_standin_model
+
+    model_path = build_standin_model(tmp_path_factory.mktemp("model") / "standin.pt")
+    checkpoint = torch.load(model_path, weights_only=False)
+    model = checkpoint["model"]
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.reset_running_stats()
+            module.momentum = None
+    batch = np.stack([scene(seed, 8)[:, :, ::-1] for seed in range(10, 14)]).transpose(0, 3, 1, 2)
+    model.train()
+    with torch.no_grad():
+        model(torch.from_numpy(batch.copy()).float() / 255.0)
+    model.eval()
+    torch.save(checkpoint, model_path)
+    return model_path
@@ -0,0 +1,45 @@
+"""Parity of the PyTorch and ONNX backends on the stand-in model."""
+import pytest
+
+from conftest import scene
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("ultralytics")
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+from benchmarks.standin import build_standin_model
+from ml_model.backends import PyTorchBackend, compare_backends, create_backend
+
+CONF = 0.01
+
+
+@pytest.fixture(scope="module")
+def exported(standin):
+    """Stand-in checkpoint with its ONNX export next to it, as train.py leaves them."""
+    from ultralytics import YOLO
+
+    YOLO(str(standin), task="detect").export(format="onnx", dynamic=True)
+    return standin
+
+
+@pytest.mark.parametrize("shapes", [
+    [(640, 640), (640, 640)],
+    [(640, 480)],
+    [(640, 480), (1280, 360), (480, 640)],
+], ids=["square", "single-non-square", "mixed"])
+def test_backends_match(exported, shapes):
+    images = [scene(seed, 16, width, height) for seed, (width, height) in enumerate(shapes)]
+    detections = create_backend(exported, "onnx").predict(images, CONF)
+    assert all(len(boxes) > 0 for boxes, _, _ in detections)
+    assert compare_backends(exported, images, CONF) == []
+
+
+def test_fused_cache_reloads(tmp_path, monkeypatch):
+    # ultralytics 8.1 deja torch.load con weights_only=True, el valor por defecto desde torch 2.6
+    load = torch.load
+    monkeypatch.setattr(torch, "load", lambda *args, **kwargs: load(*args, **{**kwargs, "weights_only": True}))
+    model_path = build_standin_model(tmp_path / "standin.pt")
+    assert "save_fused" in PyTorchBackend(model_path).load_timings
+    # Second start: the cached fused model loads instead of fusing again
+    assert "fuse" not in PyTorchBackend(model_path).load_timings
@@ -0,0 +1,25 @@
+"""StarWarsDetector.detect_batch on the stand-in model."""
+import numpy as np
+import pytest
+
+from conftest import scene
+
+pytest.importorskip("torch")
+pytest.importorskip("ultralytics")
+
+from ml_model.detect import StarWarsDetector
+
+CONF = 0.01
+
+
+def test_batch_does_not_change_detections(standin):
+    # Una imagen no cuadrada, sola y en lotes con otras formas
+    detector = StarWarsDetector(standin, backend="pytorch")
+    image = scene(0, 16, 640, 480)
+    alone = detector.detect_batch([image], CONF)[0]
+    assert len(alone) > 0
+    for others in ([scene(1, 8, 1280, 360)], [scene(2, 8, 640, 480), scene(3, 8, 480, 640)]):
+        batched = detector.detect_batch(others + [image], CONF)[-1]
+        np.testing.assert_array_equal(batched.class_id, alone.class_id)
+        np.testing.assert_allclose(batched.xyxy, alone.xyxy, atol=1e-3)
+        np.testing.assert_allclose(batched.conf, alone.conf, atol=1e-5)